@@ -1,208 +1,349 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-def get_read_base(aln, qseq, qual, pos):
-    for qpos, rpos, rbase in aln:
-        if rpos != pos:
-            continue
-        return [rbase, qseq[qpos], qual[qpos]]
-    return ['', '', 0]
-
-def infer_variant(x, minBaseQual):
-    aln = x.get_aligned_pairs(matches_only = False, with_seq = True)
-    qseq = x.query_sequence
-    qual = x.query_qualities
-    mms = dict()
-    for qpos, rpos, rbase in aln:
-        if qpos is not None and rpos is not None and rbase.islower() and qual[qpos] >= minBaseQual:
-            mms[qpos] = [rpos+1, 'M', qseq[qpos]]
-    #if x.query_name == 'HISEQ15:141:C6VDGANXX:5:1115:10555:79840':
-    #    print(mms)
-    res = []
-    qpos, rpos = 0, x.reference_start
-    rbeg = rpos
-    vnts = []
-    for opt, nbase in x.cigartuples:
-        if opt == 0: #M
-            for i in range(0, nbase):
-                if qpos+i in mms:
-                    vnts.append(mms[qpos+i])
-            qpos += nbase
-            rpos += nbase
-        elif opt == 1: #I
-            vnts.append([rpos+1, "I", qseq[qpos+1:qpos+nbase+1]])
-            qpos += nbase
-        elif opt == 2: #D
-            vnts.append([rpos+1, "D", nbase])
-            rpos += nbase
-        elif opt == 3: #N
-            res.append([rbeg, rpos, vnts])
-            rpos += nbase
-            rbeg = rpos
-            vnts = []
-        elif opt == 4: #S
-            qpos += nbase
-        elif opt == 7 or opt == 8: #=X
-            qpos += 1
-            rpos += 1
-    if rpos > rbeg:
-        res.append([rbeg, rpos, vnts])
-    if qpos != x.query_length or rpos != x.reference_end:
-        print(qpos, x.query_alignment_end, rpos, x.reference_end, x.cigartuples, aln)
-        exit(1)
-    return res
-
-def read_variants(fv):
-    fhv = open(fv, "r")
-    vdic = dict()
-    for line in fhv:
-        line = line.strip("\n")
-        seqid, beg, end, gts = line.split("\t")
-        beg, end = int(beg), int(end)
-        ref, alt = gts.split(",")
-        pos = "%s_%d" % (seqid, int(beg) + 1)
-        vdic[pos] = [ref, alt]
-    fhv.close()
-    return vdic
-
-def bam2bed(args):
-    fi, fo = args.bam, args.bed
-    min_mapq, min_baseq = args.min_mapq, args.min_baseq
-    bam = pysam.AlignmentFile(fi, "rb")
-    fho = open(fo, "w")
-    for x in bam.fetch():
-        if x.is_duplicate or x.is_unmapped or x.is_secondary or x.mapping_quality < min_mapq:
-            continue
-        sid = x.query_name
-        rid, rbeg, rend = x.reference_name, x.reference_start, x.reference_end
-        #pair = 'pe' if x.is_paired else 'se'
-        #first = 'r1' if x.is_read1 else 'r2'
-        res = infer_variant(x, min_baseq)
-        #if sid == 'D00635:197:CAC47ANXX:2:2311:18289:97712':
-        #    print(res)
-        #    exit(1)
-        for rbeg, rend, vnts in res:
-            vntstr = '.'
-            if len(vnts) > 0:
-                vntstr = " ".join([":".join(map(str,vnt)) for vnt in vnts])
-            fho.write("%s\t%d\t%d\t%s\t%s\n" %
-                    (rid, rbeg, rend, sid, vntstr))
-        #exit(1)
-    fho.close()
+"""
+Allele-specific expression: the haplotype of RNA-seq reads from the alleles
+they carry at phased heterozygous sites, tallied per read and per gene.
 
-def infer_read(rows, fho, fhb):
-    rdic, vdic = dict(), dict()
-    sid, beg, end, rid = rows[0][0:4]
-    locs = set()
-    for row in rows:
-        assert rid == row[3], "error: " + str(rows)
-        if row[4] != '.':
-            for rvnt in row[4].split(" "):
-                pos, vtype, vnt = rvnt.split(":")
-                rdic[pos] = "%s:%s" % (vtype, vnt)
-        vpos, vnt, phase = row[7:10]
-        assert phase in ['0|1','1|0'], "Unknown phase: %s" % phase
-        vdic[vpos] = [vnt, phase]
-        loc = "%s:%s" % tuple(row[0:2])
-        if loc not in locs:
-            locs.add(loc)
-            fhb.write("%s\t%s\t%s\t%s\n" % tuple(row[0:4]))
-    n0, n1, nunk, nerr = 0, 0, 0, 0
-    for pos in vdic:
-        if pos in rdic:
-            if rdic[pos] == vdic[pos][0]:
-                if vdic[pos][1] == '0|1':
-                    n1 = n1 + 1
-                else:
-                    n0 = n0 + 1
-            else:
-                nunk = nunk + 1
-            del rdic[pos]
-        else:
-            if vdic[pos][1] == '0|1':
-                n0 = n0 + 1
-            else:
-                n1 = n1 + 1
-    nerr = len(rdic)
-    fho.write("%s\t%d\t%d\t%d\t%d\n" % (rid, n0, n1, nunk, nerr))
-
-def bed_prep(args):
-    fi, fo, fb = args.bed, args.out_tsv, args.out_bed
-    min_baseq = args.min_baseq
-    fhi = open(fi, "r")
-    fho = open(fo, "w")
-    fhb = open(fb, "w")
-    fho.write("rid\tn0\tn1\tnunk\tnerr\n")
-    prid = ""
-    rows = []
-    for line in fhi:
-        row = line.strip("\n").split("\t")
-        if prid == "":
-            rows.append(row)
-            prid = row[3]
-        elif row[3] == prid:
-            rows.append(row)
-        else:
-            infer_read(rows, fho, fhb)
-            rows = [row]
-            prid = row[3]
-    infer_read(rows, fho, fhb)
-    fhi.close()
-    fho.close()
-    fhb.close()
+Sites are held as sorted per-contig arrays. For a batch of reads, the sites
+in each aligned block come from `searchsorted` on the block ends, and the
+read bases and qualities at them from array indexing into the concatenated
+query sequences; mismatches elsewhere come from the MD tag. Contigs are
+processed on a pool of workers, all in memory.
+"""
+
+import re
+import logging
+import numpy as np
+
+from collections import defaultdict, deque
+from itertools import islice
 
-def bed_summarise(args):
-    fr, fb, fo = args.tsv, args.bed, args.out
+from jcvi.formats.sam import CigarBatch, CIGAR_REF, BAM_CMATCH, BAM_CINS, \
+        BAM_CDEL, BAM_CREF_SKIP, BAM_CHARD_CLIP, BAM_CEQUAL, BAM_CDIFF, \
+        open_alignments
 
-    fhr = open(fr, "r")
-    rdic = dict()
-    for line in fhr:
-        rid, n0, n1, nunk, nerr = line.strip("\n").split("\t")
-        if rid == 'rid':
+BATCHSIZE = 10000
+MD_RE = re.compile(r"(\d+)|\^([A-Za-z]+)|([A-Za-z])")
+UPPER = np.arange(256, dtype=np.uint8)
+UPPER[97:123] -= 32
+
+def md_mismatches(md):
+    """
+    Offsets of the mismatches in an MD tag from the alignment start, over
+    the aligned and deleted reference bases (N skips are not in MD).
+
+    >>> md_mismatches("10A5^AC6T0G2")
+    [10, 24, 25]
+    """
+    pos, offsets = 0, []
+    for num, dele, base in MD_RE.findall(md):
+        if num:
+            pos += int(num)
+        elif dele:
+            pos += len(dele)
+        else:
+            offsets.append(pos)
+            pos += 1
+    return offsets
+
+def read_sites(fv):
+    """
+    Phased single-base sites from a BED file of seqid, start (0-based), end,
+    alleles and phase. Alleles are "REF,ALT", or "M:ALT" with the reference
+    base taken from the MD tag of the reads; phase "0|1" (the default) puts
+    ALT on haplotype 1, "1|0" on haplotype 0. Returns seqid => (positions,
+    ref, alt, haplotype of ALT) sorted by position, ref 0 when unknown.
+    """
+    rows = defaultdict(list)
+    for line in open(fv, "r"):
+        row = line.rstrip("\n").split("\t")
+        if line.startswith("#") or len(row) < 4:
             continue
-        tag = "unk"
-        if int(n0) > 0 and int(n1) == 0:
-            tag = 'h0'
-        elif int(n0) == 0 and int(n1) > 0:
-            tag = 'h1'
-        elif int(n0) > 0 and int(n1) > 0:
-            tag = 'cft'
-        rdic[rid] = tag
-    fhr.close()
-
-    fhb = open(fb, "r")
-    gdic, tdic = dict(), dict()
-    for line in fhb:
-        row = line.strip("\n").split("\t")
-        gid, rid = row[3], row[7]
-        if gid not in gdic:
-            gdic[gid] = {'n0': 0, 'n1': 0, 'ncft': 0}
-        if gid not in tdic:
-            tdic[gid] = set()
-        if rid not in tdic[gid]:
-            tdic[gid].add(rid)
+        seqid, beg, end = row[0], int(row[1]), int(row[2])
+        if "," in row[3]:
+            ref, alt = row[3].split(",")[:2]
         else:
+            vtype, alt = row[3].split(":")
+            ref = '' if vtype == 'M' else 'NA'
+        if end - beg != 1 or len(ref) > 1 or len(alt) != 1:
             continue
-        if rid not in rdic:
-            print("%s not in read dict" % rid)
-        if rdic[rid] == 'h0':
-            gdic[gid]['n0'] += 1
-        elif rdic[rid] == 'h1':
-            gdic[gid]['n1'] += 1
-        elif rdic[rid] == 'cft':
-            gdic[gid]['ncft'] += 1
-    fhb.close()
-    
-    fho = open(fo, "w")
-    fho.write("gid\tn0\tn1\tncft\n")
-    for gid in sorted(gdic):
-        sdic = gdic[gid]
-        n0, n1, ncft = sdic['n0'], sdic['n1'], sdic['ncft']
-        if n0 + n1 < 0:
+        phase = row[4] if len(row) > 4 else '0|1'
+        assert phase in ['0|1','1|0'], "Unknown phase: %s" % phase
+        rows[seqid].append((beg, ord(ref.upper()) if ref else 0,
+                            ord(alt.upper()), int(phase == '0|1')))
+    sites = dict()
+    for seqid, vals in rows.items():
+        a = np.array(vals, dtype=np.int64)
+        a = a[np.unique(a[:,0], return_index=True)[1]]
+        sites[seqid] = (a[:,0], a[:,1].astype(np.uint8),
+                        a[:,2].astype(np.uint8), a[:,3].astype(np.uint8))
+    logging.debug("%d sites on %d contigs read from %s" %
+                  (sum(len(x[0]) for x in sites.values()), len(sites), fv))
+    return sites
+
+def read_genes(fg):
+    """
+    Genes from a BED file of seqid, start, end and gene id, as seqid =>
+    (starts, ends, gids) sorted by start.
+    """
+    rows = defaultdict(list)
+    for line in open(fg, "r"):
+        row = line.rstrip("\n").split("\t")
+        if line.startswith("#") or len(row) < 4:
+            continue
+        rows[row[0]].append((int(row[1]), int(row[2]), row[3]))
+    genes = dict()
+    for seqid, vals in rows.items():
+        vals.sort()
+        genes[seqid] = (np.array([x[0] for x in vals], dtype=np.int64),
+                        np.array([x[1] for x in vals], dtype=np.int64),
+                        [x[2] for x in vals])
+    return genes
+
+def phase_reads(batch, cb, sites, min_baseq=20):
+    """
+    Alleles of the reads in `batch` (a CigarBatch `cb` of them) at `sites`
+    of their contig. Returns the indices of the reads with sites in aligned
+    blocks and their (n0, n1, nunk, nerr) as an (m x 4) array: sites on
+    haplotype 0 and 1, sites with another base, and variants (mismatches
+    of base quality >= `min_baseq` and indels) off the sites. Bases below
+    `min_baseq` at sites are not counted.
+    """
+    spos, sref, salt, shap = sites
+    n = len(batch)
+    # (block, site) pairs
+    lo = np.searchsorted(spos, cb.btstarts)
+    k = np.searchsorted(spos, cb.btstarts + cb.bsizes) - lo
+    if not k.any():
+        return None
+    blk = np.repeat(np.arange(len(k)), k)
+    site = lo[blk] + np.arange(len(blk)) - np.repeat(np.cumsum(k) - k, k)
+    bread = np.repeat(np.arange(n), np.diff(cb.bbounds))
+    r = bread[blk]
+
+    nops = np.diff(cb.bounds)
+    opread = np.repeat(np.arange(n), nops)
+    # query positions of the engine count hard clipped bases
+    hclip = np.zeros(n, dtype=np.int64)
+    lead = np.flatnonzero(nops > 0)
+    lead = lead[cb.ops[cb.bounds[lead]] == BAM_CHARD_CLIP]
+    hclip[lead] = cb.lens[cb.bounds[lead]]
+
+    # query sequences and qualities of the reads with sites, concatenated
+    hit = np.unique(r)
+    seqs = [batch[i].query_sequence or "" for i in hit.tolist()]
+    quals = [batch[i].query_qualities for i in hit.tolist()]
+    slens = np.array([len(x) for x in seqs], dtype=np.int64)
+    rlen = np.zeros(n, dtype=np.int64)
+    soff = np.zeros(n, dtype=np.int64)
+    rlen[hit], soff[hit] = slens, np.cumsum(slens) - slens
+    seqbuf = UPPER[np.frombuffer("".join(seqs).encode(), dtype=np.uint8)]
+    qualbuf = np.frombuffer(b"".join(b"\xff" * len(s) if q is None else bytes(q)
+                            for s, q in zip(seqs, quals)), dtype=np.uint8)
+
+    qidx = cb.bqstarts[blk] + spos[site] - cb.btstarts[blk] - hclip[r]
+    ok = qidx < rlen[r]
+    site, r, qidx = site[ok], r[ok], qidx[ok]
+    if not len(r):
+        return None
+    hit = np.unique(r)
+
+    # mismatches from MD: offsets over M, =, X and D ops, to the reference
+    # and the query through the aligned op holding them
+    mmread, mmoff = [], []
+    for i in hit.tolist():
+        x = batch[i]
+        if x.has_tag("MD"):
+            offs = md_mismatches(x.get_tag("MD"))
+            mmread.extend([i] * len(offs))
+            mmoff.extend(offs)
+    mmread = np.array(mmread, dtype=np.int64)
+    mmoff = np.array(mmoff, dtype=np.int64)
+    isaln = (cb.ops == BAM_CMATCH) | (cb.ops == BAM_CEQUAL) | (cb.ops == BAM_CDIFF)
+    mdlens = np.where(isaln | (cb.ops == BAM_CDEL), cb.lens, 0)
+    cum = np.r_[0, np.cumsum(mdlens)]
+    mdpos = cum[:-1] - np.repeat(cum[cb.bounds[:-1]], nops)
+    aidx = np.flatnonzero(isaln)
+    big = np.int64(1) << 32
+    j = aidx[np.maximum(np.searchsorted(opread[aidx] * big + mdpos[aidx],
+                                        mmread * big + mmoff, side="right") - 1, 0)] \
+            if len(aidx) else np.zeros(0, dtype=np.int64)
+    off = mmoff - mdpos[j]
+    valid = (opread[j] == mmread) & (off >= 0) & (off < cb.lens[j])
+    mmread, j, off = mmread[valid], j[valid], off[valid]
+    mmref = cb.tpos[j] + off
+    mmq = cb.qpos[j] + off - hclip[mmread]
+    ismm = np.isin(r * big + spos[site], mmread * big + mmref)
+
+    base = seqbuf[soff[r] + qidx]
+    good = qualbuf[soff[r] + qidx] >= min_baseq
+    isalt = base == salt[site]
+    isref = ~isalt & np.where(sref[site] > 0, base == sref[site], ~ismm)
+    hap = np.where(isalt, shap[site], 1 - shap[site])
+    known = good & (isalt | isref)
+    n0 = np.bincount(r[known & (hap == 0)], minlength=n)
+    n1 = np.bincount(r[known & (hap == 1)], minlength=n)
+    nunk = np.bincount(r[good & ~isalt & ~isref], minlength=n)
+
+    offsite = ~np.isin(mmref, spos) & (qualbuf[soff[mmread] + mmq] >= min_baseq)
+    nerr = np.bincount(mmread[offsite], minlength=n) + \
+            cb.counts[:, BAM_CINS] + cb.counts[:, BAM_CDEL]
+    return hit, np.column_stack((n0, n1, nunk, nerr))[hit]
+
+def read_segments(cb, reads):
+    """
+    (read, start, end) of the pieces of alignments `reads` of `cb` between
+    N skips.
+    """
+    nops = np.diff(cb.bounds)
+    opread = np.repeat(np.arange(len(cb)), nops)
+    isn = cb.ops == BAM_CREF_SKIP
+    seg = np.cumsum(isn)
+    idx = np.flatnonzero(CIGAR_REF[cb.ops] & ~isn & np.isin(opread, reads))
+    if not len(idx):
+        return idx, idx, idx
+    newseg = np.r_[True, (opread[idx][1:] != opread[idx][:-1]) |
+                         (seg[idx][1:] != seg[idx][:-1])]
+    f = np.flatnonzero(newseg)
+    l = idx[np.r_[f[1:], len(idx)] - 1]
+    f = idx[f]
+    return opread[f], cb.tpos[f], cb.tpos[l] + cb.lens[l]
+
+def gene_overlaps(starts, ends, genes):
+    """
+    (interval, gene) index pairs of the intervals [starts, ends) overlapping
+    `genes` (starts, ends, gids) sorted by start.
+    """
+    gstarts, gends = genes[0], genes[1]
+    maxlen = int((gends - gstarts).max()) if len(gstarts) else 0
+    lo = np.searchsorted(gstarts, starts - maxlen, side="right")
+    k = np.maximum(np.searchsorted(gstarts, ends, side="left") - lo, 0)
+    iv = np.repeat(np.arange(len(starts)), k)
+    g = lo[iv] + np.arange(len(iv)) - np.repeat(np.cumsum(k) - k, k)
+    keep = gends[g] > starts[iv]
+    return iv[keep], g[keep]
+
+def ase_contig(contig, sites, genes=None, filename=None, reference=None,
+               min_mapq=20, min_baseq=20, batchsize=BATCHSIZE):
+    """
+    Haplotype counts of the reads on `contig` at its `sites`, summed over
+    the alignments of a read name (mates), in order of their first
+    alignment. Returns the read names, their (n0, n1, nunk, nerr), and
+    with `genes` the ids and (n0, n1, ncft) of the genes hit: reads with
+    sites on haplotype 0 only, 1 only, or both, that overlap a gene by an
+    N-delimited piece holding a site.
+    """
+    bam = open_alignments(filename, reference=reference)
+    reads = (x for x in bam.fetch(contig) if not (x.is_duplicate or x.is_unmapped
+             or x.is_secondary or x.mapping_quality < min_mapq))
+    names, tallies, segs = [], [], []
+    while True:
+        batch = list(islice(reads, batchsize))
+        if not batch:
+            break
+        cb = CigarBatch.from_strings([x.cigarstring for x in batch],
+                                     [x.reference_start for x in batch])
+        res = phase_reads(batch, cb, sites, min_baseq)
+        if res is None:
             continue
-        fho.write("%s\t%d\t%d\t%d\n" % (gid, n0, n1, ncft))
+        hit, counts = res
+        if genes is not None:
+            sread, sstart, send = read_segments(cb, hit)
+            # pieces of reads with sites, as the read-gene overlaps go
+            spos = sites[0]
+            keep = np.searchsorted(spos, send) > np.searchsorted(spos, sstart)
+            sread, sstart, send = sread[keep], sstart[keep], send[keep]
+            segs.append((np.searchsorted(hit, sread) + len(names), sstart, send))
+        names.extend(batch[i].query_name for i in hit.tolist())
+        tallies.append(counts)
+    bam.close()
+    if not names:
+        return [], np.zeros((0, 4), dtype=np.int64), [], np.zeros((0, 3), dtype=np.int64)
+
+    uniq, first, inv = np.unique(np.array(names), return_index=True,
+                                 return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    group = rank[inv]
+    tallies = np.vstack(tallies)
+    counts = np.zeros((len(uniq), 4), dtype=np.int64)
+    np.add.at(counts, group, tallies)
+    rnames = uniq[order].tolist()
+
+    gids, gcounts = [], np.zeros((0, 3), dtype=np.int64)
+    if genes is not None and segs and genes[2]:
+        sread = group[np.concatenate([x[0] for x in segs])]
+        iv, g = gene_overlaps(np.concatenate([x[1] for x in segs]),
+                              np.concatenate([x[2] for x in segs]), genes)
+        pairs = np.unique(sread[iv] * len(genes[2]) + g)
+        read, g = pairs // len(genes[2]), pairs % len(genes[2])
+        n0, n1 = counts[:,0] > 0, counts[:,1] > 0
+        tag = np.select([n0 & ~n1, n1 & ~n0, n0 & n1], [0, 1, 2], 3)
+        gc = np.bincount(g * 4 + tag[read], minlength=4 * len(genes[2])).\
+                reshape(-1, 4)
+        hits = np.flatnonzero(gc.sum(axis=1))
+        gids, gcounts = [genes[2][i] for i in hits.tolist()], gc[hits, :3]
+    return rnames, counts, gids, gcounts
+
+def iter_ase(bamfile, sites, genes=None, cpus=1, reference=None, **kwargs):
+    """
+    Iterate over `ase_contig` results of the contigs of an indexed BAM/CRAM
+    with sites, in file order, computed on `cpus` processes with a bounded
+    queue in flight.
+    """
+    from functools import partial
+
+    bam = open_alignments(bamfile, reference=reference)
+    contigs = [x for x in bam.references if x in sites]
+    bam.close()
+    nogenes = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+    args = lambda x: (x, sites[x], None if genes is None else
+                      genes.get(x, nogenes))
+    work = partial(ase_contig, filename=bamfile, reference=reference, **kwargs)
+    if cpus < 2:
+        for contig in contigs:
+            yield contig, work(*args(contig))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    pending = deque()
+    with ProcessPoolExecutor(cpus) as pool:
+        for contig in contigs:
+            pending.append((contig, pool.submit(work, *args(contig))))
+            if len(pending) >= 2 * cpus:
+                contig, future = pending.popleft()
+                yield contig, future.result()
+        while pending:
+            contig, future = pending.popleft()
+            yield contig, future.result()
+
+def count(args):
+    fi, fv, fo = args.bam, args.sites, args.out_tsv
+    sites = read_sites(fv)
+    genes = read_genes(args.genes) if args.genes else None
+    fho = open(fo, "w")
+    fho.write("rid\tn0\tn1\tnunk\tnerr\n")
+    gdic = dict()
+    for contig, (rnames, counts, gids, gcounts) in iter_ase(fi, sites, genes,
+            cpus=args.cpus, reference=args.reference, min_mapq=args.min_mapq,
+            min_baseq=args.min_baseq):
+        for rid, row in zip(rnames, counts.tolist()):
+            fho.write("%s\t%d\t%d\t%d\t%d\n" % (rid, *row))
+        for gid, row in zip(gids, gcounts.tolist()):
+            gdic[gid] = [x + y for x, y in zip(gdic.get(gid, [0, 0, 0]), row)]
+        logging.debug("%s: %d reads, %d genes" % (contig, len(rnames), len(gids)))
     fho.close()
 
+    if args.out_gene:
+        fhg = open(args.out_gene, "w")
+        fhg.write("gid\tn0\tn1\tncft\n")
+        for gid in sorted(gdic):
+            fhg.write("%s\t%d\t%d\t%d\n" % (gid, *gdic[gid]))
+        fhg.close()
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(
@@ -211,40 +352,26 @@ if __name__ == "__main__":
     )
     sp = parser.add_subparsers(title = 'available commands', dest = 'command')
 
-    sp1 = sp.add_parser("bam2bed",
+    sp1 = sp.add_parser("count",
             formatter_class = argparse.ArgumentDefaultsHelpFormatter,
-            help = 'convert bam to bed format using variant coordinates'
+            help = 'infer allele-specific read origin at phased sites and count per gene'
     )
-    sp1.add_argument('bam', help='input SAM/BAM file')
-    sp1.add_argument('bed', help = 'output BED file')
-    sp1.add_argument('--min_mapq', default=20, help='min mapping quality')
-    sp1.add_argument('--min_baseq', default=20, help='min base quality')
-    sp1.add_argument('--vcf', default='/home/springer/zhoux379/data/misc2/mo17vnt/53.vnt.final/61.rna.bed', help='variant file')
-    sp1.set_defaults(func = bam2bed)
-
-    sp1 = sp.add_parser("bed_prep",
-            formatter_class = argparse.ArgumentDefaultsHelpFormatter,
-            help = 'infer allele-specific read origin'
-    )
-    sp1.add_argument('bed_prep', help='input BED (ase) file')
+    sp1.add_argument('bam', help='input indexed BAM/CRAM file')
+    sp1.add_argument('sites', help='phased variant sites (BED: seqid, beg, end, "ref,alt" or "M:alt", phase)')
     sp1.add_argument('out_tsv', help = 'output read ASE file (tsv)')
-    sp1.add_argument('out_bed', help = 'output read location file (bed)')
-    sp1.add_argument('--min_baseq', default=20, help='min base quality')
-    sp1.set_defaults(func = bed_prep)
-
-    sp1 = sp.add_parser("bed_summarise",
-            formatter_class = argparse.ArgumentDefaultsHelpFormatter,
-            help = 'summarise allele-specific read counts per gene'
-    )
-    sp1.add_argument('tsv', help='input tsv (ase) file')
-    sp1.add_argument('bed', help = 'input gene-read intersection BED')
-    sp1.add_argument('out', help = 'output gene ASE file (tsv)')
-    sp1.set_defaults(func = bed_summarise)
+    sp1.add_argument('--genes', help='gene BED (seqid, beg, end, gid)')
+    sp1.add_argument('--out_gene', help = 'output gene ASE file (tsv), needs --genes')
+    sp1.add_argument('--min_mapq', type=int, default=20, help='min mapping quality')
+    sp1.add_argument('--min_baseq', type=int, default=20, help='min base quality')
+    sp1.add_argument('--reference', help='reference FASTA (CRAM input)')
+    sp1.add_argument('--cpus', type=int, default=1, help='contigs processed in parallel')
+    sp1.set_defaults(func = count)
 
     args = parser.parse_args()
     if args.command:
+        if args.command == 'count' and bool(args.genes) != bool(args.out_gene):
+            parser.error("--genes and --out_gene go together")
         args.func(args)
     else:
         print('Error: need to specify a sub command\n')
         parser.print_help()
-
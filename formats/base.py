@@ -3,14 +3,14 @@
 
 import os
 import os.path as op
-import math
 import sys
 import logging
 
 #from Bio import SeqIO
-from itertools import groupby, islice, cycle
+from itertools import groupby, islice, cycle, count
 
-from jcvi.apps.base import sh, debug, mkdir
+from jcvi.apps.base import sh, debug, mkdir, need_update
+from jcvi.formats.compress import get_codec, open_compressed
 debug()
 
 FastaExt = ("fasta", "fas", "fa", "fna", "cds", "pep", "faa", "fsa", "seq", "nt", "aa")
@@ -38,47 +38,184 @@ class LineFile (BaseFile, list):
             logging.debug("Load {0} lines from `{1}`.".\
                         format(len(self.lines), filename))
 
+    def fetch(self, seqid, start, end, preset=None):
+        """
+        Iterate over the lines overlapping seqid:start-end (1-based,
+        inclusive) of a sorted BGZF file, see `jcvi.formats.tabix`.
+        """
+        from jcvi.formats.tabix import TabixIndex
+
+        tabix = getattr(self, "_tabix", None)
+        if tabix is None or (preset and tabix.preset != preset):
+            tabix = self._tabix = TabixIndex(self.filename, preset=preset)
+        return tabix.fetch(seqid, start, end)
+
+def _parse_dict_columns(lines, keypos=0, valuepos=1, delimiter=None,
+                        keycast=None, cast=None):
+    """
+    Parse rows into parallel lists of keys and values. Rows that are too
+    short are returned separately, as (line number in chunk, row).
+    """
+    keys, values, short = [], [], []
+    ncols = max(keypos, valuepos) + 1
+    thiscols = 0
+    for lineno, row in enumerate(lines):
+        row = row.rstrip()
+        atoms = row.split(delimiter)
+        thiscols = len(atoms)
+        if thiscols < ncols:
+            short.append((lineno, row))
+            continue
+
+        key = atoms[keypos]
+        value = atoms[valuepos] if (valuepos is not None) else atoms
+        if keycast:
+            key = keycast(key)
+        if cast:
+            value = cast(value)
+        keys.append(key)
+        values.append(value)
+    return keys, values, short, thiscols
+
 class DictFile (BaseFile, dict):
     """
     Generic file parser for multi-column files, keyed by a particular index.
+    With `cpus` > 1 the file is parsed in shards, `keycast` and `cast` then
+    need to be picklable (not lambdas).
     """
     def __init__(self, filename, keypos=0, valuepos=1, delimiter=None,
-                       strict=True, keycast=None, cast=None):
+                       strict=True, keycast=None, cast=None, cpus=1):
 
         super(DictFile, self).__init__(filename)
         self.keypos = keypos
 
-        fp = must_open(filename)
+        from functools import partial
+
+        parser = partial(_parse_dict_columns, keypos=keypos, valuepos=valuepos,
+                         delimiter=delimiter, keycast=keycast, cast=cast)
+        if cpus > 1:
+            chunks = parse_sharded(filename, parser, cpus=cpus)
+        else:
+            chunks = [parser(must_open(filename))]
+
         ncols = max(keypos, valuepos) + 1
         thiscols = 0
-        for lineno, row in enumerate(fp):
-            row = row.rstrip()
-            atoms = row.split(delimiter)
-            thiscols = len(atoms)
-            if thiscols < ncols:
+        lineno = 0
+        for keys, values, short, chunkcols in chunks:
+            for i, row in short:
                 action = "Aborted" if strict else "Skipped"
 
                 msg = "Must contain >= {0} columns.  {1}.\n".format(ncols, action)
-                msg += "  --> Line {0}: {1}".format(lineno + 1, row)
+                msg += "  --> Line {0}: {1}".format(lineno + i + 1, row)
                 logging.error(msg)
                 if strict:
                     sys.exit(1)
-                else:
-                    continue
 
-            key = atoms[keypos]
-            value = atoms[valuepos] if (valuepos is not None) else atoms
-            if keycast:
-                key = keycast(key)
-            if cast:
-                value = cast(value)
-            self[key] = value
+            self.update(zip(keys, values))
+            lineno += len(keys) + len(short)
+            thiscols = chunkcols or thiscols
 
         assert thiscols, "File empty"
         self.ncols = thiscols
         logging.debug("Imported {0} records from `{1}`.".\
                     format(len(self), filename))
 
+def pack_strings(strings):
+    """
+    Pack strings into one uint8 buffer and an array of end offsets, so that
+    they can be saved to (and memory-mapped from) .npy files.
+
+    >>> buf, ends = pack_strings(["chr1", "", "scaffold_2"])
+    >>> unpack_strings(buf, ends)
+    ['chr1', '', 'scaffold_2']
+    """
+    import numpy as np
+
+    enc = [x.encode() for x in strings]
+    ends = np.cumsum([len(x) for x in enc], dtype="int64")
+    return np.frombuffer(b"".join(enc), dtype="uint8"), ends
+
+def unpack_strings(buf, ends):
+    data = bytes(buf)
+    begs = [0] + ends[:-1].tolist()
+    return [data[b:e].decode() for b, e in zip(begs, ends.tolist())]
+
+class ColumnCache (object):
+    """
+    Opt-in sidecar cache of parsed columns. `<file>.npcache/` holds one .npy
+    per column, which later loads memory-map (so processes share the pages),
+    and a json stamp with the path, size and mtime of the source file. The
+    cache is used only while the stamp matches and `need_update` agrees.
+    `kind` tells apart caches of different parsers of the same file.
+    """
+    version = 1
+
+    def __init__(self, filename, kind):
+        self.filename = filename
+        self.kind = kind
+        self.cachedir = filename + ".npcache"
+        self.metafile = op.join(self.cachedir, kind + ".json")
+
+    def _path(self, name):
+        return op.join(self.cachedir, "{0}.{1}.npy".format(self.kind, name))
+
+    def _stamp(self):
+        st = os.stat(self.filename)
+        return {"path": op.abspath(self.filename), "size": st.st_size,
+                "mtime": st.st_mtime, "version": self.version}
+
+    def load(self):
+        """
+        Returns (columns, meta) with the columns memory-mapped, or None if
+        there is no valid cache.
+        """
+        import json
+        import numpy as np
+        from jcvi.apps.base import need_update
+
+        if not op.isfile(self.filename) or \
+                need_update(self.filename, self.metafile):
+            return None
+        with open(self.metafile) as fp:
+            meta = json.load(fp)
+        if meta.get("stamp") != self._stamp():
+            return None
+        try:
+            columns = dict((x, np.load(self._path(x), mmap_mode="r")) \
+                            for x in meta["columns"])
+        except (IOError, ValueError):
+            return None
+        logging.debug("Load cached columns of `{0}` from `{1}`".\
+                        format(self.filename, self.cachedir))
+        return columns, meta.get("extra", {})
+
+    def save(self, columns, **extra):
+        """
+        Write the columns (dict of arrays) and json-able extras. Failing to
+        write, e.g. in a read-only directory, only logs an error.
+        """
+        import json
+        import numpy as np
+
+        if not op.isfile(self.filename):
+            return
+        try:
+            mkdir(self.cachedir)
+            for name, col in columns.items():
+                tmpfile = self._path(name) + ".tmp"
+                with open(tmpfile, "wb") as fw:
+                    np.save(fw, np.ascontiguousarray(col))
+                os.rename(tmpfile, self._path(name))
+            meta = {"stamp": self._stamp(), "columns": list(columns.keys()),
+                    "extra": extra}
+            with open(self.metafile, "w") as fw:
+                json.dump(meta, fw)
+        except (IOError, OSError) as e:
+            logging.error("Cannot cache `{0}`: {1}".format(self.filename, e))
+            return
+        logging.debug("Cached columns of `{0}` in `{1}`".\
+                        format(self.filename, self.cachedir))
+
 class SetFile (BaseFile, set):
 
     def __init__(self, filename, column=-1, delimiter=None):
@@ -131,8 +268,76 @@ class FileMerger (object):
 
         return outfile
 
-class FileSplitter (object):
+def lpt_assign(sizes, N):
+    """
+    Longest Processing Time (LPT) assignment of jobs to N machines: jobs
+    are taken from the largest down, each going to the machine with the
+    least load so far (kept in a heap). This achieves an upper bound of
+    4/3 - 1/(3m) OPT.
+
+    Citation: <http://en.wikipedia.org/wiki/Multiprocessor_scheduling>
+
+    >>> lpt_assign([5, 3, 3, 2, 2, 1], 2)
+    [0, 1, 1, 0, 1, 0]
+    """
+    import heapq
+
+    order = sorted(range(len(sizes)), key=lambda x: -sizes[x])
+    heap = [(0, i) for i in range(N)]
+    assign = [0] * len(sizes)
+    for j in order:
+        load, i = heapq.heappop(heap)
+        assign[j] = i
+        heapq.heappush(heap, (load + sizes[j], i))
+    return assign
+
+class ShardWriter (object):
+    """
+    Buffered text writers for a set of output files. A full buffer is
+    written out on a thread pool, so shards (and their compression) are
+    written concurrently; each shard has at most one write in flight, which
+    keeps its records in order.
+    """
+    def __init__(self, names, threads=4, bufsize=1 << 20):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.fhs = [open_compressed(x, "w", threads=1) if get_codec(x) \
+                        else open(x, "w") for x in names]
+        self.bufs = [[] for x in names]
+        self.sizes = [0] * len(names)
+        self.pending = [None] * len(names)
+        self.bufsize = bufsize
+        self.pool = ThreadPoolExecutor(threads)
+
+    def write(self, i, text):
+        self.bufs[i].append(text)
+        self.sizes[i] += len(text)
+        if self.sizes[i] >= self.bufsize:
+            self._flush(i)
+
+    def _flush(self, i):
+        if self.pending[i]:
+            self.pending[i].result()
+        data = "".join(self.bufs[i])
+        self.bufs[i], self.sizes[i] = [], 0
+        self.pending[i] = self.pool.submit(self.fhs[i].write, data)
+
+    def close(self):
+        for i, buf in enumerate(self.bufs):
+            if buf:
+                self._flush(i)
+        for f in self.pending:
+            if f:
+                f.result()
+        self.pool.shutdown()
+        for fh in self.fhs:
+            fh.close()
 
+class FileSplitter (object):
+    """
+    Split FASTA/FASTQ/txt/clust files at record boundaries. Records are
+    streamed as raw text, sequences are never parsed into SeqRecords.
+    """
     def __init__(self, filename, outputdir=None, format="fasta", mode="cycle"):
         self.filename = filename
         self.outputdir = outputdir
@@ -151,24 +356,79 @@ class FileSplitter (object):
         self.format = format
         mkdir(outputdir)
 
-    def _open(self, filename):
-
-        if self.klass == "seqio":
-            handle = SeqIO.parse(open(filename), self.format)
-        elif self.klass == "clust":
+    def _iter_records(self):
+        """
+        Yields (record text, size) where size is the number of bases for
+        FASTA/FASTQ and the number of characters otherwise.
+        """
+        if self.klass == "clust":
             from jcvi.apps.uclust import ClustFile
-            handle = iter(ClustFile(filename))
+            for b in ClustFile(self.filename):
+                b = "{0}\n".format(b)
+                yield b, len(b)
+            return
+
+        fp = must_open(self.filename)
+        if self.format == "fasta":
+            rec, size = [], 0
+            for line in fp:
+                if line[0] == ">":
+                    if rec:
+                        yield "".join(rec), size
+                    rec, size = [line], 0
+                elif rec:
+                    rec.append(line)
+                    size += len(line.rstrip())
+            if rec:
+                yield "".join(rec), size
+        elif self.format == "fastq":
+            while True:
+                rec = list(islice(fp, 4))
+                if not rec:
+                    break
+                yield "".join(rec), len(rec[1].rstrip())
         else:
-            handle = open(filename)
-        return handle
+            for line in fp:
+                yield line, len(line)
+        fp.close()
+
+    def _fai(self):
+        # sequence lengths from a samtools faidx index, if it is up to date
+        faifile = self.filename + ".fai"
+        if self.format != "fasta" or not op.exists(faifile) or \
+                need_update(self.filename, faifile):
+            return None
+        return [int(x.split("\t")[1]) for x in open(faifile) if x.strip()]
+
+    @property
+    def record_sizes(self):
+        sizes = self._fai()
+        if sizes is None:
+            sizes = [size for rec, size in self._iter_records()]
+        return sizes
 
     @property
     def num_records(self):
-        handle = self._open(self.filename)
-        return sum(1 for x in handle)
+        sizes = self._fai()
+        if sizes is not None:
+            return len(sizes)
+        if self.klass == "clust":
+            return sum(1 for x in self._iter_records())
+
+        fp = must_open(self.filename)
+        if self.format == "fasta":
+            n = sum(1 for x in fp if x[0] == ">")
+        elif self.format == "fastq":
+            n = sum(1 for x in fp) // 4
+        else:
+            n = sum(1 for x in fp)
+        fp.close()
+        return n
 
     def _guess_format(self, filename):
         root, ext = op.splitext(filename)
+        if get_codec(filename):
+            root, ext = op.splitext(root)
         ext = ext.strip(".")
 
         if ext in FastaExt:
@@ -179,62 +439,38 @@ class FileSplitter (object):
             format = "txt"
         return format
 
-    def _batch_iterator(self, N=1):
-        """Returns N lists of records.
-
-        This can be used on any iterator, for example to batch up
-        SeqRecord objects from Bio.SeqIO.parse(...), or to batch
-        Alignment objects from Bio.AlignIO.parse(...), or simply
-        lines from a file handle.
-
-        This is a generator function, and it returns lists of the
-        entries from the supplied iterator.  Each list will have
-        batch_size entries, although the final list may be shorter.
-        """
-        batch_size = math.ceil(self.num_records / float(N))
-        handle = self._open(self.filename)
-        while True:
-            batch = list(islice(handle, batch_size))
-            if not batch:
-                break
-            yield batch
-
     @classmethod
     def get_names(cls, filename, N):
         root, ext = op.splitext(op.basename(filename))
+        if get_codec(filename):     # x.fa.gz => x_0.fa.gz
+            root, ext2 = op.splitext(root)
+            ext = ext2 + ext
 
         names = []
         pad0 = len(str(int(N - 1)))
-        for i in xrange(N):
+        for i in range(N):
             name = "{0}_{1:0{2}d}{3}".format(root, i, pad0, ext)
             names.append(name)
 
         return names
 
-    def write(self, fw, batch):
-        if self.klass == "seqio":
-            SeqIO.write(batch, fw, self.format)
-        elif self.klass == "clust":
-            for b in batch:
-                print >> fw, b
-        else:
-            for line in batch:
-                fw.write(line)
-        return len(batch)
-
-    def split(self, N, force=False):
+    def split(self, N, force=False, names=None, threads=4):
         """
-        There are two modes of splitting the records
+        There are three modes of splitting the records
         - batch: splitting is sequentially to records/N chunks
         - cycle: placing each record in the splitted files and cycles
+        - optimal: balance the number of bases with LPT (`lpt_assign`),
+          sizes come from the .fai index if there is one
 
-        use `cycle` if the len of the record is not evenly distributed
+        use `optimal` if the len of the record is not evenly distributed.
+        Output files ending with .gz are compressed, and the shards are
+        written concurrently on `threads` threads.
         """
         mode = self.mode
         assert mode in ("batch", "cycle", "optimal")
         logging.debug("set split mode=%s" % mode)
 
-        self.names = self.__class__.get_names(self.filename, N)
+        self.names = names or self.__class__.get_names(self.filename, N)
         if self.outputdir:
             self.names = [op.join(self.outputdir, x) for x in self.names]
 
@@ -243,39 +479,24 @@ class FileSplitter (object):
                     self.names[0])
             return
 
-        filehandles = [open(x, "w") for x in self.names]
-
         if mode == "batch":
-            for batch, fw in zip(self._batch_iterator(N), filehandles):
-                count = self.write(fw, batch)
-                logging.debug("write %d records to %s" % (count, fw.name))
-
+            batch_size = max(-(-self.num_records // N), 1)
+            assign = (i // batch_size for i in count())
         elif mode == "cycle":
-            handle = self._open(self.filename)
-            for record, fw in izip(handle, cycle(filehandles)):
-                count = self.write(fw, [record])
-
-        elif mode == "optimal":
-            """
-            This mode is based on Longest Processing Time (LPT) algorithm:
-
-            A simple, often-used algorithm is the LPT algorithm (Longest
-            Processing Time) which sorts the jobs by its processing time and
-            then assigns them to the machine with the earliest end time so far.
-            This algorithm achieves an upper bound of 4/3 - 1/(3m) OPT.
-
-            Citation: <http://en.wikipedia.org/wiki/Multiprocessor_scheduling>
-            """
-            endtime = [0] * N
-            handle = self._open(self.filename)
-            for record in handle:
-                mt, mi = min((x, i) for (i, x) in enumerate(endtime))
-                fw = filehandles[mi]
-                count = self.write(fw, [record])
-                endtime[mi] += len(record)
-
-        for fw in filehandles:
-            fw.close()
+            assign = cycle(range(N))
+        else:
+            sizes = self.record_sizes
+            assign = lpt_assign(sizes, N)
+            loads = [0] * N
+            for size, i in zip(sizes, assign):
+                loads[i] += size
+            logging.debug("shard sizes range {0} - {1}".\
+                            format(min(loads), max(loads)))
+
+        writer = ShardWriter(self.names, threads=threads)
+        for (record, size), i in zip(self._iter_records(), assign):
+            writer.write(i, record)
+        writer.close()
 
 def longest_unique_prefix(query, targets, remove_self=True):
     """
@@ -310,20 +531,25 @@ def timestamp():
     return "{0}{1:02d}{2:02d}".format(dt.now().year, dt.now().month, dt.now().day)
 
 def must_open(filename, mode="r", checkexists=False, skipcheck=False, \
-            oappend=False):
+            oappend=False, region=None):
     """
     Accepts filename and returns filehandle.
 
-    Checks on multiple files, stdin/stdout/stderr, .gz or .bz2 file.
+    Checks on multiple files, stdin/stdout/stderr, and compressed files
+    (.gz, .bgz, .bz2, .xz, .zst, see `jcvi.formats.compress`). With `region`
+    given as (seqid, start, end), a sorted BGZF file is read only over the
+    lines overlapping it, through an index cached next to the file.
     """
+    if region:
+        assert "r" in mode
+        from jcvi.formats.tabix import tabix_fetch
+        return (x + "\n" for x in tabix_fetch(filename, *region))
+
     if isinstance(filename, list):
         assert "r" in mode
 
-        if filename[0].endswith((".gz", ".bz2")):
-            filename = " ".join(filename)  # allow opening multiple gz/bz2 files
-        else:
-            import fileinput
-            return fileinput.input(filename)
+        import fileinput
+        return fileinput.input(filename, openhook=_open_hook)
 
     if filename.startswith("s3://"):
         from jcvi.utils.aws import pull_from_s3
@@ -345,23 +571,9 @@ def must_open(filename, mode="r", checkexists=False, skipcheck=False, \
         from tempfile import NamedTemporaryFile
         fp = NamedTemporaryFile(delete=False)
 
-    elif filename.endswith(".gz"):
-        if "r" in mode:
-            cmd = "gunzip -c %s" % filename
-            from subprocess import Popen, PIPE
-            fp = Popen(cmd, bufsize = 1, stdout = PIPE, shell = True, universal_newlines = True).stdout
-        elif "w" in mode:
-            import gzip
-            fp = gzip.open(filename, mode)
-
-    elif filename.endswith(".bz2"):
-        if "r" in mode:
-            cmd = "bzcat -c %s" % filename
-            from subprocess import Popen, PIPE
-            fp = Popen(cmd, bufsize = 1, stdout = PIPE, shell = True, universal_newlines = True).stdout
-        elif "w" in mode:
-            import bz2
-            fp = bz2.open(filename, mode)
+    elif get_codec(filename):
+        # .gz, .bgz, .bz2, .xz, .zst are handled in-process
+        fp = open_compressed(filename, mode)
 
     else:
         if checkexists:
@@ -382,6 +594,117 @@ def must_open(filename, mode="r", checkexists=False, skipcheck=False, \
 
     return fp
 
+SHARDSIZE = 1 << 26      # 64MB of file per parsing shard
+
+def file_shards(filename, shardsize=SHARDSIZE):
+    """
+    Split a file into shards that each start at a line start: byte ranges
+    for a plain file, runs of blocks for a BGZF file. Other compressed files
+    and streams come back as one shard.
+    """
+    from jcvi.formats.compress import block_offsets, get_codec, is_bgzf
+
+    if filename in ("-", "stdin") or not op.isfile(filename):
+        return [("stream", filename)]
+
+    size = op.getsize(filename)
+    with open(filename, "rb") as fp:
+        if get_codec(filename):
+            if not is_bgzf(fp.read(18)):
+                return [("stream", filename)]
+            offsets = block_offsets(fp) + [size]
+            shards, prev, beg = [], None, 0
+            for i in range(1, len(offsets)):
+                if offsets[i] - offsets[beg] >= shardsize or \
+                        i == len(offsets) - 1:
+                    shards.append(("bgzf", prev, offsets[beg], offsets[i]))
+                    prev, beg = offsets[i - 1], i
+            return shards
+
+        bounds = [0]
+        for target in range(shardsize, size, shardsize):
+            if target <= bounds[-1]:
+                continue
+            fp.seek(target - 1)
+            fp.readline()     # the line holding byte target - 1 stays behind
+            if fp.tell() >= size:
+                break
+            bounds.append(fp.tell())
+    bounds.append(size)
+    return [("plain", a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def read_shard(filename, shard):
+    """
+    Returns the lines (newline stripped) starting within a shard made by
+    `file_shards`. A line crossing into the next BGZF shard is completed
+    from the blocks after it.
+    """
+    kind = shard[0]
+    if kind == "stream":
+        return [x.rstrip("\n") for x in must_open(filename)]
+
+    from jcvi.formats.compress import bgzf_inflate, read_block, split_blocks
+
+    with open(filename, "rb") as fp:
+        if kind == "plain":
+            _, beg, end = shard
+            fp.seek(beg)
+            data = fp.read(end - beg)
+        else:
+            _, prev, beg, end = shard
+            at_start = True
+            if prev is not None:
+                fp.seek(prev)
+                at_start = bgzf_inflate(fp.read(beg - prev)).endswith(b"\n")
+            fp.seek(beg)
+            blocks, _ = split_blocks(fp.read(end - beg))
+            data = b"".join(bgzf_inflate(x) for x in blocks)
+            if not at_start:   # first partial line belongs to the shard before
+                data = data[data.find(b"\n") + 1:] if b"\n" in data else b""
+            tail = b""
+            while data and not data.endswith(b"\n") and \
+                    not tail.endswith(b"\n"):
+                block = read_block(fp)
+                if not block:
+                    break
+                chunk = bgzf_inflate(block)
+                nl = chunk.find(b"\n")
+                tail += chunk if nl < 0 else chunk[:nl + 1]
+            data += tail
+
+    lines = data.decode().split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    return lines
+
+def _parse_shard(args):
+    filename, shard, parser = args
+    return parser(read_shard(filename, shard))
+
+def parse_sharded(filename, parser, cpus=1, shardsize=SHARDSIZE):
+    """
+    Parse a large file in parallel. The file is cut into newline-aligned
+    shards (`file_shards`), `parser` turns the lines of each shard into a
+    chunk on a `ProcessPoolExecutor`, and the chunks come back in file order.
+    `parser` must be picklable, i.e. a module-level function or a partial
+    of one, and should return compact columns (arrays, packed strings):
+    sending back one Python object per row costs about as much as parsing.
+    """
+    shards = file_shards(filename, shardsize=shardsize)
+    if cpus <= 1 or len(shards) < 2:
+        return [parser(read_shard(filename, x)) for x in shards]
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    logging.debug("Parse `{0}` in {1} shards on {2} processes".\
+                    format(filename, len(shards), cpus))
+    with ProcessPoolExecutor(cpus) as pool:
+        return list(pool.map(_parse_shard,
+                             [(filename, x, parser) for x in shards]))
+
+def _open_hook(filename, mode, **kwargs):
+    return must_open(filename, mode)
+
 bash_shebang = "#!/bin/bash"
 python_shebang = """#!/usr/bin/env python
 # -*- coding: UTF-8 -*-"""
@@ -9,16 +9,19 @@ import logging
 import numpy as np
 
 from collections import defaultdict
+from functools import partial
 from itertools import groupby
-from jcvi.formats.base import LineFile, must_open, is_number, get_number
+from jcvi.formats.base import BaseFile, LineFile, must_open, is_number, \
+            get_number, parse_sharded, ColumnCache, pack_strings, unpack_strings
+from jcvi.formats.tabix import is_bgzf_file
 from jcvi.formats.sizes import Sizes
 from jcvi.utils.iter import pairwise
 from jcvi.utils.cbook import SummaryStats, thousands, percentage
 from jcvi.utils.grouper import Grouper
-from jcvi.utils.range import Range, range_union, range_chain, \
-            range_distance, range_intersect
+from jcvi.utils.range import range_union, range_union_array, \
+            range_chain_array, range_distance, range_intersect
 from jcvi.apps.base import sh, need_update, mkdir
-from jcvi.utils.natsort import natsort_key, natsorted
+from jcvi.utils.natsort import natsorted, seqid_ranks
 
 def make_window(beg, end, winsize, winstep):
     import math
@@ -126,27 +129,101 @@ class BedLine(object):
             strand, '.', 'ID=' + self.accn))
         return row
 
+class IntervalIndex(object):
+    """
+    Per-seqid query index over a set of intervals. Within each seqid, rows
+    are sorted by start and augmented with the running maximum of ends, so
+    both overlap and containment queries are two binary searches followed by
+    a vectorized filter of the candidate slice.
+
+    Queries return row indices (into the original container) in input order.
+    """
+    def __init__(self, codes, names, starts, ends):
+        codes = np.asarray(codes)
+        starts = np.asarray(starts, dtype="int64")
+        ends = np.asarray(ends, dtype="int64")
+        self.index = {}
+        if not len(codes):
+            return
+        order = np.lexsort((starts, codes))
+        scodes = codes[order]
+        breaks = np.flatnonzero(np.diff(scodes)) + 1
+        bounds = [0] + breaks.tolist() + [len(order)]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            rows = order[a:b]
+            se = ends[rows]
+            self.index[names[scodes[a]]] = \
+                    (rows, starts[rows], se, np.maximum.accumulate(se))
+
+    def __contains__(self, seqid):
+        return seqid in self.index
+
+    def rows(self, seqid):
+        if seqid not in self.index:
+            return np.zeros(0, dtype="int64")
+        return np.sort(self.index[seqid][0])
+
+    def overlap(self, seqid, start, end):
+        # rows with start <= end and end >= start (1-based, inclusive)
+        if seqid not in self.index:
+            return np.zeros(0, dtype="int64")
+        rows, ss, se, maxend = self.index[seqid]
+        lo = np.searchsorted(maxend, start, side="left")
+        hi = np.searchsorted(ss, end, side="right")
+        if lo >= hi:
+            return np.zeros(0, dtype="int64")
+        hits = rows[lo:hi][se[lo:hi] >= start]
+        return np.sort(hits)
+
+    def contain(self, seqid, start, end):
+        # rows that lie completely within [start, end]
+        if seqid not in self.index:
+            return np.zeros(0, dtype="int64")
+        rows, ss, se, maxend = self.index[seqid]
+        lo = np.searchsorted(ss, start, side="left")
+        hi = np.searchsorted(ss, end, side="right")
+        if lo >= hi:
+            return np.zeros(0, dtype="int64")
+        hits = rows[lo:hi][se[lo:hi] <= end]
+        return np.sort(hits)
+
+def _parse_bedlines(lines, juncs=False, include=None):
+    beds = []
+    for line in lines:
+        if not line or line[0] == "#" or \
+                (juncs and line.startswith('track name')):
+            continue
+        b = BedLine(line)
+        if include and b.accn not in include:
+            continue
+        beds.append(b)
+    return beds
+
 class Bed(LineFile):
 
     def __init__(self, filename=None, key=None, sorted=True, juncs=False,
-                       include=None):
+                       include=None, lazy=False):
         super(Bed, self).__init__(filename)
 
         # the sorting key provides some flexibility in ordering the features
-        # for example, user might not like the lexico-order of seqid
-        self.nullkey = lambda x: (natsort_key(x.seqid), x.start, x.accn)
+        # for example, user might not like the lexico-order of seqid.
+        # seqids are compared by their memoized natural-order rank, see sort()
+        self.nullkey = lambda x: (seqid_ranks[x.seqid], x.start, x.accn or "")
         self.key = key or self.nullkey
+        self._index = None
+        self.lazy = False
 
         if not filename:
             return
 
-        for line in must_open(filename):
-            if line[0] == "#" or (juncs and line.startswith('track name')):
-                continue
-            b = BedLine(line)
-            if include and b.accn not in include:
-                continue
-            self.append(b)
+        # a sorted BGZF file can stay on disk, `extract` and `overlap` then
+        # seek to the region through its index
+        if lazy and is_bgzf_file(filename):
+            self.lazy = True
+            return
+
+        self.extend(_parse_bedlines(must_open(filename), juncs=juncs,
+                                    include=include))
 
         if sorted:
             self.sort(key=self.key)
@@ -154,6 +231,37 @@ class Bed(LineFile):
     def add(self, row):
         self.append(BedLine(row))
 
+    def reindex(self):
+        # call after editing seqid/start/end of rows in place
+        self._index = None
+
+    def sort(self, key=None, reverse=False):
+        """
+        Sort in place, by default with `nullkey`. All seqids are registered in
+        the shared rank table first, so the sort only compares integers. Rows
+        may have been edited in place, so every call sorts again; on rows
+        already in order that is a single linear pass.
+        """
+        key = key or self.nullkey
+        ranks = seqid_ranks.update(b.seqid for b in self)
+        if key is self.nullkey:
+            key = lambda x: (ranks[x.seqid], x.start, x.accn or "")
+        list.sort(self, key=key, reverse=reverse)
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            codes = {}
+            seqids = [codes.setdefault(b.seqid, len(codes)) for b in self]
+            names = [None] * len(codes)
+            for name, code in codes.items():
+                names[code] = name
+            self._index = IntervalIndex(seqids, names,
+                                        [b.start for b in self],
+                                        [b.end for b in self])
+        return self._index
+
     def print_to_file(self, filename="stdout", sorted=False):
         if sorted:
             self.sort(key=self.key)
@@ -216,18 +324,27 @@ class Bed(LineFile):
 
     def extract(self, seqid, start, end):
         # get all features within certain range
-        for b in self:
-            if b.seqid != seqid:
-                continue
-            if b.start < start or b.end > end:
-                continue
-            yield b
+        if self.lazy:
+            for b in self.overlap(seqid, start, end):
+                if b.start >= start and b.end <= end:
+                    yield b
+            return
+        for i in self.index.contain(seqid, start, end):
+            yield self[i]
+
+    def overlap(self, seqid, start, end):
+        # get all features overlapping certain range
+        if self.lazy:
+            for line in self.fetch(seqid, start, end, preset="bed"):
+                yield BedLine(line)
+            return
+        for i in self.index.overlap(seqid, start, end):
+            yield self[i]
 
     def sub_bed(self, seqid):
         # get all the beds on one chromosome
-        for b in self:
-            if b.seqid == seqid:
-                yield b
+        for i in self.index.rows(seqid):
+            yield self[i]
 
     def sub_beds(self):
 
@@ -244,6 +361,339 @@ class Bed(LineFile):
             # chromosome, extent of the chromosome
             yield seqid, ranks[0][1], ranks[-1][1]
 
+def _drop_index(method):
+    def wrapped(self, *args, **kwargs):
+        self._index = None
+        return method(self, *args, **kwargs)
+    wrapped.__name__ = method.__name__
+    return wrapped
+
+# any change to the list drops the query index, rebuilt on demand
+for name in ("append", "extend", "insert", "remove", "pop", "clear",
+             "reverse", "__setitem__", "__delitem__", "__iadd__"):
+    setattr(Bed, name, _drop_index(getattr(list, name)))
+del name
+
+def _parse_bed_columns(lines, include=None):
+    """
+    Parse BED lines into columns: (seqid names, seqid codes, 1-based starts,
+    ends, raw bytes of the columns after end, their begin/end offsets).
+    """
+    from array import array
+
+    codes = {}
+    seqid, start, end = array("i"), array("q"), array("q")
+    tail, tail_beg, tail_end = bytearray(), array("q"), array("q")
+    for line in lines:
+        if not line or line[0] == "#" or line.startswith("track"):
+            continue
+        atoms = line.rstrip("\n").split("\t", 3)
+        rest = atoms[3] if len(atoms) > 3 else ""
+        if include and rest.split("\t", 1)[0] not in include:
+            continue
+        code = codes.get(atoms[0])
+        if code is None:
+            code = codes[atoms[0]] = len(codes)
+        s, e = int(atoms[1]) + 1, int(atoms[2])
+        assert s <= e, "start={0} end={1}".format(s, e)
+        seqid.append(code)
+        start.append(s)
+        end.append(e)
+        tail_beg.append(len(tail))
+        tail.extend(rest.encode())
+        tail_end.append(len(tail))
+
+    names = [None] * len(codes)
+    for name, code in codes.items():
+        names[code] = name
+    return names, np.frombuffer(seqid, dtype="int32"), \
+           np.frombuffer(start, dtype="int64"), \
+           np.frombuffer(end, dtype="int64"), bytes(tail), \
+           np.frombuffer(tail_beg, dtype="int64"), \
+           np.frombuffer(tail_end, dtype="int64")
+
+class BedArray(BaseFile):
+    """
+    Columnar alternative to `Bed` for very large files. No BedLine is created
+    while parsing: seqid is stored as integer codes into `seqid_names`,
+    start/end as int arrays (start is 1-based, same as BedLine), and columns
+    4+ are kept as raw text, decoded into accn/score/strand/extra only when
+    first accessed.
+    """
+    def __init__(self, filename=None, sorted=True, include=None, cpus=1,
+                       cache=False):
+        super(BedArray, self).__init__(filename)
+
+        self.seqid_names = []
+        self.seqid = np.zeros(0, dtype="int32")
+        self.start = np.zeros(0, dtype="int64")
+        self.end = np.zeros(0, dtype="int64")
+        self._tail = b""
+        self._tail_beg = np.zeros(0, dtype="int64")
+        self._tail_end = np.zeros(0, dtype="int64")
+        self._cols = {}
+        self._index = None
+        self.sorted = False
+
+        if not filename:
+            return
+
+        # the cache holds the whole file, so `include` bypasses it
+        cache = ColumnCache(filename, "bed") if cache and not include else None
+        if cache and self._load_cache(cache, sorted):
+            if sorted:
+                self.sort()
+            return
+
+        if cpus > 1:
+            parser = partial(_parse_bed_columns, include=include)
+            chunks = parse_sharded(filename, parser, cpus=cpus)
+        else:
+            chunks = [_parse_bed_columns(must_open(filename), include=include)]
+
+        # renumber the seqid codes of each chunk into one table
+        codes = {}
+        seqids, tail_begs, tail_ends, offset = [], [], [], 0
+        for names, seqid, start, end, tail, tail_beg, tail_end in chunks:
+            lookup = np.array([codes.setdefault(x, len(codes)) for x in names],
+                              dtype="int32")
+            seqids.append(lookup[seqid] if len(seqid) else seqid)
+            tail_begs.append(tail_beg + offset)
+            tail_ends.append(tail_end + offset)
+            offset += len(tail)
+
+        self.seqid_names = [None] * len(codes)
+        for name, code in codes.items():
+            self.seqid_names[code] = name
+        self.seqid = np.concatenate(seqids)
+        self.start = np.concatenate([x[2] for x in chunks])
+        self.end = np.concatenate([x[3] for x in chunks])
+        self._tail = b"".join(x[4] for x in chunks)
+        self._tail_beg = np.concatenate(tail_begs)
+        self._tail_end = np.concatenate(tail_ends)
+        logging.debug("Load {0} features from `{1}`.".format(len(self), filename))
+
+        # the cache keeps the rows sorted, so that sorted loads map it as
+        # is, with the file row of each to get back the file order
+        row = np.arange(len(self))
+        if sorted and len(self):
+            row = self._sort_index()
+            self.__dict__.update(self._take(row).__dict__)
+            self.sorted = True
+
+        if cache:
+            names, ends = pack_strings(self.seqid_names)
+            cache.save(dict(names=names, name_ends=ends, seqid=self.seqid,
+                            start=self.start, end=self.end,
+                            tail=np.frombuffer(self._tail, dtype="uint8"),
+                            tail_beg=self._tail_beg, tail_end=self._tail_end,
+                            row=row), sorted=self.sorted)
+
+    def _load_cache(self, cache, sorted=True):
+        loaded = cache.load()
+        if not loaded or "row" not in loaded[0]:
+            return False
+        cols, meta = loaded
+        self.seqid_names = unpack_strings(cols["names"], cols["name_ends"])
+        self.seqid = cols["seqid"]
+        self.start = cols["start"]
+        self.end = cols["end"]
+        self._tail = cols["tail"]
+        self._tail_beg = cols["tail_beg"]
+        self._tail_end = cols["tail_end"]
+        self.sorted = bool(meta.get("sorted"))
+        if self.sorted and not sorted:
+            self.__dict__.update(self._take(np.argsort(cols["row"])).__dict__)
+            self.sorted = False
+        logging.debug("Load {0} features from `{1}`.".\
+                        format(len(self), self.filename))
+        return True
+
+    @classmethod
+    def from_arrays(cls, names, seqid, start, end, tails=None):
+        """
+        Build a BedArray from columns, `start` is 1-based. `tails` is an
+        optional list of the tab-joined columns after end.
+        """
+        b = cls()
+        b.seqid_names = list(names)
+        b.seqid = np.asarray(seqid, dtype="int32")
+        b.start = np.asarray(start, dtype="int64")
+        b.end = np.asarray(end, dtype="int64")
+        n = len(b.start)
+        if tails is None:
+            b._tail_beg = b._tail_end = np.zeros(n, dtype="int64")
+        else:
+            enc = [x.encode() for x in tails]
+            lens = np.fromiter((len(x) for x in enc), dtype="int64", count=n)
+            b._tail = b"".join(enc)
+            b._tail_end = np.cumsum(lens)
+            b._tail_beg = b._tail_end - lens
+        return b
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, i):
+        return BedLine(self._row(i))
+
+    def __iter__(self):
+        # materializes one BedLine per row, only use on small subsets
+        for i in range(len(self)):
+            yield self[i]
+
+    def _row(self, i):
+        row = "{0}\t{1}\t{2}".format(self.seqid_names[self.seqid[i]],
+                                     self.start[i] - 1, self.end[i])
+        tail = bytes(self._tail[self._tail_beg[i]:self._tail_end[i]])
+        if tail:
+            row += "\t" + tail.decode()
+        return row
+
+    def _take(self, idx):
+        # new BedArray sharing the tail buffer and seqid categories
+        b = BedArray()
+        b.filename = self.filename
+        b.seqid_names = self.seqid_names
+        b.seqid = self.seqid[idx]
+        b.start = self.start[idx]
+        b.end = self.end[idx]
+        b._tail = self._tail
+        b._tail_beg = self._tail_beg[idx]
+        b._tail_end = self._tail_end[idx]
+        b._cols = dict((k, v[idx]) for k, v in self._cols.items())
+        return b
+
+    def _column(self, i):
+        # decode the i-th column after end (0=accn, 1=score, 2=strand, 3=extra)
+        tail = self._tail
+        col = np.empty(len(self), dtype=object)
+        for j, (b, e) in enumerate(zip(self._tail_beg, self._tail_end)):
+            atoms = bytes(tail[b:e]).decode().split("\t", 3) if e > b else []
+            if i < 3:
+                col[j] = atoms[i] if len(atoms) > i else None
+            else:
+                col[j] = atoms[3].split("\t") if len(atoms) > 3 else None
+        return col
+
+    def _lazy(self, name, i):
+        if name not in self._cols:
+            self._cols[name] = self._column(i)
+        return self._cols[name]
+
+    @property
+    def accn(self):
+        return self._lazy("accn", 0)
+
+    @property
+    def strand(self):
+        return self._lazy("strand", 2)
+
+    @property
+    def extra(self):
+        return self._lazy("extra", 3)
+
+    @property
+    def score(self):
+        if "score" not in self._cols:
+            col = self._lazy("rawscore", 1)
+            self._cols["score"] = np.array([float(x) if x is not None and \
+                    is_number(x) else np.nan for x in col], dtype="float64")
+        return self._cols["score"]
+
+    @property
+    def span(self):
+        return self.end - self.start + 1
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = IntervalIndex(self.seqid, self.seqid_names,
+                                        self.start, self.end)
+        return self._index
+
+    @property
+    def seqid_ranks(self):
+        # natural sort rank of each seqid category, from the shared table
+        ranks = seqid_ranks.update(self.seqid_names)
+        return np.array([ranks[x] for x in self.seqid_names], dtype="int32")
+
+    def _sort_index(self):
+        ranks = self.seqid_ranks
+        return np.lexsort((self.end, self.start, ranks[self.seqid]))
+
+    def sort(self):
+        if self.sorted or not len(self):
+            return
+        self.__dict__.update(self._take(self._sort_index()).__dict__)
+        self.sorted = True
+
+    def print_to_file(self, filename="stdout", sorted=False):
+        if sorted:
+            self.sort()
+
+        fw = must_open(filename, "w")
+        self.write(fw)
+        if fw not in (sys.stdout, sys.stderr):
+            fw.close()
+
+    def write(self, fw):
+        names = self.seqid_names
+        tail = self._tail
+        for code, s, e, tb, te in zip(self.seqid, self.start, self.end,
+                                     self._tail_beg, self._tail_end):
+            if s < 1:
+                logging.error("Start < 1. Reset start.")
+                s = 1
+            row = "{0}\t{1}\t{2}".format(names[code], s - 1, e)
+            if te > tb:
+                row += "\t" + bytes(tail[tb:te]).decode()
+            fw.write(row + "\n")
+
+    def sum(self, seqid=None, unique=True):
+        bed = self.sub_bed(seqid) if seqid else self
+        if not unique:
+            return int(bed.span.sum())
+        return range_union_array(bed.seqid, bed.start, bed.end)
+
+    @property
+    def seqids(self):
+        present = set(np.unique(self.seqid))
+        return natsorted(self.seqid_names[x] for x in present)
+
+    @property
+    def accns(self):
+        return natsorted(set(self.accn))
+
+    @property
+    def order(self):
+        return dict((a, (i, self[i])) for (i, a) in enumerate(self.accn))
+
+    def extract(self, seqid, start, end):
+        # get all features within certain range
+        for i in self.index.contain(seqid, start, end):
+            yield self[i]
+
+    def overlap(self, seqid, start, end):
+        # get all features overlapping certain range, as a BedArray view
+        return self._take(self.index.overlap(seqid, start, end))
+
+    def sub_bed(self, seqid):
+        # get all the features on one chromosome, as a BedArray view
+        return self._take(self.index.rows(seqid))
+
+    def sub_beds(self):
+        # get the features on all chromosomes, one BedArray per seqid
+        self.sort()
+        if not len(self):
+            return
+        breaks = np.flatnonzero(np.diff(self.seqid)) + 1
+        bounds = [0] + breaks.tolist() + [len(self)]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            sb = self._take(slice(a, b))
+            sb.sorted = True
+            yield self.seqid_names[self.seqid[a]], sb
+
 class BedpeLine(object):
     def __init__(self, sline):
         args = sline.strip().split("\t")
@@ -548,7 +998,7 @@ def density(args):
         sys.exit(not p.print_help())
 
     bedfile, fastafile = args
-    bed = Bed(bedfile)
+    bed = BedArray(bedfile)
     sizes = Sizes(fastafile).mapping
     header = "seqid features size density_per_Mb".split()
     print("\t".join(header))
@@ -799,7 +1249,7 @@ def juncs(args):
         infile = grouptbed.fn
         sh(cmd, infile=infile, outfile=args.outfile)
     else:
-        sort([trimbed, "-o", args.outfile])
+        sortBed(trimbed, outfile=args.outfile)
 
     os.unlink(trimbed)
 
@@ -872,7 +1322,7 @@ def filter(args):
 def make_bedgraph(bedfile, fastafile):
     sizesfile = Sizes(fastafile).filename
     pf = bedfile.rsplit(".", 1)[0]
-    bedfile = sort([bedfile])
+    bedfile = sortBed(bedfile)
     bedgraph = pf + ".bedgraph"
     if need_update(bedfile, bedgraph):
         cmd = "genomeCoverageBed"
@@ -1019,11 +1469,11 @@ def merge(args):
     bedfiles = args
     fw = must_open(args.outfile, "w")
     for bedfile in bedfiles:
-        bed = Bed(bedfile)
+        bed = BedArray(bedfile)
         pf = op.basename(bedfile).split(".")[0]
-        for b in bed:
-            b.seqid = "_".join((pf, b.seqid))
-            print >> fw, b
+        # renaming the seqid categories relabels every row at once
+        bed.seqid_names = ["_".join((pf, x)) for x in bed.seqid_names]
+        bed.write(fw)
 
 def fix(args):
     """
@@ -1124,33 +1574,25 @@ def uniq(args):
     """
     from jcvi.formats.sizes import Sizes
 
-    p = OptionParser(uniq.__doc__)
-    sp1.add_argument("--sizes", help="Use sequence length as score")
-    sp1.add_argument("--mode", default="span", choices=("span", "score"),
-                 help="Pile mode")
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
-
-    bedfile, = args
+    bedfile = args.i
     uniqbedfile = bedfile.split(".")[0] + ".uniq.bed"
     bed = Bed(bedfile)
 
+    codes = {}
+    seqids = [codes.setdefault(x.seqid, len(codes)) for x in bed]
+    starts = [x.start for x in bed]
+    ends = [x.end for x in bed]
     if args.sizes:
         sizes = Sizes(args.sizes).mapping
-        ranges = [Range(x.seqid, x.start, x.end, sizes[x.accn], i) \
-                    for i, x in enumerate(bed)]
+        scores = [sizes[x.accn] for x in bed]
+    elif args.mode == "span":
+        scores = [x.end - x.start + 1 for x in bed]
     else:
-        if args.mode == "span":
-            ranges = [Range(x.seqid, x.start, x.end, x.end - x.start + 1, i) \
-                        for i, x in enumerate(bed)]
-        else:
-            ranges = [Range(x.seqid, x.start, x.end, float(x.score), i) \
-                        for i, x in enumerate(bed)]
+        scores = [float(x.score) for x in bed]
 
-    selected, score = range_chain(ranges)
-    selected = [x.id for x in selected]
+    selected, score = range_chain_array(seqids, starts, ends, scores,
+                                        cpus=args.cpus)
+    selected = selected.tolist()
     selected_ids = set(selected)
     selected = [bed[x] for x in selected]
     notselected = [x for i, x in enumerate(bed) if i not in selected_ids]
@@ -1169,129 +1611,100 @@ def uniq(args):
 
     return uniqbedfile
 
-def subtractbins(binfile1, binfile2):
-    from jcvi.graphics.landscape import BinFile
-
-    abin = BinFile(binfile1)
-    bbin = BinFile(binfile2)
-
-    assert len(abin) == len(bbin)
-
-    fw = open(binfile1, "w")
-
-    for a, b in zip(abin, bbin):
-        assert a.chr == b.chr
-        assert a.binlen == b.binlen
-
-        a.subtract(b)
-        print >> fw, a
-
-    fw.close()
-
-    return binfile1
+def bin_values(start, end, chr_len, binsize, mode="span", score=None):
+    """
+    Accumulate features on one sequence into consecutive windows of
+    `binsize`, base p (1-based) falling into window (p - 1) // binsize.
+
+    - span: bases covered in each window
+    - count: number of features touching each window
+    - score: sum of `score` of the features touching each window
+
+    All modes are a single vectorized pass, no per-feature loop.
+    """
+    nbins = max(1, -(-chr_len // binsize))
+    start = np.asarray(start, dtype="int64")
+    end = np.asarray(end, dtype="int64")
+    if not len(start):
+        return np.zeros(nbins, dtype="float64" if mode == "score" else "int64")
+    if mode == "span":
+        # bases covered before x is piecewise linear in x, with slope +1
+        # after each start and -1 after each end; evaluate it at the window
+        # boundaries from cumulative sums over the sorted breakpoints
+        pos = np.concatenate((start - 1, end))
+        sign = np.concatenate((np.ones(len(start), dtype="int64"),
+                               -np.ones(len(end), dtype="int64")))
+        order = np.argsort(pos, kind="stable")
+        pos, sign = pos[order], sign[order]
+        slope = np.cumsum(sign)
+        offset = np.cumsum(sign * pos)
+        bounds = np.minimum(np.arange(nbins + 1, dtype="int64") * binsize, chr_len)
+        k = np.searchsorted(pos, bounds, side="right")
+        covered = np.where(k > 0, bounds * slope[k - 1] - offset[k - 1], 0)
+        return np.diff(covered)
+
+    startbin = np.clip((start - 1) // binsize, 0, nbins - 1)
+    endbin = np.clip((end - 1) // binsize, 0, nbins - 1)
+    weights = np.nan_to_num(score) if mode == "score" else None
+    # difference array over windows, +w at the first window, -w past the last
+    diff = np.bincount(startbin, weights=weights, minlength=nbins + 1) - \
+           np.bincount(endbin + 1, weights=weights, minlength=nbins + 1)
+    return np.cumsum(diff)[:nbins]
 
 def bins(args):
     """
     %prog bins bedfile fastafile
 
     Bin bed lengths into each consecutive window. Use --subtract to remove bases
-    from window, e.g. --subtract gaps.bed ignores the gap sequences.
+    from window, e.g. --subtract gaps.bed ignores the gap sequences. Multiple
+    window sizes can be given at once, e.g. --binsize 10000,100000,1000000,
+    and are all computed from a single read of the input.
     """
     from maize.formats.sizes import Sizes
 
-    p = OptionParser(bins.__doc__)
-    sp1.add_argument("--binsize", default=100000, type="int",
-                 help="Size of the bins [default: %default]")
-    sp1.add_argument("--subtract",
-                 help="Subtract bases from window [default: %default]")
-    sp1.add_argument("--mode", default="span", choices=("span", "count", "score"),
-                 help="Accumulate feature based on [default: %default]")
-    sp1.add_argument("--nomerge", default=False, action="store_true",
-                 help="Do not merge features")
-    opts, args = p.parse_args(args)
-
-    if len(args) != 2:
-        sys.exit(not p.print_help())
-
-    bedfile, fastafile = args
+    bedfile, fastafile = args.bed, args.fasta
     subtract = args.subtract
     mode = args.mode
     assert op.exists(bedfile), "File `{0}` not found".format(bedfile)
 
-    binsize = args.binsize
-    binfile = bedfile + ".{0}".format(binsize)
-    binfile += ".{0}.bins".format(mode)
-
-    if not need_update(bedfile, binfile):
-        return binfile
+    binsizes = [int(x) for x in str(args.binsize).split(",")]
+    binfiles = [bedfile + ".{0}.{1}.bins".format(x, mode) for x in binsizes]
+    todo = [(x, f) for x, f in zip(binsizes, binfiles) if need_update(bedfile, f)]
+    if not todo:
+        return binfiles[0] if len(binfiles) == 1 else binfiles
 
     sz = Sizes(fastafile)
-    sizesfile = sz.filename
     sizes = sz.mapping
-    fw = open(binfile, "w")
     scores = "median" if mode == "score" else None
+    bed = BedArray(bedfile, sorted=False)
     if not args.nomerge:
-        bedfile = mergeBed(bedfile, nms=True, scores=scores)
+        bed = merge_bed(bed, nms=True, scores=scores)
+    subdict = {}
     if subtract:
-        subtractmerge = mergeBed(subtract)
-        subtract_complement = complementBed(subtractmerge, sizesfile)
-        bedfile = intersectBed(bedfile, subtract_complement)
+        subtractmerge = merge_bed(BedArray(subtract, sorted=False))
+        bed = intersect_bed(bed, complement_bed(subtractmerge, sz))
+        subdict = dict(subtractmerge.sub_beds())
 
-    bedfile = sort([bedfile, "-i"])
-
-    bed = Bed(bedfile)
     sbdict = dict(bed.sub_beds())
+    fws = [open(f, "w") for x, f in todo]
     for chr, chr_len in sorted(sizes.items()):
-        chr_len = sizes[chr]
-        subbeds = sbdict.get(chr, [])
-        nbins = chr_len / binsize
-        last_bin = chr_len % binsize
-        if last_bin:
-            nbins += 1
-
-        a = np.zeros(nbins)  # values
-        b = np.zeros(nbins, dtype="int")  # bases
-        c = np.zeros(nbins, dtype="int")  # count
-        b[:-1] = binsize
-        b[-1] = last_bin
-
-        for bb in subbeds:
-
-            start, end = bb.start, bb.end
-            startbin = start / binsize
-            endbin = end / binsize
-
-            assert startbin <= endbin
-            c[startbin:endbin + 1] += 1
-
-            if mode == "score":
-                a[startbin:endbin + 1] += float(bb.score)
-
-            elif mode == "span":
-                if startbin == endbin:
-                    a[startbin] += end - start + 1
-
-                if startbin < endbin:
-                    firstsize = (startbin + 1) * binsize - start + 1
-                    lastsize = end - endbin * binsize
-                    a[startbin] += firstsize
-                    if startbin + 1 < endbin:
-                        a[startbin + 1:endbin] += binsize
-                    a[endbin] += lastsize
-
-        if mode == "count":
-            a = c
-
-        for xa, xb in zip(a, b):
-            print >> fw, "\t".join(str(x) for x in (chr, xa, xb))
-
-    fw.close()
-
-    if subtract:
-        subtractbinfile = bins([subtract, fastafile, "--binsize={0}".format(binsize)])
-        binfile = subtractbins(binfile, subtractbinfile)
+        subbed = sbdict.get(chr, BedArray())
+        score = subbed.score if mode == "score" else None
+        gaps = subdict.get(chr)
+        for (binsize, binfile), fw in zip(todo, fws):
+            a = bin_values(subbed.start, subbed.end, chr_len, binsize,
+                           mode=mode, score=score)
+            b = np.full(len(a), binsize, dtype="int64")  # bases
+            b[-1] = chr_len - (len(a) - 1) * binsize
+            if gaps is not None:
+                b -= bin_values(gaps.start, gaps.end, chr_len, binsize)
+            for xa, xb in zip(a.tolist(), b.tolist()):
+                fw.write("{0}\t{1}\t{2}\n".format(chr, xa, xb))
+
+    for fw in fws:
+        fw.close()
 
-    return binfile
+    return binfiles[0] if len(binfiles) == 1 else binfiles
 
 def binpacking(args):
     import binpacking
@@ -1348,10 +1761,13 @@ def pile(args):
         sys.exit(not p.print_help())
 
     abedfile, bbedfile = args
-    iw = intersectBed_wao(abedfile, bbedfile, minOverlap=args.minOverlap)
+    abed = BedArray(abedfile)
+    bbed = BedArray(bbedfile)
+    ai, bi, ov = intersect_bed_wao(abed, bbed)
+    keep = (bi >= 0) & (ov >= args.minOverlap)
     groups = Grouper()
-    for a, b in iw:
-        groups.join(a.accn, b.accn)
+    groups.join_many(np.column_stack((abed.accn[ai[keep]],
+                                      bbed.accn[bi[keep]])))
 
     ngroups = 0
     for group in groups:
@@ -1383,7 +1799,7 @@ def index(args):
     if fastafile:
         bedfile = make_bedgraph(bedfile, fastafile)
 
-    bedfile = sort([bedfile])
+    bedfile = sortBed(bedfile)
 
     gzfile = bedfile + ".gz"
     if need_update(bedfile, gzfile):
@@ -1419,57 +1835,188 @@ def fastaFromBed(bedfile, fastafile, name=False, tab=False, stranded=False):
 
     return outfile
 
-def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=";"):
-    if not sorted:
-        bedfile = sort([bedfile, "-i"])
-    cmd = "mergeBed -i {0}".format(bedfile)
-    if d:
-        cmd += " -d {0}".format(d)
+def _fmt_score(x):
+    return str(int(x)) if float(x).is_integer() else str(x)
+
+def merge_bed(bed, d=0, s=False, nms=False, scores=None, delim=";"):
+    """
+    In-memory equivalent of `mergeBed`, taking and returning a BedArray.
+    Overlapping or book-ended features (or closer than `d` bp) are merged;
+    with `s` only features on the same strand. `nms` collapses the names and
+    `scores` aggregates the score column (sum, min, max, mean, median, mode,
+    antimode or collapse).
+    """
+    if not len(bed):
+        return BedArray()
+
+    group = bed.seqid_ranks[bed.seqid].astype("int64") * 2
+    if s:
+        group += (bed.strand == "-")
+    idx = np.lexsort((bed.end, bed.start, group))
+    group, start, end = group[idx], bed.start[idx], bed.end[idx]
+
+    # sweep with a running max of ends; groups are offset far enough apart
+    # that a run can never continue into the next seqid/strand
+    offset = int(end.max()) + d + 2
+    gstart = group * offset + start
+    runmax = np.maximum.accumulate(group * offset + end)
+    newrun = np.ones(len(idx), dtype=bool)
+    newrun[1:] = gstart[1:] > runmax[:-1] + d + 1
+    firsts = np.flatnonzero(newrun)
+    mstart = start[firsts]
+    mend = np.maximum.reduceat(end, firsts)
+
+    cols = []
     if nms:
-        nargs = len(open(bedfile).readline().split())
-        if nargs <= 3:
-            logging.debug("Only {0} columns detected... set nms=True"\
-                            .format(nargs))
+        accns = [x for x in bed.accn[idx]]
+        if all(x is None for x in accns):
+            logging.debug("No name column detected... set nms=False")
         else:
-            cmd += " -c 4 -o collapse"
-    if s:
-        cmd += " -s"
+            cols.append([(delim or ",").join(x for x in chunk if x is not None) \
+                         for chunk in np.split(np.array(accns, dtype=object),
+                                               firsts[1:])])
     if scores:
         valid_opts = ("sum", "min", "max", "mean", "median",
                 "mode", "antimode", "collapse")
         if not scores in valid_opts:
             scores = "mean"
-        cmd += " -scores {0}".format(scores)
-
-    if delim:
-        cmd += ' -delim "{0}"'.format(delim)
+        sc = bed.score[idx]
+        if scores == "sum":
+            agg = np.add.reduceat(sc, firsts)
+        elif scores == "min":
+            agg = np.minimum.reduceat(sc, firsts)
+        elif scores == "max":
+            agg = np.maximum.reduceat(sc, firsts)
+        elif scores == "mean":
+            agg = np.add.reduceat(sc, firsts) / np.diff(np.append(firsts, len(sc)))
+        else:
+            from collections import Counter
+            chunks = np.split(sc, firsts[1:])
+            if scores == "median":
+                agg = [np.median(x) for x in chunks]
+            elif scores == "collapse":
+                agg = None
+                cols.append([(delim or ",").join(_fmt_score(y) for y in x) \
+                             for x in chunks])
+            else:
+                pick = (lambda c: c.most_common()[0][0]) if scores == "mode" \
+                        else (lambda c: c.most_common()[-1][0])
+                agg = [pick(Counter(x.tolist())) for x in chunks]
+        if agg is not None:
+            cols.append([_fmt_score(x) for x in agg])
+    if s:
+        cols.append(["-" if x % 2 else "+" for x in group[firsts]])
+
+    tails = ["\t".join(x) for x in zip(*cols)] if cols else None
+    return BedArray.from_arrays(bed.seqid_names, bed.seqid[idx][firsts],
+                                mstart, mend, tails)
+
+def complement_bed(bed, sizes):
+    """
+    In-memory equivalent of `complementBed`, returns the regions of each
+    sequence in `sizes` (a Sizes object) not covered by `bed`.
+    """
+    merged = merge_bed(bed)
+    seqid, start, end = [], [], []
+    for code, (ctg, size) in enumerate(zip(sizes.ctgs, sizes.sizes)):
+        rows = merged.index.rows(ctg)
+        gstart = np.append(1, merged.end[rows] + 1)
+        gend = np.append(merged.start[rows] - 1, size)
+        gend = np.minimum(gend, size)
+        keep = gstart <= gend
+        start.append(gstart[keep])
+        end.append(gend[keep])
+        seqid.append(np.full(keep.sum(), code, dtype="int32"))
+
+    if not seqid:
+        return BedArray()
+    return BedArray.from_arrays(sizes.ctgs, np.concatenate(seqid),
+                                np.concatenate(start), np.concatenate(end))
+
+def _overlap_pairs(abed, bbed):
+    """
+    All pairs of overlapping features between two BedArrays, returned as
+    arrays of row indices (ai, bi), ordered by ai.
+    """
+    bindex = bbed.index.index
+    ai, bi = [], []
+    for seqid in set(abed.seqid_names) & set(bindex):
+        arows = abed.index.rows(seqid)
+        if not len(arows):
+            continue
+        rows, ss, se, maxend = bindex[seqid]
+        astart, aend = abed.start[arows], abed.end[arows]
+        lo = np.searchsorted(maxend, astart, side="left")
+        hi = np.searchsorted(ss, aend, side="right")
+        n = np.maximum(hi - lo, 0)
+        # expand each A row into its candidate slice of B in one shot
+        offs = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + \
+               np.repeat(lo, n)
+        keep = se[offs] >= np.repeat(astart, n)
+        ai.append(np.repeat(arows, n)[keep])
+        bi.append(rows[offs][keep])
+
+    if not ai:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+    ai, bi = np.concatenate(ai), np.concatenate(bi)
+    order = np.lexsort((bbed.start[bi], ai))
+    return ai[order], bi[order]
+
+def intersect_bed(abed, bbed):
+    """
+    In-memory equivalent of `intersectBed -a -b`, each overlap is reported
+    as the A feature trimmed to the overlapping part.
+    """
+    ai, bi = _overlap_pairs(abed, bbed)
+    res = abed._take(ai)
+    res.start = np.maximum(abed.start[ai], bbed.start[bi])
+    res.end = np.minimum(abed.end[ai], bbed.end[bi])
+    return res
+
+def intersect_bed_wao(abed, bbed):
+    """
+    In-memory equivalent of `intersectBed -wao`. Returns arrays (ai, bi, ov):
+    every A row appears at least once, with bi=-1 and ov=0 if it overlaps
+    nothing in B.
+    """
+    ai, bi = _overlap_pairs(abed, bbed)
+    ov = np.minimum(abed.end[ai], bbed.end[bi]) - \
+         np.maximum(abed.start[ai], bbed.start[bi]) + 1
+    lonely = np.setdiff1d(np.arange(len(abed)), ai)
+    ai = np.concatenate((ai, lonely))
+    bi = np.concatenate((bi, np.full(len(lonely), -1, dtype="int64")))
+    ov = np.concatenate((ov, np.zeros(len(lonely), dtype="int64")))
+    order = np.argsort(ai, kind="stable")
+    return ai[order], bi[order], ov[order]
 
+def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=";"):
     pf = bedfile.rsplit(".", 1)[0] if bedfile.endswith(".bed") else bedfile
     mergebedfile = op.basename(pf) + ".merge.bed"
 
     if need_update(bedfile, mergebedfile):
-        sh(cmd, outfile=mergebedfile)
+        bed = BedArray(bedfile, sorted=False)
+        merged = merge_bed(bed, d=d, s=s, nms=nms, scores=scores, delim=delim)
+        merged.print_to_file(mergebedfile)
     return mergebedfile
 
 def complementBed(bedfile, sizesfile):
-    cmd = "complementBed"
-    cmd += " -i {0} -g {1}".format(bedfile, sizesfile)
     complementbedfile = "complement_" + op.basename(bedfile)
 
     if need_update([bedfile, sizesfile], complementbedfile):
-        sh(cmd, outfile=complementbedfile)
+        bed = BedArray(bedfile, sorted=False)
+        complement_bed(bed, Sizes(sizesfile)).print_to_file(complementbedfile)
     return complementbedfile
 
 def intersectBed(bedfile1, bedfile2):
-    cmd = "intersectBed"
-    cmd += " -a {0} -b {1}".format(bedfile1, bedfile2)
     suffix = ".intersect.bed"
 
     intersectbedfile = ".".join((op.basename(bedfile1).split(".")[0],
             op.basename(bedfile2).split(".")[0])) + suffix
 
     if need_update([bedfile1, bedfile2], intersectbedfile):
-        sh(cmd, outfile=intersectbedfile)
+        abed = BedArray(bedfile1, sorted=False)
+        bbed = BedArray(bedfile2, sorted=False)
+        intersect_bed(abed, bbed).print_to_file(intersectbedfile)
     return intersectbedfile
 
 def query_to_range(query, sizes):
@@ -1545,29 +2092,16 @@ def evaluate(args):
     return be
 
 def intersectBed_wao(abedfile, bbedfile, minOverlap=0):
-    abed = Bed(abedfile)
-    bbed = Bed(bbedfile)
-    print >> sys.stderr, "`{0}` has {1} features.".format(abedfile, len(abed))
-    print >> sys.stderr, "`{0}` has {1} features.".format(bbedfile, len(bbed))
-
-    cmd = "intersectBed -wao -a {0} -b {1}".format(abedfile, bbedfile)
-    acols = abed[0].nargs
-    bcols = bbed[0].nargs
-    fp = popen(cmd)
-    for row in fp:
-        atoms = row.split()
-        aline = "\t".join(atoms[:acols])
-        bline = "\t".join(atoms[acols:acols + bcols])
-        c = int(atoms[-1])
+    abed = BedArray(abedfile)
+    bbed = BedArray(bbedfile)
+    logging.debug("`{0}` has {1} features.".format(abedfile, len(abed)))
+    logging.debug("`{0}` has {1} features.".format(bbedfile, len(bbed)))
+
+    ai, bi, ov = intersect_bed_wao(abed, bbed)
+    for i, j, c in zip(ai, bi, ov):
         if c < minOverlap:
             continue
-        a = BedLine(aline)
-        try:
-            b = BedLine(bline)
-        except AssertionError:
-            b = None
-
-        yield a, b
+        yield abed[i], (bbed[j] if j >= 0 else None)
 
 def refine(args):
     """
@@ -1627,7 +2161,7 @@ def distance(args):
         sys.exit(not p.print_help())
 
     bedfile, = args
-    sortedbedfile = sort([bedfile])
+    sortedbedfile = sortBed(bedfile)
     valid = total = 0
     fp = open(sortedbedfile)
     for a, b in pairwise(fp):
@@ -1944,7 +2478,7 @@ def pairs(args):
 
     basename = bedfile.split(".")[0]
     insertsfile = ".".join((basename, "inserts"))
-    bedfile = sort([bedfile, "--accn"])
+    bedfile = sortBed(bedfile, accn=True)
 
     fp = open(bedfile)
     data = [BedLine(row) for i, row in enumerate(fp) if i < args.nrows]
@@ -1991,56 +2525,158 @@ def summary(args):
         bs = BedSummary(subbeds)
         print("\t".join((seqid, str(bs))))
 
-def sort(args):
-    """
-    %prog sort bedfile
-
-    Sort bed file to have ascending order of seqid, then start. It uses the
-    `sort` command.
-    """
-    p = OptionParser(sort.__doc__)
-    sp1.add_argument("-i", "--inplace", dest="inplace",
-            default=False, action="store_true",
-            help="Sort bed file in place [default: %default]")
-    sp1.add_argument("-u", dest="unique",
-            default=False, action="store_true",
-            help="Uniqify the bed file")
-    sp1.add_argument("--accn", default=False, action="store_true",
-            help="Sort based on the accessions [default: %default]")
-    p.set_outfile(outfile=None)
-    p.set_tmpdir()
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
+def _parse_size(size):
+    # 500000, 512K, 64M, 2G => bytes
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def bed_sort_key(accn=False):
+    """
+    Sort key for raw bed lines: natural order of seqid, then start, end and
+    name (or name first with `accn`). Seqid keys are memoized in the shared
+    `seqid_ranks` table. Natsort tuples rather than ranks are used since
+    heapq.merge computes keys while new seqids keep showing up.
+    """
+    seqid_key = seqid_ranks.key
+    def key(line):
+        atoms = line.split("\t", 4)
+        k = seqid_key(atoms[0])
+        name = atoms[3].rstrip("\n") if len(atoms) > 3 else ""
+        if accn:
+            return (name, k, int(atoms[1]), int(atoms[2]))
+        return (k, int(atoms[1]), int(atoms[2]), name)
+    return key
+
+def _uniq_lines(lines):
+    last = None
+    for line in lines:
+        if line != last:
+            yield line
+        last = line
+
+def _sort_run(lines, runfile, accn=False, unique=False, compress=False):
+    # sort one chunk in memory and spill it to `runfile`
+    lines.sort(key=bed_sort_key(accn))
+    if unique:
+        lines = _uniq_lines(lines)
+    if compress:
+        import gzip
+        fw = gzip.open(runfile, "wt", compresslevel=1)
+    else:
+        fw = open(runfile, "w")
+    fw.writelines(lines)
+    fw.close()
+    return runfile
 
-    bedfile, = args
-    inplace = args.inplace
+def sortBed(bedfile, outfile=None, inplace=False, accn=False, unique=False,
+            tmpdir=None, buffersize="1G", compress=False, cpus=1):
+    """
+    Sort bed file by natural order of seqid, then start, end and name. The
+    input is read in chunks that together with the runs being sorted stay
+    within about `buffersize` of memory; when it does not fit, each chunk
+    is sorted (on `cpus` processes) and spilled to a run file under
+    `tmpdir` (gzip'd with `compress`), and runs are then k-way merged.
+    """
+    import heapq
+    import shutil
+    from tempfile import mkdtemp
 
     if not inplace and ".sorted." in bedfile:
         return bedfile
 
-    sortedbed = args.outfile
+    sortedbed = outfile
     if inplace:
         sortedbed = bedfile
-    elif args.outfile is None:
+    elif outfile is None:
         pf, sf = op.basename(bedfile).rsplit(".", 1)
         sortedbed = pf + ".sorted." + sf
 
-    sortopt = "-k1,1 -k2,2n -k3,3n -k4,4" if not args.accn else \
-              "-k4,4 -k1,1 -k2,2n -k3,3n"
-    cmd = "sort"
-    if args.tmpdir:
-        cmd += " -T {0}".format(args.tmpdir)
-    if args.unique:
-        cmd += " -u"
-    cmd += " {0} {1} -o {2}".format(sortopt, bedfile, sortedbed)
+    if not (inplace or need_update(bedfile, sortedbed)):
+        return sortedbed
+
+    # up to `cpus` runs are sorted while the next chunk is read
+    runsize = _parse_size(buffersize) // (cpus + 1 if cpus > 1 else 1)
+    pool = None
+    if cpus > 1:
+        from multiprocessing import Pool
+        pool = Pool(cpus)
+    workdir = None
+    headers, runs, pending = [], [], []
+    chunk, size = [], 0
+
+    def spill(chunk):
+        runfile = op.join(workdir, "run{0:05d}".format(len(runs) + len(pending)))
+        if compress:
+            runfile += ".gz"
+        opts = (chunk, runfile, accn, unique, compress)
+        if pool:
+            if len(pending) >= cpus:
+                runs.append(pending.pop(0).get())
+            pending.append(pool.apply_async(_sort_run, opts))
+        else:
+            runs.append(_sort_run(*opts))
 
-    if inplace or need_update(bedfile, sortedbed):
-        sh(cmd)
+    for line in must_open(bedfile):
+        if line[0] == "#" or line.startswith(("track", "browser")):
+            headers.append(line)
+            continue
+        if not line.strip():
+            continue
+        if line[-1] != "\n":
+            line += "\n"
+        chunk.append(line)
+        # python str, its sort key tuple and list slot of a line
+        size += len(line) + 250
+        if size >= runsize:
+            if workdir is None:
+                workdir = mkdtemp(prefix="bedsort.", dir=tmpdir)
+            spill(chunk)
+            chunk, size = [], 0
+
+    if workdir is None:
+        # everything fits in the buffer, no need to spill
+        chunk.sort(key=bed_sort_key(accn))
+        merged = chunk
+    else:
+        if chunk:
+            spill(chunk)
+        runs.extend(x.get() for x in pending)
+        logging.debug("Merge {0} sorted runs from `{1}`.".format(len(runs), workdir))
+        fps = [must_open(x) for x in runs]
+        merged = heapq.merge(*fps, key=bed_sort_key(accn))
+    if pool:
+        pool.close()
+
+    if unique:
+        merged = _uniq_lines(merged)
+    fw = must_open(sortedbed, "w")
+    fw.writelines(headers)
+    fw.writelines(merged)
+    fw.close()
+
+    if workdir is not None:
+        for fp in fps:
+            fp.close()
+        shutil.rmtree(workdir)
 
     return sortedbed
 
+def sort(args):
+    """
+    %prog sort bedfile
+
+    Sort bed file to have ascending order of seqid (natural order), then
+    start. Files larger than --buffer are sorted externally with bounded
+    memory, see `sortBed`.
+    """
+    return sortBed(args.bed, outfile=args.outfile, inplace=args.inplace,
+                   accn=args.accn, unique=args.unique, tmpdir=args.tmpdir,
+                   buffersize=args.buffer, compress=args.compress,
+                   cpus=args.cpus)
+
 def mates(args):
     """
     %prog mates bedfile
@@ -2304,7 +2940,15 @@ if __name__ == '__main__':
 
     sp1 = sp.add_parser('sort', help='sort bed file',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('bed', help = 'input *.bed file')
+    sp1.add_argument('-i', '--inplace', action = 'store_true', help = 'sort bed file in place')
+    sp1.add_argument('-u', dest = 'unique', action = 'store_true', help = 'uniqify the bed file')
+    sp1.add_argument('--accn', action = 'store_true', help = 'sort based on the accessions')
+    sp1.add_argument('--outfile', '-o', help = 'output file')
+    sp1.add_argument('--tmpdir', help = 'directory for temporary sorted runs')
+    sp1.add_argument('--buffer', default = '1G', help = 'memory budget for the sorted runs in flight (as sort -S)')
+    sp1.add_argument('--compress', action = 'store_true', help = 'gzip the temporary sorted runs')
+    sp1.add_argument('--cpus', type = int, default = 1, help = 'sort runs on this many processes')
     sp1.set_defaults(func = sort)
 
     sp1 = sp.add_parser('merge', help='merge bed files',
@@ -2319,7 +2963,14 @@ if __name__ == '__main__':
 
     sp1 = sp.add_parser('bins', help='bin bed lengths into each window',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('bed', help = 'input *.bed file')
+    sp1.add_argument('fasta', help = 'genome fasta or *.sizes file')
+    sp1.add_argument('--binsize', default = '100000',
+            help = 'size of the bins, use comma to give multiple sizes')
+    sp1.add_argument('--subtract', help = 'subtract bases from window')
+    sp1.add_argument('--mode', default = 'span', choices = ('span', 'count', 'score'),
+            help = 'accumulate feature based on')
+    sp1.add_argument('--nomerge', action = 'store_true', help = 'do not merge features')
     sp1.set_defaults(func = bins)
 
     sp1 = sp.add_parser('summary', help='summarize the lengths of the intervals',
@@ -2364,6 +3015,11 @@ if __name__ == '__main__':
     sp1 = sp.add_parser('uniq', help='remove overlapping features with higher scores',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     sp1.add_argument('i', help = '')
+    sp1.add_argument('--sizes', help = 'use sequence length as score')
+    sp1.add_argument('--mode', default = 'span', choices = ('span', 'score'),
+            help = 'pile mode')
+    sp1.add_argument('--cpus', type = int, default = 1,
+            help = 'chain seqids on this many processes')
     sp1.set_defaults(func = uniq)
     
     sp1 = sp.add_parser('longest', help='select longest feature within overlapping piles',
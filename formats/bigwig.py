@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+bigWig writer, in the BBI layout of UCSC `bedGraphToBigWig`
+<https://genome.ucsc.edu/goldenPath/help/bigWig.html>.
+
+Data go in as bedGraph runs, one contig chunk at a time, and are written
+as zlib-compressed sections of `items_per_slot` records as they come. Zoom
+levels are summarised chunk by chunk into temporary files, so memory stays
+bounded by a chunk; the R-tree indexes, zoom levels and header are put in
+place on `close`.
+"""
+
+import os
+import struct
+import zlib
+import logging
+
+import numpy as np
+
+BIGWIG_MAGIC = 0x888FFC26
+BPT_MAGIC = 0x78CA8C91
+CIRTREE_MAGIC = 0x2468ACE0
+BIGWIG_VERSION = 4
+MAX_ZOOM_LEVELS = 10
+HEADER = struct.Struct("<IHHQQQHHQQIQ")
+ZOOM_HEADER = struct.Struct("<IIQQ")
+SUMMARY = struct.Struct("<Qdddd")
+SECTION_HEADER = struct.Struct("<IIIIIBBH")
+BEDGRAPH_ITEM = np.dtype([("start", "<u4"), ("end", "<u4"), ("value", "<f4")])
+ZOOM_ITEM = np.dtype([("chrom", "<u4"), ("start", "<u4"), ("end", "<u4"),
+                      ("count", "<u4"), ("min", "<f4"), ("max", "<f4"),
+                      ("sum", "<f4"), ("sumsq", "<f4")])
+
+
+def zoom_summaries(chrom, starts, ends, values, reduction):
+    """
+    Zoom records of runs over bins of `reduction` bases, each bin clipped
+    to the span of the runs: bases covered, min, max, sum and sum of
+    squares of the values.
+
+    >>> z = zoom_summaries(0, np.array([0, 5]), np.array([5, 12]),
+    ...                    np.array([1., 2.]), 10)
+    >>> z["start"].tolist(), z["end"].tolist(), z["count"].tolist()
+    ([0, 10], [10, 12], [10, 2])
+    >>> z["sum"].tolist(), z["min"].tolist()
+    ([15.0, 4.0], [1.0, 2.0])
+    """
+    first = starts // reduction
+    nbins = (ends - 1) // reduction - first + 1
+    # runs cut at bin boundaries
+    run = np.repeat(np.arange(len(starts)), nbins)
+    bins = first[run] + np.arange(len(run)) - np.repeat(np.cumsum(nbins) - nbins,
+                                                        nbins)
+    size = np.minimum(ends[run], (bins + 1) * reduction) - \
+            np.maximum(starts[run], bins * reduction)
+    vals = values[run]
+
+    newbin = np.r_[True, bins[1:] != bins[:-1]]
+    idx = np.flatnonzero(newbin)
+    last = np.r_[idx[1:], len(bins)] - 1
+    z = np.zeros(len(idx), dtype=ZOOM_ITEM)
+    z["chrom"] = chrom
+    z["start"] = np.maximum(bins[idx] * reduction, starts[run[idx]])
+    z["end"] = np.minimum((bins[idx] + 1) * reduction, ends[run[last]])
+    z["count"] = np.add.reduceat(size, idx)
+    z["min"] = np.minimum.reduceat(vals, idx)
+    z["max"] = np.maximum.reduceat(vals, idx)
+    z["sum"] = np.add.reduceat(vals * size, idx)
+    z["sumsq"] = np.add.reduceat(vals * vals * size, idx)
+    return z
+
+
+class SectionWriter (object):
+    """
+    Compressed data sections written to a file handle, keeping the R-tree
+    index entries (chrom, start, end, offset, size) of each.
+    """
+    def __init__(self, fw, base=0):
+        self.fw = fw
+        self.base = base
+        self.index = []
+        self.maxsize = 0
+
+    def write(self, chrom, start, end, data):
+        offset = self.base + self.fw.tell()
+        self.maxsize = max(self.maxsize, len(data))
+        packed = zlib.compress(data)
+        self.fw.write(packed)
+        self.index.append((chrom, start, chrom, end, offset, len(packed)))
+
+
+class BigWigWriter (object):
+    """
+    Write bigWig from bedGraph runs. `sizes` lists (name, size) of the
+    contigs; runs have to come in their order, and by position within a
+    contig.
+
+    >> bw = BigWigWriter("a.bw", [("chr1", 1000)])
+    >> bw.add("chr1", starts, ends, values)
+    >> bw.close()
+    """
+    def __init__(self, filename, sizes, items_per_slot=1024, block_size=256,
+                 zoom_levels=MAX_ZOOM_LEVELS):
+        self.filename = filename
+        self.names = [x for x, y in sizes]
+        self.sizes = [y for x, y in sizes]
+        self.ids = dict((x, i) for i, x in enumerate(self.names))
+        self.items_per_slot = items_per_slot
+        self.block_size = block_size
+        self.zoom_levels = zoom_levels
+        self.reductions = None
+        self.zooms = []
+        self.last = (-1, 0)
+        self.summary = [0, np.inf, -np.inf, 0., 0.]
+
+        self.fw = open(filename, "wb")
+        # header, zoom headers and total summary are filled in on `close`
+        self.fw.write(b"\0" * (HEADER.size + ZOOM_HEADER.size * zoom_levels +
+                               SUMMARY.size))
+        self.chrom_tree_offset = self.fw.tell()
+        self._write_chrom_tree()
+        self.data_offset = self.fw.tell()
+        self.fw.write(struct.pack("<Q", 0))
+        self.data = SectionWriter(self.fw)
+
+    def _write_chrom_tree(self):
+        """
+        B+ tree of the contig names, as one leaf; ids are in input order
+        and keys sorted.
+        """
+        keysize = max([len(x.encode()) for x in self.names] + [1])
+        n = len(self.names)
+        fw = self.fw
+        fw.write(struct.pack("<IIIIQQ", BPT_MAGIC, max(n, 1), keysize, 8, n, 0))
+        fw.write(struct.pack("<BBH", 1, 0, n))
+        for name in sorted(self.names, key=lambda x: x.encode()):
+            fw.write(name.encode().ljust(keysize, b"\0"))
+            fw.write(struct.pack("<II", self.ids[name], self.sizes[self.ids[name]]))
+
+    def _init_zooms(self, starts, ends):
+        # as `bedGraphToBigWig`: first reduction 10x the mean run span,
+        # then 4x each level while below the largest contig
+        span = max(int((ends - starts).mean()), 1)
+        reduction = 10 * span
+        largest = max(self.sizes)
+        self.reductions = []
+        while len(self.reductions) < self.zoom_levels and reduction < largest:
+            self.reductions.append(reduction)
+            reduction *= 4
+        for reduction in self.reductions:
+            tmpfile = "{0}.zoom{1}.tmp".format(self.filename, reduction)
+            self.zooms.append(SectionWriter(open(tmpfile, "w+b")))
+
+    def add(self, chrom, starts, ends, values):
+        """
+        Add runs [start, end) (0-based) of `values` on contig `chrom`.
+        """
+        if not len(starts):
+            return
+        cid = self.ids[chrom]
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        assert (cid, int(starts[0])) >= self.last, \
+                "runs not sorted at {0}:{1}".format(chrom, starts[0])
+        self.last = (cid, int(ends[-1]))
+        if self.reductions is None:
+            self._init_zooms(starts, ends)
+
+        sizes = ends - starts
+        s = self.summary
+        s[0] += int(sizes.sum())
+        s[1] = min(s[1], values.min())
+        s[2] = max(s[2], values.max())
+        s[3] += float((values * sizes).sum())
+        s[4] += float((values * values * sizes).sum())
+
+        items = np.zeros(len(starts), dtype=BEDGRAPH_ITEM)
+        items["start"], items["end"], items["value"] = starts, ends, values
+        k = self.items_per_slot
+        for i in range(0, len(items), k):
+            block = items[i:i + k]
+            start, end = int(block["start"][0]), int(block["end"][-1])
+            header = SECTION_HEADER.pack(cid, start, end, 0, 0, 1, 0, len(block))
+            self.data.write(cid, start, end, header + block.tobytes())
+
+        for reduction, zoom in zip(self.reductions, self.zooms):
+            z = zoom_summaries(cid, starts, ends, values, reduction)
+            for i in range(0, len(z), k):
+                block = z[i:i + k]
+                zoom.write(cid, int(block["start"][0]), int(block["end"][-1]),
+                           block.tobytes())
+
+    def _write_index(self, index):
+        """
+        R-tree over the sections, written top level first; returns its
+        offset.
+        """
+        fw = self.fw
+        offset = fw.tell()
+        bs = self.block_size
+        end = offset
+        if index:
+            first, last = index[0], index[-1]
+            fw.write(struct.pack("<IIQIIIIQII", CIRTREE_MAGIC, bs, len(index),
+                                 first[0], first[1], last[2], last[3], end, 1, 0))
+        else:
+            fw.write(struct.pack("<IIQIIIIQII", CIRTREE_MAGIC, bs, 0,
+                                 0, 0, 0, 0, end, 1, 0))
+            fw.write(struct.pack("<BBH", 1, 0, 0))
+            return offset
+
+        # levels from the leaves up: bounds of each node over its items
+        levels = [index]
+        while len(levels[-1]) > bs:
+            items = levels[-1]
+            levels.append([(g[0][0], g[0][1], g[-1][2], g[-1][3])
+                           for g in (items[i:i + bs]
+                                     for i in range(0, len(items), bs))])
+        levels.reverse()
+
+        pos = fw.tell()
+        nodepos = []
+        for depth, items in enumerate(levels):
+            leaf = depth == len(levels) - 1
+            nnodes = -(-len(items) // bs)
+            nodepos.append(pos)
+            pos += nnodes * 4 + len(items) * (32 if leaf else 24)
+        for depth, items in enumerate(levels):
+            leaf = depth == len(levels) - 1
+            for i in range(0, len(items), bs):
+                group = items[i:i + bs]
+                fw.write(struct.pack("<BBH", int(leaf), 0, len(group)))
+                if leaf:
+                    for x in group:
+                        fw.write(struct.pack("<IIIIQQ", *x))
+                    continue
+                # children: nodes of the level below, in order
+                below = levels[depth + 1]
+                childleaf = depth + 1 == len(levels) - 1
+                for j, x in enumerate(group):
+                    child = i + j
+                    cpos = nodepos[depth + 1] + child * 4 + \
+                            min(child * bs, len(below)) * (32 if childleaf else 24)
+                    fw.write(struct.pack("<IIIIQ", x[0], x[1], x[2], x[3], cpos))
+        return offset
+
+    def close(self):
+        fw = self.fw
+        data_end = fw.tell()
+        fw.seek(self.data_offset)
+        fw.write(struct.pack("<Q", len(self.data.index)))
+        fw.seek(data_end)
+        index_offset = self._write_index(self.data.index)
+
+        zoom_headers = []
+        maxsize = self.data.maxsize
+        for reduction, zoom in zip(self.reductions or [], self.zooms):
+            if not zoom.index:
+                continue
+            tmp = zoom.fw
+            zoom_offset = fw.tell()
+            fw.write(struct.pack("<Q", len(zoom.index)))
+            base = fw.tell()
+            tmp.seek(0)
+            while True:
+                buf = tmp.read(1 << 24)
+                if not buf:
+                    break
+                fw.write(buf)
+            index = [x[:4] + (x[4] + base,) + x[5:] for x in zoom.index]
+            zoom_headers.append((reduction, zoom_offset, self._write_index(index)))
+            maxsize = max(maxsize, zoom.maxsize)
+            tmp.close()
+            os.remove(tmp.name)
+
+        fw.seek(0)
+        summary_offset = HEADER.size + ZOOM_HEADER.size * self.zoom_levels
+        fw.write(HEADER.pack(BIGWIG_MAGIC, BIGWIG_VERSION, len(zoom_headers),
+                             self.chrom_tree_offset, self.data_offset,
+                             index_offset, 0, 0, 0, summary_offset, maxsize, 0))
+        for reduction, data_offset, zindex_offset in zoom_headers:
+            fw.write(ZOOM_HEADER.pack(reduction, 0, data_offset, zindex_offset))
+        s = self.summary
+        if not s[0]:
+            s[1] = s[2] = 0
+        fw.seek(summary_offset)
+        fw.write(SUMMARY.pack(*s))
+        fw.close()
+        logging.debug("{0} sections, {1} zoom levels written to `{2}`".\
+                        format(len(self.data.index), len(zoom_headers),
+                               self.filename))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
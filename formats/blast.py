@@ -9,10 +9,13 @@ import os.path as op
 import sys
 import logging
 
+import numpy as np
+
 from itertools import groupby
 from collections import defaultdict
 
-from maize.formats.base import LineFile, BaseFile, must_open
+from maize.formats.base import LineFile, BaseFile, must_open, parse_sharded, \
+            ColumnCache, pack_strings, unpack_strings
 from maize.formats.bed import Bed
 from maize.formats.sizes import Sizes
 from maize.utils.grouper import Grouper
@@ -81,15 +84,75 @@ class BlastLine(object):
                     (self.subject, self.sstart - 1, self.sstop, self.query,
                      self.score, self.orientation))
 
+def _parse_blastlines(lines):
+    return [BlastLine(row) for row in lines if row.strip()]
+
+def _parse_blast_columns(lines):
+    # shards come back as columns, rows are rebuilt in the parent
+    return _blastlines_to_columns(_parse_blastlines(lines))
+
+_blast_numeric = ('pctid', 'hitlen', 'nmismatch', 'ngaps', 'qstart', 'qstop',
+                  'sstart', 'sstop', 'evalue', 'score')
+
+def _blastlines_to_columns(blines):
+    """
+    Columns for `ColumnCache`: query/subject as codes into packed names,
+    numeric fields as arrays, in the order of `blines`.
+    """
+    columns = {}
+    for field in ('query', 'subject'):
+        codes = {}
+        col = np.array([codes.setdefault(getattr(b, field), len(codes)) \
+                        for b in blines], dtype="int32")
+        names, ends = pack_strings(sorted(codes, key=codes.get))
+        columns[field] = col
+        columns[field + "_names"] = names
+        columns[field + "_ends"] = ends
+    for field in _blast_numeric:
+        dtype = "float64" if field in ('pctid', 'evalue', 'score') else "int64"
+        columns[field] = np.array([getattr(b, field) for b in blines],
+                                  dtype=dtype)
+    columns["minus"] = np.array([b.orientation == '-' for b in blines])
+    return columns
+
+def _blastlines_from_columns(columns):
+    """
+    Rebuild BlastLines from cached columns without tokenizing any text.
+    """
+    qnames = unpack_strings(columns["query_names"], columns["query_ends"])
+    snames = unpack_strings(columns["subject_names"], columns["subject_ends"])
+    fields = [columns[x].tolist() for x in ('query', 'subject') + \
+                _blast_numeric + ('minus',)]
+    blines = []
+    new = BlastLine.__new__
+    for q, s, pctid, hitlen, nmismatch, ngaps, qstart, qstop, sstart, sstop, \
+            evalue, score, minus in zip(*fields):
+        b = new(BlastLine)
+        b.query, b.subject = qnames[q], snames[s]
+        b.pctid, b.hitlen, b.nmismatch, b.ngaps = pctid, hitlen, nmismatch, ngaps
+        b.qstart, b.qstop, b.sstart, b.sstop = qstart, qstop, sstart, sstop
+        b.evalue, b.score = evalue, score
+        b.orientation = '-' if minus else '+'
+        blines.append(b)
+    return blines
+
 class BlastSlow (LineFile):
     """
     Load entire blastfile into memory
     """
-    def __init__(self, filename, sorted=False):
+    def __init__(self, filename, sorted=False, cpus=1, cache=False):
         super(BlastSlow, self).__init__(filename)
-        fp = must_open(filename)
-        for row in fp:
-            self.append(BlastLine(row))
+        cache = ColumnCache(filename, "blast") if cache else None
+        loaded = cache.load() if cache else None
+        if loaded:
+            self.extend(_blastlines_from_columns(loaded[0]))
+        elif cpus > 1:
+            for chunk in parse_sharded(filename, _parse_blast_columns, cpus=cpus):
+                self.extend(_blastlines_from_columns(chunk))
+        else:
+            self.extend(_parse_blastlines(must_open(filename)))
+        if cache and not loaded:
+            cache.save(_blastlines_to_columns(self))
         self.sorted = sorted
         if not sorted:
             self.sort(key=lambda x: x.query)
@@ -217,12 +280,14 @@ class BlastLineByConversion (BlastLine):
 
 def get_stats(blastfile):
 
-    from jcvi.utils.range import range_union
+    from array import array
+    from jcvi.utils.range import range_union_array
 
     logging.debug("report stats on `%s`" % blastfile)
     fp = open(blastfile)
-    ref_ivs = []
-    qry_ivs = []
+    qry_codes, ref_codes = {}, {}
+    qry_ivs = [array("l"), array("l"), array("l")]
+    ref_ivs = [array("l"), array("l"), array("l")]
     identicals = 0
     alignlen = 0
 
@@ -231,19 +296,23 @@ def get_stats(blastfile):
         qstart, qstop = c.qstart, c.qstop
         if qstart > qstop:
             qstart, qstop = qstop, qstart
-        qry_ivs.append((c.query, qstart, qstop))
+        qry_ivs[0].append(qry_codes.setdefault(c.query, len(qry_codes)))
+        qry_ivs[1].append(qstart)
+        qry_ivs[2].append(qstop)
 
         sstart, sstop = c.sstart, c.sstop
         if sstart > sstop:
             sstart, sstop = sstop, sstart
-        ref_ivs.append((c.subject, sstart, sstop))
+        ref_ivs[0].append(ref_codes.setdefault(c.subject, len(ref_codes)))
+        ref_ivs[1].append(sstart)
+        ref_ivs[2].append(sstop)
 
         alen = sstop - sstart
         alignlen += alen
         identicals += c.pctid / 100. * alen
 
-    qrycovered = range_union(qry_ivs)
-    refcovered = range_union(ref_ivs)
+    qrycovered = range_union_array(*qry_ivs)
+    refcovered = range_union_array(*ref_ivs)
     id_pct = identicals * 100. / alignlen
 
     return qrycovered, refcovered, id_pct
@@ -727,40 +796,72 @@ def combine_HSPs(a):
     m.pctid = 100 - (m.nmismatch + m.ngaps) * 100. / m.hitlen
     return m
 
-def chain_HSPs(blast, xdist=100, ydist=100):
+def _chain_group(args):
+    """
+    Cluster the HSPs of one query-subject pair, given as arrays sorted by
+    (qstart, qstop, sstart, sstop). Returns lists of indices into the arrays.
+
+    The x-axis distance of a later HSP j to i is |qstart_j - qstop_i - 1|,
+    so only the j whose qstart falls within xdist of qstop_i + 1 are paired
+    up (found by binary search on the sorted qstarts); orientation and y-axis
+    distance are then checked on all these pairs at once.
+    """
+    qstart, qstop, sstart, sstop, minus, xdist, ydist = args
+    n = len(qstart)
+    lo = np.searchsorted(qstart, qstop + 1 - xdist, side="left")
+    lo = np.maximum(lo, np.arange(1, n + 1))
+    hi = np.searchsorted(qstart, qstop + 1 + xdist, side="right")
+    counts = np.maximum(hi - lo, 0)
+    ai = np.repeat(np.arange(n), counts)
+    bj = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) \
+            + np.repeat(lo, counts)
+
+    swap = sstart[ai] > sstart[bj]
+    del_y = np.where(swap, sstart[ai] - sstop[bj], sstart[bj] - sstop[ai]) - 1
+    keep = (minus[ai] == minus[bj]) & (np.abs(del_y) <= ydist)
+
+    clusters = Grouper(range(n))
+    clusters.join_many(np.column_stack((ai[keep], bj[keep])))
+    return list(clusters)
+
+def chain_HSPs(blast, xdist=100, ydist=100, cpus=1):
     """
     Take a list of BlastLines (or a BlastSlow instance), and returns a list of
-    BlastLines.
+    BlastLines. Query-subject pairs are chained on `cpus` processes.
     """
     key = lambda x: (x.query, x.subject)
     blast.sort(key=key)
 
-    clusters = Grouper()
+    groups = []
     for qs, points in groupby(blast, key=key):
         points = sorted(list(points), \
                 key=lambda x: (x.qstart, x.qstop, x.sstart, x.sstop))
+        groups.append(points)
 
-        n = len(points)
-        for i in xrange(n):
-            a = points[i]
-            clusters.join(a)
-            for j in xrange(i + 1, n):
-                b = points[j]
-                if a.orientation != b.orientation:
-                    continue
-
-                # x-axis distance
-                del_x = get_distance(a, b)
-                if del_x > xdist:
-                    continue
-                # y-axis distance
-                del_y = get_distance(a, b, xaxis=False)
-                if del_y > ydist:
-                    continue
-                # otherwise join
-                clusters.join(a, b)
+    tasks = ((np.array([x.qstart for x in points], dtype="int64"),
+              np.array([x.qstop for x in points], dtype="int64"),
+              np.array([x.sstart for x in points], dtype="int64"),
+              np.array([x.sstop for x in points], dtype="int64"),
+              np.array([x.orientation == '-' for x in points]),
+              xdist, ydist) for points in groups)
+
+    if cpus > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(cpus)
+        results = pool.imap(_chain_group, tasks, chunksize=64)
+    else:
+        pool = None
+        results = (_chain_group(x) for x in tasks)
+
+    chained_hsps = []
+    for points, clusters in zip(groups, results):
+        chained_hsps.extend(combine_HSPs([points[i] for i in x]) \
+                            for x in clusters)
+    if pool:
+        pool.close()
+        pool.join()
 
-    chained_hsps = [combine_HSPs(x) for x in clusters]
     chained_hsps = sorted(chained_hsps, key=lambda x: (x.query, -x.score))
 
     return chained_hsps
@@ -772,22 +873,12 @@ def chain(args):
     Chain adjacent HSPs together to form larger HSP. The adjacent HSPs have to
     share the same orientation.
     """
-    p = OptionParser(chain.__doc__)
-    sp1.add_argument("--dist", dest="dist",
-            default=100, type="int",
-            help="extent of flanking regions to search [default: %default]")
-
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
-
-    blastfile, = args
-    dist = opts.dist
+    blastfile = args.i
+    dist = args.dist
     assert dist > 0
 
     blast = BlastSlow(blastfile)
-    chained_hsps = chain_HSPs(blast, xdist=dist, ydist=dist)
+    chained_hsps = chain_HSPs(blast, xdist=dist, ydist=dist, cpus=args.cpus)
 
     for b in chained_hsps:
         print(b)
@@ -863,7 +954,7 @@ def covfilter(args):
     applied, the id% and cov%.
     """
     from jcvi.algorithms.supermap import supermap
-    from jcvi.utils.range import range_union
+    from jcvi.utils.range import range_union_array
 
     allowed_iterby = ("query", "query_sbjct")
 
@@ -926,7 +1017,7 @@ def covfilter(args):
         this_gaps = 0
         this_identity = 0
 
-        ranges = []
+        starts, stops = [], []
         for b in blines:
             if scov:
                 s, start, stop = b.subject, b.sstart, b.sstop
@@ -943,13 +1034,14 @@ def covfilter(args):
             this_alignlen += b.hitlen
             this_mismatches += b.nmismatch
             this_gaps += b.ngaps
-            ranges.append(("1", start, stop))
+            starts.append(start)
+            stops.append(stop)
 
-        if ranges:
+        if starts:
             this_identity = 100. - (this_mismatches + this_gaps) * 100. / this_alignlen
 
         if union:
-            this_covered = range_union(ranges)
+            this_covered = range_union_array([0] * len(starts), starts, stops)
 
         this_coverage = this_covered * 100. / sizes[cov_id]
         covidstore[query] = (this_identity, this_coverage)
@@ -1056,7 +1148,7 @@ def bed(args):
     Print out bed file based on coordinates in BLAST report. By default, write
     out subject positions. Use --swap to write query positions.
     """
-    from jcvi.formats.bed import sort as bed_sort
+    from maize.formats.bed import sortBed
 
     p = OptionParser(bed.__doc__)
     sp1.add_argument("--swap", default=False, action="store_true",
@@ -1083,7 +1175,7 @@ def bed(args):
 
     logging.debug("File written to `{0}`.".format(bedfile))
     fw.close()
-    bed_sort([bedfile, "-i"])
+    sortBed(bedfile, inplace=True)
 
     return bedfile
 
@@ -1297,6 +1389,10 @@ if __name__ == '__main__':
     sp1 = sp.add_parser('chain', help='chain adjacent HSPs together',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     sp1.add_argument('i', help = '')
+    sp1.add_argument('--dist', type = int, default = 100,
+            help = 'extent of flanking regions to search')
+    sp1.add_argument('--cpus', type = int, default = 1,
+            help = 'chain query-subject pairs on this many processes')
     sp1.set_defaults(func = chain)
     
     sp1 = sp.add_parser('swap', help='swap query and subjects in BLAST tabular file',
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+In-process compressed file I/O used by `must_open`.
+
+Codecs are looked up by file suffix in `CODECS` and can be extended with
+`register_codec`. gzip input that is BGZF (blocked gzip, as written by
+bgzip/samtools) is inflated block-parallel on a thread pool; other streams
+are decompressed on a background thread while the caller parses. `.gz`
+output is written as BGZF, which stays readable by any gzip tool, with the
+blocks compressed in parallel. zlib, bz2 and lzma release the GIL while
+working, so threads are enough.
+"""
+
+import io
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+BUFSIZE = 1 << 22                        # read/write buffer, 4MB
+THREADS = min(4, os.cpu_count() or 1)    # default worker threads
+
+BGZF_BLOCKSIZE = 0xff00                  # uncompressed bytes per block
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b00"
+                         "03000000000000000000")
+_bgzf_header = struct.Struct("<4BI2BH2B2H")
+
+
+def is_bgzf(head):
+    """
+    Tell if the leading bytes of a file are a BGZF block header.
+
+    >>> is_bgzf(BGZF_EOF)
+    True
+    >>> is_bgzf(b"plain text")
+    False
+    """
+    if len(head) < 18 or head[:4] != b"\x1f\x8b\x08\x04":
+        return False
+    try:
+        return _block_size(head, 0) is not None
+    except IOError:
+        return False
+
+
+def _block_size(buf, pos):
+    """
+    Total size of the BGZF block starting at `pos`, None if the header is
+    not complete in `buf`.
+    """
+    if len(buf) - pos < 12:
+        return None
+    xlen, = struct.unpack_from("<H", buf, pos + 10)
+    if len(buf) - pos < 12 + xlen:
+        return None
+    i, end = pos + 12, pos + 12 + xlen
+    while i + 4 <= end:
+        si1, si2, slen = struct.unpack_from("<2BH", buf, i)
+        if si1 == 66 and si2 == 67 and slen == 2:
+            return struct.unpack_from("<H", buf, i + 4)[0] + 1
+        i += 4 + slen
+    raise IOError("Not a BGZF block at offset {0}".format(pos))
+
+
+def bgzf_compress(data, level=6):
+    """
+    Compress at most `BGZF_BLOCKSIZE` bytes into one BGZF block.
+
+    >>> bgzf_inflate(bgzf_compress(b"ACGT" * 10)) == b"ACGT" * 10
+    True
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = _bgzf_header.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                               len(cdata) + 25)
+    return header + cdata + struct.pack("<2I", zlib.crc32(data) & 0xffffffff,
+                                        len(data))
+
+
+def bgzf_inflate(block):
+    """
+    Inflate one BGZF block (bytes or memoryview).
+    """
+    xlen, = struct.unpack_from("<H", block, 10)
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    isize, = struct.unpack_from("<I", block, len(block) - 4)
+    if len(data) != isize:
+        raise IOError("Corrupt BGZF block, expect {0} bytes got {1}".\
+                        format(isize, len(data)))
+    return data
+
+
+def split_blocks(buf):
+    """
+    Cut the complete BGZF blocks off the front of `buf`. Returns the blocks
+    as memoryviews and the number of bytes they take.
+    """
+    buf = memoryview(buf)
+    pos, blocks = 0, []
+    while True:
+        size = _block_size(buf, pos)
+        if size is None or pos + size > len(buf):
+            break
+        blocks.append(buf[pos:pos + size])
+        pos += size
+    return blocks, pos
+
+
+def block_offsets(fp):
+    """
+    Compressed offsets of all the blocks of a BGZF file object, found by
+    hopping from header to header without inflating anything.
+    """
+    offsets = []
+    offset = fp.seek(0, io.SEEK_END)
+    size, offset = offset, fp.seek(0)
+    while offset < size:
+        head = fp.read(18)
+        length = _block_size(head, 0) if len(head) == 18 else None
+        if length is None:
+            raise EOFError("Truncated BGZF stream")
+        offsets.append(offset)
+        offset = fp.seek(offset + length)
+    return offsets
+
+
+def read_block(fp):
+    """
+    Read the next raw BGZF block from a file object, b"" at the end.
+    """
+    head = fp.read(18)
+    if not head:
+        return b""
+    length = _block_size(head, 0) if len(head) == 18 else None
+    if length is None:
+        raise EOFError("Truncated BGZF stream")
+    return head + fp.read(length - 18)
+
+
+def iter_blocks(fp, threads=THREADS, chunksize=BUFSIZE):
+    """
+    Iterate over (compressed offset, inflated data) of the blocks of a BGZF
+    file object, inflating on `threads` threads.
+    """
+    pool = ThreadPoolExecutor(threads) if threads > 1 else None
+    offset, tail = fp.tell(), b""
+    try:
+        while True:
+            chunk = fp.read(chunksize)
+            if not chunk:
+                if tail:
+                    raise EOFError("Truncated BGZF stream")
+                break
+            buf = tail + chunk
+            blocks, consumed = split_blocks(buf)
+            tail = buf[consumed:]
+            offsets = []
+            for b in blocks:
+                offsets.append(offset)
+                offset += len(b)
+            datas = pool.map(bgzf_inflate, blocks) if pool \
+                        else map(bgzf_inflate, blocks)
+            for item in zip(offsets, datas):
+                yield item
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+def _inflate_batch(blocks):
+    return b"".join(bgzf_inflate(x) for x in blocks)
+
+
+def _deflate_batch(args):
+    data, level = args
+    return b"".join(bgzf_compress(data[i:i + BGZF_BLOCKSIZE], level)
+                    for i in range(0, len(data), BGZF_BLOCKSIZE))
+
+
+class BgzfReader (io.RawIOBase):
+    """
+    Reads a BGZF stream, inflating batches of blocks on `threads` threads
+    ahead of the consumer. Use a small `chunksize` for short random reads.
+    """
+    def __init__(self, fileobj, threads=THREADS, chunksize=BUFSIZE):
+        self._fp = fileobj
+        self._chunksize = chunksize
+        self._skip = 0
+        self._threads = max(threads, 1)
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self._pending = deque()
+        self._tail = b""
+        self._eof = False
+        self._buf = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        chunk = self._fp.read(self._chunksize)
+        if not chunk:
+            if self._tail:
+                raise EOFError("Truncated BGZF stream")
+            self._eof = True
+            return
+
+        buf = self._tail + chunk
+        blocks, consumed = split_blocks(buf)
+        self._tail = buf[consumed:]
+        if not blocks:
+            return
+
+        if not self._pool:
+            self._pending.append(_inflate_batch(blocks))
+            return
+        step = -(-len(blocks) // self._threads)
+        for i in range(0, len(blocks), step):
+            self._pending.append(self._pool.submit(_inflate_batch,
+                                                   blocks[i:i + step]))
+
+    def seek_virtual(self, voffset):
+        """
+        Move to a virtual offset: compressed offset of a block << 16 | offset
+        within the inflated block.
+        """
+        if self._pool:
+            for f in self._pending:
+                f.cancel()
+        self._pending.clear()
+        self._fp.seek(voffset >> 16)
+        self._tail = b""
+        self._eof = False
+        self._buf = memoryview(b"")
+        self._skip = voffset & 0xffff
+
+    def readinto(self, b):
+        while not len(self._buf):
+            while not self._eof and len(self._pending) < 2 * self._threads:
+                self._fill()
+            if not self._pending:
+                return 0
+            item = self._pending.popleft()
+            self._buf = memoryview(item.result() if self._pool else item)
+            if self._skip:
+                self._buf = self._buf[self._skip:]
+                self._skip = 0
+
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self._pool:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+            self._fp.close()
+        super(BgzfReader, self).close()
+
+
+class BgzfWriter (io.RawIOBase):
+    """
+    Writes a BGZF stream (EOF marker included), compressing batches of
+    blocks on `threads` threads while keeping their order.
+    """
+    def __init__(self, fileobj, threads=THREADS, level=6):
+        self._fp = fileobj
+        self._threads = max(threads, 1)
+        self._pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self._level = level
+        self._pending = deque()
+        self._buf = bytearray()
+        self._batch = BGZF_BLOCKSIZE * 16
+
+    def writable(self):
+        return True
+
+    def _submit(self, data):
+        if self._pool:
+            self._pending.append(self._pool.submit(_deflate_batch,
+                                                   (data, self._level)))
+            while len(self._pending) > 2 * self._threads:
+                self._fp.write(self._pending.popleft().result())
+        else:
+            self._fp.write(_deflate_batch((data, self._level)))
+
+    def write(self, b):
+        self._buf += b
+        if len(self._buf) >= self._batch:
+            n = len(self._buf) - len(self._buf) % self._batch
+            self._submit(bytes(self._buf[:n]))
+            del self._buf[:n]
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+            while self._pending:
+                self._fp.write(self._pending.popleft().result())
+            if self._pool:
+                self._pool.shutdown()
+            self._fp.write(BGZF_EOF)
+            self._fp.close()
+        super(BgzfWriter, self).close()
+
+
+class PrefetchReader (io.RawIOBase):
+    """
+    Pulls `BUFSIZE` chunks from a (decompressing) stream on a background
+    thread, so decompression overlaps with parsing in the caller.
+    """
+    def __init__(self, stream, depth=4):
+        self._stream = stream
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._buf = memoryview(b"")
+        self._done = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            while True:
+                data = self._stream.read(BUFSIZE)
+                if not self._put(data) or not data:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def readinto(self, b):
+        while not len(self._buf):
+            if self._done:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._done = True
+                raise item
+            if not item:
+                self._done = True
+                return 0
+            self._buf = memoryview(item)
+
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        super(PrefetchReader, self).close()
+
+
+class _StreamWriter (io.RawIOBase):
+    """
+    Raw adapter for the stdlib/zstd compressing writers, closing the
+    underlying file with them.
+    """
+    def __init__(self, stream, fileobj):
+        self._stream = stream
+        self._fp = fileobj
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._stream.write(b)
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+            self._fp.close()
+        super(_StreamWriter, self).close()
+
+
+def gzip_reader(fp, threads=THREADS):
+    if is_bgzf(fp.peek(18)[:18]):
+        return BgzfReader(fp, threads=threads)
+    import gzip
+    return PrefetchReader(gzip.GzipFile(fileobj=fp, mode="rb"))
+
+def gzip_writer(fp, threads=THREADS, level=6):
+    return BgzfWriter(fp, threads=threads, level=level)
+
+def bz2_reader(fp, threads=THREADS):
+    import bz2
+    return PrefetchReader(bz2.BZ2File(fp, "rb"))
+
+def bz2_writer(fp, threads=THREADS, level=9):
+    import bz2
+    return _StreamWriter(bz2.BZ2File(fp, "wb", compresslevel=level), fp)
+
+def xz_reader(fp, threads=THREADS):
+    import lzma
+    return PrefetchReader(lzma.LZMAFile(fp, "rb"))
+
+def xz_writer(fp, threads=THREADS, level=6):
+    import lzma
+    return _StreamWriter(lzma.LZMAFile(fp, "wb", preset=level), fp)
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading/writing .zst requires `zstandard`")
+    return zstandard
+
+def zstd_reader(fp, threads=THREADS):
+    zstd = _zstandard()
+    return PrefetchReader(zstd.ZstdDecompressor().stream_reader(fp))
+
+def zstd_writer(fp, threads=THREADS, level=3):
+    zstd = _zstandard()
+    c = zstd.ZstdCompressor(level=level, threads=threads)
+    return _StreamWriter(c.stream_writer(fp, closefd=False), fp)
+
+
+CODECS = {}
+
+def register_codec(suffix, reader, writer):
+    """
+    Make `open_compressed` (and `must_open`) handle files ending with
+    `suffix`. `reader(fp, threads)` and `writer(fp, threads)` wrap a binary
+    file object into a raw stream of decompressed/to-compress bytes.
+    """
+    CODECS[suffix] = (reader, writer)
+
+register_codec(".gz", gzip_reader, gzip_writer)
+register_codec(".bgz", gzip_reader, gzip_writer)
+register_codec(".bz2", bz2_reader, bz2_writer)
+register_codec(".xz", xz_reader, xz_writer)
+register_codec(".zst", zstd_reader, zstd_writer)
+
+
+def get_codec(filename):
+    for suffix, codec in CODECS.items():
+        if filename.endswith(suffix):
+            return codec
+    return None
+
+
+def open_compressed(filename, mode="r", threads=THREADS, encoding=None):
+    """
+    Open a compressed file in text (default) or binary mode, for reading
+    ("r"), writing ("w") or appending ("a", a new member is added).
+    """
+    codec = get_codec(filename)
+    assert codec, "No codec registered for `{0}`".format(filename)
+    reader, writer = codec
+    rw = mode.replace("b", "").replace("t", "")
+    assert rw in ("r", "w", "a"), "Unknown mode `{0}`".format(mode)
+
+    fp = io.open(filename, rw + "b")
+    if rw == "r":
+        stream = io.BufferedReader(reader(fp, threads=threads), BUFSIZE)
+    else:
+        stream = io.BufferedWriter(writer(fp, threads=threads), BUFSIZE)
+
+    if "b" in mode:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding)
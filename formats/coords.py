@@ -133,6 +133,16 @@ class CoordsLine (object):
 
         return type
 
+def _parse_coordslines(lines):
+    # header and other malformed rows are skipped
+    coords = []
+    for row in lines:
+        try:
+            coords.append(CoordsLine(row))
+        except AssertionError:
+            pass
+    return coords
+
 class Coords (LineFile):
 
     """
@@ -153,13 +163,9 @@ class Coords (LineFile):
 
         fp = open(filename)
         if header:
-            self.cmd = fp.next()
+            self.cmd = next(fp)
 
-        for row in fp:
-            try:
-                self.append(CoordsLine(row))
-            except AssertionError:
-                pass
+        self.extend(_parse_coordslines(fp))
 
         if sorted:
             self.ref_sort()
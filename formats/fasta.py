@@ -91,34 +91,37 @@ def translate(args):
         nrcd = SeqRecord(aa, id = sid, description = "")
         SeqIO.write(nrcd, sys.stdout, "fasta")
 
+def wrap_fasta(oid, seq, width=60):
+    lines = [b">" + oid.encode()]
+    lines += [seq[i:i+width] for i in range(0, len(seq), width)]
+    lines.append(b"")
+    return b"\n".join(lines)
+
 def extract(args):
     import re
-    from jcvi.formats.bed import Bed
+    import numpy as np
+    from jcvi.formats.bed import BedArray
+    from jcvi.formats.twobit import twobit_store
 
-    db = ""
     if op.isfile(args.db):
-        db = Fasta(args.db)
+        f_db = args.db
     else:
         f_db = "%s/data/%s/10_genome.fna" % (os.environ["genome"], args.db)
         assert op.isfile(f_db), "cannot find %s" % args.db
-        db = Fasta(f_db)
+    db = twobit_store(f_db)
 
     reg1 = re.compile("^([\w\-]+)\:([\d,]+)(\-|\.{1,2})([\d,]+)$")
     reg2 = re.compile("^([\w\-]+)$")
-    bed = Bed()
+    locs = []
     if op.isfile(args.loc):
         if args.list:
             fho = must_open(args.loc, 'r')
             for line in fho:
                 sid = line.strip()
-                beg = 0
                 if sid in db:
-                    end = len(db[sid])
-                    bed.add("%s\t%d\t%d\n" % (sid, beg, end))
+                    locs.append((sid, 1, db.size(sid)))
                 else:
                     logging.error("%s not in db => skipped" % sid)
-        else:
-            bed = Bed(args.loc, sorted=False)
     else:
         for loc in args.loc.split(","):
             res = reg1.match(loc)
@@ -126,56 +129,74 @@ def extract(args):
                 sid, beg, end = res.group(1), res.group(2), res.group(4)
                 beg = int(beg.replace(",", ""))
                 end = int(end.replace(",", ""))
-                bed.add("%s\t%d\t%d\n" % (sid, beg-1, end))
+                locs.append((sid, beg, end))
             else:
                 res = reg2.match(loc)
                 if res:
                     sid = res.group(1)
-                    beg = 0
                     if sid in db:
-                        end = len(db[sid])
-                        bed.add("%s\t%d\t%d\n" % (sid, beg, end))
+                        locs.append((sid, 1, db.size(sid)))
                     else:
                         logging.error("%s not in db => skipped" % sid)
                 else:
                     logging.error("%s: unknown locstr => skipped" % loc)
 
-    rcds = []
-    for b in bed:
-        sid, beg, end = b.seqid, b.start, b.end
-        oid = "%s-%d-%d" % (sid, beg, end)
-        if b.accn:
-            oid = b.accn
-        if sid not in db:
-            print("%s not in db => skipped" % sid)
-            continue
-        size = end - beg + 1
-        bp_pad = 0
-        if beg < 1:
-            bp_pad += 1 - beg
-            beg = 1
-        if beg > len(db[sid]):
-            bp_pad = 1
-            beg = len(db[sid])
-        if end > len(db[sid]):
-            bp_pad += end - len(db[sid])
-            end = len(db[sid])
-        seq = db[sid][beg-1:end].seq
-        if args.padding:
-            if bp_pad > 0:
-                if end-beg+1 < 30:
-                    seq = "N" * size
-                else:
-                    seq += "N" * bp_pad
-            assert len(seq) == size, "error in seq size: %s:%d-%d %d" % (sid, beg, end, bp_pad)
+    if op.isfile(args.loc) and not args.list:
+        bed = BedArray(args.loc, sorted=False)
+    else:
+        names = sorted(set(x[0] for x in locs))
+        codes = dict((x, i) for i, x in enumerate(names))
+        bed = BedArray.from_arrays(names, [codes[x[0]] for x in locs],
+                                   [x[1] for x in locs], [x[2] for x in locs])
+
+    sids = [bed.seqid_names[x] for x in bed.seqid.tolist()]
+    ok = np.array([x in db for x in sids], dtype=bool)
+    for i in np.flatnonzero(~ok).tolist():
+        print("%s not in db => skipped" % sids[i])
+    bed = bed._take(np.flatnonzero(ok))
+    sids = [x for x, o in zip(sids, ok.tolist()) if o]
+
+    # 1-based, clipped to the sequence as the padding below expects
+    sizes = np.array([db.size(x) for x in sids], dtype=np.int64)
+    obeg, oend = bed.start, bed.end
+    beg = np.minimum(np.maximum(obeg, 1), sizes)
+    end = np.minimum(oend, sizes)
+    bp_pad = np.where(obeg > sizes, 1, np.maximum(1 - obeg, 0)) + \
+             np.maximum(oend - sizes, 0)
+    strands = list(bed.strand) if args.stranded else None
+    seqs = db.fetch(sids, beg - 1, end, strands=strands)
+
+    accns = bed.accn
+    fw = sys.stdout.buffer
+    out = []
+    for i, seq in enumerate(seqs):
+        sid, b, e = sids[i], int(beg[i]), int(end[i])
+        if args.padding and bp_pad[i] > 0:
+            size = int(oend[i] - obeg[i] + 1)
+            if e-b+1 < 30:
+                seq = b"N" * size
+            else:
+                seq += b"N" * int(bp_pad[i])
+            assert len(seq) == size, "error in seq size: %s:%d-%d %d" % (sid, b, e, bp_pad[i])
 
         if args.tsv:
-            print("\t".join([sid, str(beg), str(end), seq]))
+            out.append(("\t".join([sid, str(b), str(e), ""])).encode() + seq + b"\n")
         else:
-            rcd = SeqRecord(Seq(seq), id = oid, description = '')
-            SeqIO.write([rcd], sys.stdout, 'fasta')
+            oid = accns[i] or "%s-%d-%d" % (sid, obeg[i], oend[i])
+            out.append(wrap_fasta(oid, seq))
+        if len(out) >= 10000:
+            fw.write(b"".join(out))
+            out = []
+    fw.write(b"".join(out))
+    fw.flush()
+
+def to2bit(args):
+    from jcvi.formats.twobit import fasta_to_twobit
+    fasta_to_twobit(args.fi, args.fo)
 
 def split_old(args):
+    from jcvi.formats.base import FileSplitter
+
     fi, dirw = op.realpath(args.fi), op.realpath(args.outdir)
     n = args.N
     if not op.exists(dirw):
@@ -183,21 +204,13 @@ def split_old(args):
     else:
         sh("rm -rf %s/*" % dirw)
 
-    cdir = os.path.dirname(os.path.realpath(__file__))
-    cwd = os.getcwd()
-    os.chdir(dirw)
-
-    sh("ln -sf %s part.fas" % fi)
-    sh("pyfasta split -n %d part.fas" % n)
-    sh("rm part.fas part.fas.*")
-
     digit = ndigit(n)
-    sizes = []
-    for i in range(0,n):
-        fmt = "part.%%0%dd.fas" % digit
-        fp = fmt % i
-        sizes.append(os.stat(fp).st_size)
-    sizes.sort()
+    fmt = "part.%%0%dd.fas" % digit
+    names = [fmt % i for i in range(0,n)]
+    fs = FileSplitter(fi, outputdir=dirw, format="fasta", mode="optimal")
+    fs.split(n, force=True, names=names)
+
+    sizes = sorted(os.stat(x).st_size for x in fs.names)
     print("size range: %s - %s" % (prettysize(sizes[0]), prettysize(sizes[n-1])))
 
 def tile(args):
@@ -429,53 +442,175 @@ def suffix(args):
             print(line)
     fh.close()
 
-def dedup(args):
-    fh = must_open(args.fi)
-    seqd = dict()
-    seq_it = SeqIO.parse(fh, "fasta")
-    cnt, cntu = 0, 0
-    for rcd in seq_it:
-        rid, seq = rcd.id, rcd.seq
-        cnt += 1
-        if seq in seqd:
-            seqd[seq] += args.sep + rid
+def _dedup_entries(entries, sep):
+    """
+    Collapse (digest, index, source, id) entries with the same digest. A
+    group keeps the index of its first entry; ids of source 0 are joined,
+    a group only in source 1 keeps its first id. Returns (index, ids) pairs
+    sorted by index, and the number of groups first seen in each source.
+    """
+    from itertools import groupby
+
+    entries.sort()
+    out, counts = [], [0, 0]
+    for digest, group in groupby(entries, key=lambda x: x[0]):
+        group = list(group)
+        first = group[0]
+        if first[2] == 0:
+            ids = sep.join(x[3] for x in group if x[2] == 0)
         else:
-            seqd[seq] = rid
-            cntu += 1
-    fh.close()
+            ids = first[3]
+        out.append((first[1], ids))
+        counts[first[2]] += 1
+    out.sort()
+    return out, counts
+
+def _dedup_bucket(bucketfile, sep, budget, depth=0):
+    """
+    Collapse a bucket of spilled entries into `<bucket>.nr` of (index, ids)
+    lines sorted by index. A bucket that would take more than `budget` in
+    memory (about three times its size on disk) is split 16 ways on the
+    next hex digit of the digests, and the parts collapsed one by one.
+    """
+    import heapq
+
+    outfile = bucketfile + ".nr"
+    if op.getsize(bucketfile) * 3 > budget and depth < 16:
+        parts = [open("{0}.{1:x}".format(bucketfile, k), "w") for k in range(16)]
+        for line in open(bucketfile):
+            parts[int(line[4 + depth], 16)].write(line)
+        for x in parts:
+            x.close()
+        os.remove(bucketfile)
+        results = [_dedup_bucket(x.name, sep, budget, depth + 1) for x in parts]
+        fps = [open(x[0]) for x in results]
+        with open(outfile, "w") as fw:
+            fw.writelines(heapq.merge(*fps, key=lambda x: int(x.split("\t", 1)[0])))
+        for fp in fps:
+            fp.close()
+            os.remove(fp.name)
+        return outfile, [sum(x[1][k] for x in results) for k in (0, 1)]
+
+    entries = []
+    for line in open(bucketfile):
+        digest, i, src, rid = line.rstrip("\n").split("\t", 3)
+        entries.append((digest, int(i), int(src), rid))
+    out, counts = _dedup_entries(entries, sep)
+    with open(outfile, "w") as fw:
+        fw.writelines("%d\t%s\n" % x for x in out)
+    os.remove(bucketfile)
+    return outfile, counts
+
+def nr_fasta(fastafiles, fw, sep=",", buffersize="1G", cpus=1, tmpdir=None):
+    """
+    Write the distinct sequences of `fastafiles` in order of first
+    appearance. Identical sequences of the first file are collapsed with
+    their ids joined by `sep`; later files only add sequences not seen
+    before. Sequences are compared by 128-bit digests and never held in
+    memory: the digests and ids are kept up to `buffersize`, beyond which
+    they are spilled into hash-prefix buckets under `tmpdir` that are
+    collapsed on `cpus` processes, each within `buffersize` / `cpus`. A
+    second pass streams the input again and writes the kept records.
+    """
+    import hashlib
+    import heapq
+    import shutil
+    from tempfile import mkdtemp
+    from jcvi.formats.bed import _parse_size
+    from jcvi.formats.twobit import iter_fasta_raw
+
+    budget = _parse_size(buffersize)
+    workdir = None
+    spooled = []
+    if any(not op.isfile(x) for x in fastafiles):
+        # stdin etc. can only be read once, keep a copy for the second pass
+        workdir = mkdtemp(prefix="nr.", dir=tmpdir)
+        for i, x in enumerate(fastafiles):
+            if not op.isfile(x):
+                spool = op.join(workdir, "input{0}.fa".format(i))
+                with open(spool, "w") as fo:
+                    fo.writelines(must_open(x))
+                fastafiles[i] = spool
+                spooled.append(spool)
+
+    nbuckets = max(cpus, 1) * 16
+    entries, size, buckets = [], 0, None
+    nrecords = 0
+    i = 0
+    for src, fastafile in enumerate(fastafiles):
+        for rid, seq in iter_fasta_raw(fastafile):
+            digest = hashlib.blake2b(seq, digest_size=16).hexdigest()
+            entries.append((digest, i, min(src, 1), rid))
+            size += len(rid) + 150      # python objects of an entry
+            if src == 0:
+                nrecords += 1
+            i += 1
+            if size >= budget:
+                if workdir is None:
+                    workdir = mkdtemp(prefix="nr.", dir=tmpdir)
+                if buckets is None:
+                    buckets = [open(op.join(workdir, "bucket{0:04d}".format(k)), "w")
+                               for k in range(nbuckets)]
+                for e in entries:
+                    buckets[int(e[0][:4], 16) % nbuckets].write("%s\t%d\t%d\t%s\n" % e)
+                entries, size = [], 0
+
+    if buckets is None:
+        out, counts = _dedup_entries(entries, sep)
+        merged = iter(out)
+    else:
+        for e in entries:
+            buckets[int(e[0][:4], 16) % nbuckets].write("%s\t%d\t%d\t%s\n" % e)
+        entries = []
+        names = [x.name for x in buckets]
+        for x in buckets:
+            x.close()
+        logging.debug("Collapse {0} buckets from `{1}`".format(nbuckets, workdir))
+        share = budget // max(cpus, 1)
+        if cpus > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(cpus) as pool:
+                results = list(pool.map(_dedup_bucket, names, [sep] * len(names),
+                                        [share] * len(names)))
+        else:
+            results = [_dedup_bucket(x, sep, share) for x in names]
+        counts = [sum(x[1][k] for x in results) for k in (0, 1)]
+        fps = [open(x[0]) for x in results]
+        merged = ((int(a), b) for a, b in (x.rstrip("\n").split("\t", 1) for x in
+                  heapq.merge(*fps, key=lambda x: int(x.split("\t", 1)[0]))))
+
+    nxt = next(merged, None)
+    out = []
+    i = 0
+    for fastafile in fastafiles:
+        for rid, seq in iter_fasta_raw(fastafile):
+            if nxt is not None and nxt[0] == i:
+                out.append(wrap_fasta(nxt[1], seq))
+                nxt = next(merged, None)
+                if len(out) >= 10000:
+                    fw.write(b"".join(out))
+                    out = []
+            i += 1
+    fw.write(b"".join(out))
+    fw.flush()
+
+    if workdir is not None:
+        if buckets is not None:
+            for fp in fps:
+                fp.close()
+        shutil.rmtree(workdir)
+    return nrecords, counts[0], counts[1]
 
-    seqs = [SeqRecord(seq, id=rids, description='') for seq, rids in seqd.items()]
-    SeqIO.write(seqs, sys.stdout, "fasta")
+def dedup(args):
+    cnt, cntu, cntn = nr_fasta([args.fi], sys.stdout.buffer, sep=args.sep,
+            buffersize=args.buffer, cpus=args.cpus, tmpdir=args.tmpdir)
     logging.info("%6d total sequences" % cnt)
     logging.info("%6d non-redundant sequences" % cntu)
 
 def add_nr(args):
-    fh = must_open(args.fi)
-    seqd = dict()
-    seq_it = SeqIO.parse(fh, "fasta")
-    cnt, cntu = 0, 0
-    for rcd in seq_it:
-        rid, seq = rcd.id, rcd.seq
-        cnt += 1
-        if seq in seqd:
-            seqd[seq] += args.sep + rid
-        else:
-            seqd[seq] = rid
-            cntu += 1
-    fh.close()
-
-    cntn = 0
-    fh = must_open(args.fi2)
-    seq_it = SeqIO.parse(fh, "fasta")
-    for rcd in seq_it:
-        rid, seq = rcd.id, rcd.seq
-        if seq not in seqd:
-            seqd[seq] = rid
-            cntn += 1
-    fh.close()
-
-    seqs = [SeqRecord(seq, id=rids, description='') for seq, rids in seqd.items()]
-    SeqIO.write(seqs, sys.stdout, "fasta")
+    cnt, cntu, cntn = nr_fasta([args.fi, args.fi2], sys.stdout.buffer,
+            sep=args.sep, buffersize=args.buffer, cpus=args.cpus,
+            tmpdir=args.tmpdir)
     logging.info("%6d total sequences" % cnt)
     logging.info("%6d non-redundant sequences" % cntu)
     logging.info("%6d new sequences added" % cntn)
@@ -544,8 +679,15 @@ if __name__ == "__main__":
     sp1.add_argument('--padding', action = "store_true", help = 'padding to size')
     sp1.add_argument('--tsv', action = "store_true", help = 'output in tabular format')
     sp1.add_argument('--list', action = "store_true", help = 'input is text file with sequence IDs')
+    sp1.add_argument('--stranded', action = "store_true", help = 'reverse complement regions on the "-" strand')
     sp1.set_defaults(func = extract)
 
+    sp1 = sp.add_parser("2bit", help = 'pack fasta into a 2bit sequence store (used by extract)',
+            formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    sp1.add_argument('fi', help = 'input fasta file')
+    sp1.add_argument('fo', help = 'output 2bit file')
+    sp1.set_defaults(func = to2bit)
+
     sp1 = sp.add_parser("tile", help = 'create sliding windows that tile the entire sequence',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     sp1.add_argument('fi', help = 'input fasta file')
@@ -612,6 +754,9 @@ if __name__ == "__main__":
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     sp1.add_argument('fi', help='input fasta file')
     sp1.add_argument('--sep', default=',', help='separator')
+    sp1.add_argument('--buffer', default='1G', help='memory for sequence digests, spill to disk beyond')
+    sp1.add_argument('--cpus', type=int, default=1, help='number of processes to collapse spilled buckets')
+    sp1.add_argument('--tmpdir', default=None, help='directory for spilled buckets')
     sp1.set_defaults(func = dedup)
 
     sp1 = sp.add_parser("add_nr", help='add non-redundant sequences from file2 to file1',
@@ -619,6 +764,9 @@ if __name__ == "__main__":
     sp1.add_argument('fi', help='input fasta file')
     sp1.add_argument('fi2', help='input fasta file 2')
     sp1.add_argument('--sep', default=',', help='separator')
+    sp1.add_argument('--buffer', default='1G', help='memory for sequence digests, spill to disk beyond')
+    sp1.add_argument('--cpus', type=int, default=1, help='number of processes to collapse spilled buckets')
+    sp1.add_argument('--tmpdir', default=None, help='directory for spilled buckets')
     sp1.set_defaults(func = add_nr)
 
     sp1 = sp.add_parser("cds2gene", help='concatenate CDS segmetns for each gene')
@@ -10,12 +10,13 @@ import sys
 import re
 import logging
 import json
-import gzip
+
+import numpy as np
 
 from itertools import islice
+from collections import Counter
 
 from Bio import SeqIO
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 from maize.formats.base import must_open, DictFile
 from maize.utils.cbook import percentage
@@ -42,19 +43,13 @@ class FastqLite (object):
         self.qual = self.qual[::-1]
 
 class FastqRecord (object):
-    def __init__(self, fh, offset=0, key=None):
-        self.name = self.header = fh.readline()
-        if not self.name:
-            return
-        self.name = self.name.split()[0]
-        self.seq = fh.readline().rstrip()
-        self.l3 = fh.readline().rstrip()
-        self.qual = fh.readline().rstrip()
-        if offset != 0:
-            self.qual = "".join(chr(ord(x) + offset) for x in self.qual)
+    def __init__(self, header, seq, qual, key=None):
+        self.header = header
+        self.name = header.split()[0]
+        self.seq = seq
+        self.l3 = "+"
+        self.qual = qual
         self.length = len(self.seq)
-        assert self.length == len(self.qual), \
-                "length mismatch: seq(%s) and qual(%s)" % (self.seq, self.qual)
         if key:
             self.name = key(self.name)
 
@@ -68,6 +63,233 @@ class FastqRecord (object):
     def quality(self):
         return [ord(x) for x in self.qual]
 
+def qual_table(offset):
+    """
+    Lookup table that shifts quality chars by `offset`.
+
+    >>> qual_table(-31)[[ord("h"), ord("B")]].tolist()
+    [73, 35]
+    """
+    return np.clip(np.arange(256) + offset, 0, 255).astype(np.uint8)
+
+class FastqBatch (object):
+    """
+    A batch of 4-line FASTQ records parsed from one buffer. The text stays
+    in `buf` (a uint8 array), records are located by the offsets of their
+    lines, and fields are handed out as memoryview slices or uint8 arrays
+    without being copied.
+    """
+    def __init__(self, buf, rbeg, nend, sbeg, send, qbeg, qend, rend):
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.rbeg, self.nend = rbeg, nend   # header line, "@" included
+        self.sbeg, self.send = sbeg, send
+        self.qbeg, self.qend = qbeg, qend
+        self.rend = rend                    # end of record, newline included
+
+    @classmethod
+    def parse(cls, buf, multiple=1, filename=None, nrecords=0):
+        """
+        Locate the complete records in `buf`; returns the batch and the
+        number of bytes it covers. The number of records is kept a
+        multiple of `multiple`, e.g. 2 for interleaved pairs.
+        """
+        nl = np.flatnonzero(buf == 10)
+        n = len(nl) // (4 * multiple) * (4 * multiple)
+        nl = nl[:n]
+        if not n:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(buf, *([empty] * 7)), 0
+
+        lbeg = np.empty(n, dtype=np.int64)
+        lbeg[0] = 0
+        lbeg[1:] = nl[:-1] + 1
+        lend = nl - ((nl > lbeg) & (buf[np.maximum(nl - 1, 0)] == 13))
+        lbeg, lend = lbeg.reshape(-1, 4), lend.reshape(-1, 4)
+
+        bad = (buf[lbeg[:, 0]] != 64) | (buf[lbeg[:, 2]] != 43) | \
+              (lend[:, 1] - lbeg[:, 1] != lend[:, 3] - lbeg[:, 3])
+        if bad.any():
+            i = int(np.argmax(bad))
+            rec = bytes(buf[lbeg[i, 0]:nl[4 * i + 3]]).decode(errors="replace")
+            raise Error("{0}(record {1}): malformed 4-line FASTQ record:\n{2}"
+                        .format(filename, nrecords + i + 1, rec))
+
+        batch = cls(buf, lbeg[:, 0], lend[:, 0], lbeg[:, 1], lend[:, 1],
+                    lbeg[:, 3], lend[:, 3], nl[3::4] + 1)
+        return batch, int(nl[-1]) + 1
+
+    def __len__(self):
+        return len(self.rbeg)
+
+    def __getitem__(self, i):
+        """
+        A slice, integer index array or boolean mask gives a sub-batch
+        sharing the same buffer.
+        """
+        return FastqBatch(self.buf, self.rbeg[i], self.nend[i], self.sbeg[i],
+                self.send[i], self.qbeg[i], self.qend[i], self.rend[i])
+
+    def __iter__(self):
+        """
+        Iterate over (header, seq, qual) memoryviews, "@" left off.
+        """
+        view = self.view
+        for rb, ne, sb, se, qb, qe in zip(self.rbeg.tolist(),
+                self.nend.tolist(), self.sbeg.tolist(), self.send.tolist(),
+                self.qbeg.tolist(), self.qend.tolist()):
+            yield view[rb + 1:ne], view[sb:se], view[qb:qe]
+
+    @property
+    def lengths(self):
+        return self.send - self.sbeg
+
+    def headers(self):
+        view = self.view
+        return [bytes(view[a + 1:b]) for a, b in
+                zip(self.rbeg.tolist(), self.nend.tolist())]
+
+    def ids(self):
+        return [x.split(None, 1)[0] for x in self.headers()]
+
+    def seq_array(self, i):
+        return self.buf[self.sbeg[i]:self.send[i]]
+
+    def qual_array(self, i):
+        return self.buf[self.qbeg[i]:self.qend[i]]
+
+    def qual_mask(self):
+        """
+        Boolean mask over `buf` of the quality characters.
+        """
+        d = np.zeros(len(self.buf) + 1, dtype=np.int8)
+        d[self.qbeg] += 1
+        d[self.qend] -= 1
+        return np.cumsum(d[:-1], dtype=np.int8).view(bool)
+
+    def shift_qual(self, offset):
+        """
+        Shift quality chars by `offset` in place (e.g. -31 for Illumina 1.3+
+        to Sanger), with one table lookup over the buffer.
+        """
+        mask = self.qual_mask()
+        self.buf[mask] = qual_table(offset)[self.buf[mask]]
+
+    def qual_count(self, minqual):
+        """
+        Number of bases per record with quality char >= `minqual`.
+        """
+        cs = np.zeros(len(self.buf) + 1, dtype=np.int32)
+        np.cumsum(self.buf >= ord(minqual), out=cs[1:])
+        return cs[self.qend] - cs[self.qbeg]
+
+    def records(self):
+        """
+        Iterate over the raw text of each record, as memoryviews.
+        """
+        view = self.view
+        for a, b in zip(self.rbeg.tolist(), self.rend.tolist()):
+            yield view[a:b]
+
+    def _runs(self):
+        # spans of records contiguous in `buf`
+        rbeg, rend = self.rbeg, self.rend
+        brk = np.flatnonzero(rbeg[1:] != rend[:-1]) + 1
+        starts = np.r_[0, brk]
+        ends = np.r_[brk, len(rbeg)] - 1
+        return zip(rbeg[starts].tolist(), rend[ends].tolist())
+
+    def write(self, fw):
+        """
+        Write the records to a binary handle, contiguous runs in one go.
+        """
+        if not len(self):
+            return
+        view = self.view
+        for a, b in self._runs():
+            fw.write(view[a:b])
+
+    def tobytes(self):
+        if not len(self):
+            return b""
+        view = self.view
+        return b"".join(view[a:b] for a, b in self._runs())
+
+def open_fastq(filename, mode="r"):
+    """
+    Binary handle of a (possibly compressed) FASTQ file or stdin/stdout.
+    """
+    if not isinstance(filename, str):
+        return getattr(filename, "buffer", filename)
+    if filename in ("-", "stdin"):
+        return sys.stdin.buffer
+    if filename == "stdout":
+        return sys.stdout.buffer
+    return must_open(filename, mode.replace("b", "") + "b")
+
+def iter_fastq_batches(filename, offset=0, multiple=1, bufsize=1 << 22):
+    """
+    Read FASTQ in blocks of about `bufsize` bytes and yield a `FastqBatch`
+    of the complete records in each, the partial record at the end of a
+    block is carried over to the next. Quality chars are shifted by
+    `offset`.
+    """
+    if isinstance(filename, str):
+        logging.debug("Read file `{0}`".format(filename))
+    fp = open_fastq(filename)
+    tail = b""
+    nrecords = 0
+    while True:
+        chunk = fp.read(bufsize)
+        buf = bytearray(tail)
+        buf += chunk
+        if not chunk:
+            buf = buf.rstrip()
+            if not buf:
+                break
+            buf += b"\n"
+        arr = np.frombuffer(buf, dtype=np.uint8)
+        batch, consumed = FastqBatch.parse(arr, multiple=multiple,
+                                filename=filename, nrecords=nrecords)
+        if not chunk and consumed < len(buf):
+            raise Error("{0}(record {1}): End of input before sequence was "
+                        "complete".format(filename, nrecords + len(batch) + 1))
+        tail = bytes(buf[consumed:])
+        if len(batch):
+            if offset:
+                batch.shift_qual(offset)
+            nrecords += len(batch)
+            yield batch
+        if not chunk:
+            break
+
+def iter_paired_batches(r1, r2=None, offset=0, bufsize=1 << 22):
+    """
+    Yield (batch1, batch2) of paired records of equal length, from two
+    files or from one interleaved file (`r2` None or the same as `r1`).
+    """
+    if r2 is None or r2 == r1:
+        for batch in iter_fastq_batches(r1, offset=offset, multiple=2,
+                                        bufsize=bufsize):
+            yield batch[0::2], batch[1::2]
+        return
+
+    ai = iter_fastq_batches(r1, offset=offset, bufsize=bufsize)
+    bi = iter_fastq_batches(r2, offset=offset, bufsize=bufsize)
+    a = b = None
+    while True:
+        if a is None or not len(a):
+            a = next(ai, None)
+        if b is None or not len(b):
+            b = next(bi, None)
+        if a is None or b is None:
+            break
+        n = min(len(a), len(b))
+        yield a[:n], b[:n]
+        a, b = a[n:], b[n:]
+    if a is not None or b is not None:
+        logging.error("`{0}` and `{1}` differ in number of reads".format(r1, r2))
+
 class FastqHeader(object):
 
     def __init__(self, row):
@@ -187,18 +409,157 @@ def pairspf(pp, commonprefix=True):
         pf = op.basename(pp[0])
     return pf
 
-def iter_fastq(filename, offset=0, key=None):
-    if isinstance(filename, str):
-        logging.debug("Read file `{0}`".format(filename))
-        fh = must_open(filename)
+class ReadTrimmer (object):
+    """
+    Quality trimming and filtering of whole batches of reads at once.
+
+    Each read is first cut to bases `first`..`last` (1-based, as in
+    `fastx_trimmer -f -l`), then at the start of the first `window`-base
+    window whose mean quality is below `winqual`. The rest of the read has
+    to pass all of: mean quality >= `minmean`, at least `pct`% of bases with
+    quality >= `minqual`, at most `maxn` N's, and length >= `minlen`.
+    """
+    def __init__(self, offset=33, first=1, last=0, window=0, winqual=20,
+                 minmean=0, minqual=0, pct=0, maxn=None, minlen=1):
+        self.offset = offset
+        self.first, self.last = first, last
+        self.window, self.winqual = window, winqual
+        self.minmean, self.minqual, self.pct = minmean, minqual, pct
+        self.maxn, self.minlen = maxn, minlen
+
+    def __call__(self, batch):
+        """
+        Returns the pass mask and the kept [beg, end) of every read.
+        """
+        n = len(batch)
+        L = batch.lengths
+        M = int(L.max()) if n else 0
+        cols = np.arange(M)
+        last = len(batch.buf) - 1
+        Q = batch.buf[np.minimum(batch.qbeg[:, None] + cols, last)].astype(np.int16)
+        Q -= self.offset
+
+        beg = np.minimum(max(self.first - 1, 0), L)
+        end = np.minimum(L, self.last) if self.last else L.copy()
+        end = np.maximum(end, beg)
+
+        w = self.window
+        if w and M >= w:
+            cs = np.zeros((n, M + 1), dtype=np.int32)
+            np.cumsum(Q, axis=1, out=cs[:, 1:])
+            j = cols[:M - w + 1]
+            bad = (cs[:, w:] - cs[:, :M - w + 1]) < self.winqual * w
+            bad &= (j >= beg[:, None])
+            bad &= (j + w <= end[:, None])
+            hasbad = bad.any(axis=1)
+            end = np.where(hasbad, np.maximum(np.argmax(bad, axis=1), beg), end)
+
+        length = end - beg
+        keep = length >= self.minlen
+        if not (self.minmean or self.pct or self.maxn is not None):
+            return keep, beg, end
+
+        K = (cols >= beg[:, None]) & (cols < end[:, None])
+        if self.minmean:
+            qsum = (Q * K).sum(axis=1)
+            keep &= qsum >= self.minmean * length
+        if self.pct:
+            highs = ((Q >= self.minqual) & K).sum(axis=1)
+            keep &= highs * 100 >= length * self.pct
+        if self.maxn is not None:
+            S = batch.buf[np.minimum(batch.sbeg[:, None] + cols, last)]
+            nn = (((S == 78) | (S == 110)) & K).sum(axis=1)
+            keep &= nn <= self.maxn
+        return keep, beg, end
+
+def format_trimmed(batch, beg, end):
+    """
+    Text of each read of `batch` cut to [beg, end), "+" lines emptied.
+    """
+    view = batch.view
+    return [b"%s\n%s\n+\n%s\n" % (view[rb:ne], view[sb + b:sb + e],
+                                    view[qb + b:qb + e])
+            for rb, ne, sb, qb, b, e in zip(batch.rbeg.tolist(),
+                batch.nend.tolist(), batch.sbeg.tolist(), batch.qbeg.tolist(),
+                beg.tolist(), end.tolist())]
+
+def _trim_block(block, trimmer, interleave=False):
+    """
+    Trim one block of reads (mates in `block[1]` if paired); a pair is kept
+    only if both mates pass. Returns the output text of each mate (one
+    interleaved text with `interleave`) and the number of reads in and out.
+    """
+    batches = [FastqBatch.parse(np.frombuffer(x, dtype=np.uint8))[0]
+               for x in block if x is not None]
+    results = [trimmer(x) for x in batches]
+    keep = results[0][0]
+    for k, beg, end in results[1:]:
+        keep = keep & k
+    out = [format_trimmed(x[keep], beg[keep], end[keep])
+           for x, (k, beg, end) in zip(batches, results)]
+    if interleave:
+        out = [b"".join(b"".join(x) for x in zip(*out))]
     else:
-        fh = filename
+        out = [b"".join(x) for x in out]
+    return out, len(keep), int(keep.sum())
 
-    while True:
-        rec = FastqRecord(fh, offset=offset, key=key)
-        if not rec.name:
-            break
-        yield rec
+def trim_reads(r1, r2, o1, o2, trimmer, interleaved=False, cpus=1,
+               bufsize=1 << 22):
+    """
+    Run `trimmer` over single, paired (`r2`) or interleaved reads; paired
+    reads go to `o1` and `o2`, or interleaved to `o1` if there is no `o2`.
+    Blocks are trimmed on `cpus` processes with a bounded queue of blocks
+    in flight, and written out in input order so mates stay in sync.
+    """
+    from collections import deque
+    from functools import partial
+
+    paired = bool(r2) or interleaved
+    if paired:
+        blocks = ((a.tobytes(), b.tobytes()) for a, b in
+                  iter_paired_batches(r1, r2, bufsize=bufsize))
+    else:
+        blocks = ((x.tobytes(), None) for x in
+                  iter_fastq_batches(r1, bufsize=bufsize))
+
+    fws = [open_fastq(x, "w") for x in (o1, o2) if x]
+    work = partial(_trim_block, trimmer=trimmer,
+                   interleave=paired and len(fws) == 1)
+
+    def emit(result):
+        out, a, b = result
+        for fw, text in zip(fws, out):
+            fw.write(text)
+        return a, b
+
+    if cpus > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        pending = deque()
+        results = []
+        with ProcessPoolExecutor(cpus) as pool:
+            for block in blocks:
+                pending.append(pool.submit(work, block))
+                if len(pending) >= 2 * cpus:
+                    results.append(emit(pending.popleft().result()))
+            while pending:
+                results.append(emit(pending.popleft().result()))
+    else:
+        results = [emit(work(block)) for block in blocks]
+
+    for fw in fws:
+        fw.close()
+    nin = sum(x[0] for x in results)
+    nout = sum(x[1] for x in results)
+    logging.debug("Reads{0} kept: {1}".format(" (pairs)" if paired else "",
+                                               percentage(nout, nin)))
+    return nin, nout
+
+def iter_fastq(filename, offset=0, key=None):
+    for batch in iter_fastq_batches(filename, offset=offset):
+        for header, seq, qual in batch:
+            yield FastqRecord("@" + bytes(header).decode(), bytes(seq).decode(),
+                              bytes(qual).decode(), key=key)
     yield None  # sentinel
 
 def uniq(args):
@@ -207,28 +568,47 @@ def uniq(args):
 
     Retain only first instance of duplicate reads. Duplicate is defined as
     having the same read name.
-    """
-    p = OptionParser(uniq.__doc__)
-    p.set_outfile()
-    opts, args = p.parse_args(args)
 
-    if len(args) != 1:
-        sys.exit(not p.print_help())
+    Read names are kept as 128-bit digests in sorted runs, sharded by hash
+    prefix over `--cpus` processes. With `--approx` they go into a
+    count-min sketch of fixed size instead, which may drop a few unique
+    reads as false duplicates.
+    """
+    from maize.utils.sketch import CountMinSketch, HyperLogLog, SortedRunSet, \
+            ShardPool, hash_bytes, log_memory
 
-    fastqfile, = args
-    fw = must_open(args.outfile, "w")
+    fw = open_fastq(args.outfile, "w")
     nduplicates = nreads = 0
-    seen = set()
-    for rec in iter_fastq(fastqfile):
-        nreads += 1
-        if rec is None:
-            break
-        name = rec.name
-        if name in seen:
-            nduplicates += 1
-            continue
-        seen.add(name)
-        print >> fw, rec
+    if args.approx:
+        cms = CountMinSketch(width=args.width)
+        hll = HyperLogLog()
+    else:
+        pool = ShardPool(SortedRunSet, cpus=args.cpus)
+
+    for batch in iter_fastq_batches(args.fi):
+        keep = np.zeros(len(batch), dtype=bool)
+        if args.approx:
+            keys = hash_bytes(batch.ids())
+            uniq, first = np.unique(keys, return_index=True)
+            unseen = cms.estimate(uniq) == 0
+            keep[first[unseen]] = True
+            cms.add(uniq[unseen])
+            hll.add(uniq)
+        else:
+            keys = hash_bytes(batch.ids(), digest_size=16)
+            for idx, new in pool.call("add_new", keys):
+                keep[idx] = new
+        nreads += len(batch)
+        nduplicates += len(batch) - int(keep.sum())
+        batch[keep].write(fw)
+    fw.flush()
+
+    if args.approx:
+        logging.debug("About {0} distinct read names".format(hll.estimate()))
+        log_memory("uniq", cms.nbytes + hll.nbytes)
+    else:
+        log_memory("uniq", sum(pool.each("nbytes")))
+        pool.close()
     logging.debug("Removed duplicate reads: {}".\
                   format(percentage(nduplicates, nreads)))
 
@@ -411,45 +791,23 @@ def filter(args):
     Filter to get high qv reads. Use interleaved format (one file) or paired
     format (two files) to filter on paired reads.
     """
-    p = OptionParser(filter.__doc__)
-    sp1.add_argument("-q", dest="qv", default=20, type="int",
-                 help="Minimum quality score to keep [default: %default]")
-    sp1.add_argument("-p", dest="pct", default=95, type="int",
-                 help="Minimum percent of bases that have [-q] quality "\
-                 "[default: %default]")
+    r1, r2 = args.r1, args.r2 or args.r1
+    qv, pct = args.qv, args.pct
 
-    opts, args = p.parse_args(args)
-
-    if len(args) not in (1, 2):
-        sys.exit(not p.print_help())
-
-    if len(args) == 1:
-        r1 = r2 = args[0]
-    else:
-        r1, r2 = args
-
-    qv = args.qv
-    pct = args.pct
-
-    offset = guessoffset([r1])
+    offset = guess_offset(r1)
     qvchar = chr(offset + qv)
     logging.debug("Call base qv >= {0} as good.".format(qvchar))
     outfile = r1.rsplit(".", 1)[0] + ".q{0}.paired.fastq".format(qv)
-    fw = open(outfile, "w")
+    fw = open_fastq(outfile, "w")
 
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
-
-        b = list(islice(p2fp, 4))
-        q1 = a[-1].rstrip()
-        q2 = b[-1].rstrip()
-
-        if isHighQv(q1, qvchar, pct=pct) and isHighQv(q2, qvchar, pct=pct):
-            fw.writelines(a)
-            fw.writelines(b)
+    for a, b in iter_paired_batches(r1, r2):
+        keep = (a.qual_count(qvchar) * 100 >= a.lengths * pct) & \
+               (b.qual_count(qvchar) * 100 >= b.lengths * pct)
+        a, b = a[keep], b[keep]
+        for ra, rb in zip(a.records(), b.records()):
+            fw.write(ra)
+            fw.write(rb)
+    fw.close()
 
 def checkShuffleSizes(p1, p2, pairsfastq, extra=0):
     from maize.apps.base import getfilesize
@@ -570,35 +928,28 @@ def guessoffset(args):
      L - Illumina 1.8+ Phred+33,  raw reads typically (0, 40)
         with 0=unused, 1=unused, 2=Read Segment Quality Control Indicator (bold)
     """
-    p = OptionParser(guessoffset.__doc__)
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
-
-    fastqfile, = args
-    ai = iter_fastq(fastqfile)
-    rec = ai.next()
-    offset = 64
-    while rec:
-        quality = rec.quality
-        lowcounts = len([x for x in quality if x < 59])
-        highcounts = len([x for x in quality if x > 74])
-        diff = highcounts - lowcounts
-        if diff > 10:
-            break
-        elif diff < -10:
-            offset = 33
-            break
-        rec = ai.next()
-
+    offset = guess_offset(args.i)
     if offset == 33:
-        print >> sys.stderr, "Sanger encoding (offset=33)"
+        print("Sanger encoding (offset=33)", file=sys.stderr)
     elif offset == 64:
-        print >> sys.stderr, "Illumina encoding (offset=64)"
+        print("Illumina encoding (offset=64)", file=sys.stderr)
 
     return offset
 
+def guess_offset(fastqfile):
+    """
+    Guess the quality offset (33 or 64) from the quality chars below 59 and
+    above 74, reading batch by batch until one side clearly dominates.
+    """
+    for batch in iter_fastq_batches(fastqfile):
+        quals = batch.buf[batch.qual_mask()]
+        diff = int((quals > 74).sum()) - int((quals < 59).sum())
+        if diff > 10:
+            return 64
+        elif diff < -10:
+            return 33
+    return 64
+
 def format(args):
     """
     %prog format fastqfile
@@ -668,35 +1019,30 @@ def some(args):
         if bfastq:
             brec = bi.next()
 
-def trim(args):
-    """
-    %prog trim fastqfile
-
-    Wraps `fastx_trimmer` to trim from begin or end of reads.
-    """
-    p = OptionParser(trim.__doc__)
-    sp1.add_argument("-f", dest="first", default=0, type="int",
-            help="First base to keep. Default is 1.")
-    sp1.add_argument("-l", dest="last", default=0, type="int",
-            help="Last base to keep. Default is entire read.")
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
-
-    fastqfile, = args
+def trimmed_name(fastqfile):
     obfastqfile = op.basename(fastqfile)
     fq = obfastqfile.rsplit(".", 1)[0] + ".ntrimmed.fastq"
     if fastqfile.endswith(".gz"):
         fq = obfastqfile.rsplit(".", 2)[0] + ".ntrimmed.fastq.gz"
+    return fq
 
-    cmd = "fastx_trimmer -Q33 "
-    if args.first:
-        cmd += "-f {0.first} ".format(opts)
-    if args.last:
-        cmd += "-l {0.last} ".format(opts)
+def trim(args):
+    """
+    %prog trim fastqfile [fastqfile2]
 
-    sh(cmd, infile=fastqfile, outfile=fq)
+    Trim and filter single, paired or interleaved reads by quality, with
+    `ReadTrimmer` on batches of reads.
+    """
+    r1, r2 = args.r1, args.r2
+    offset = args.offset or guess_offset(r1)
+    trimmer = ReadTrimmer(offset=offset, first=args.first, last=args.last,
+                window=args.window, winqual=args.winqual,
+                minmean=args.minmean, minqual=args.minqual, pct=args.pct,
+                maxn=args.maxn, minlen=args.minlen)
+    o1 = trimmed_name(r1)
+    o2 = trimmed_name(r2) if r2 else None
+    trim_reads(r1, r2, o1, o2, trimmer, interleaved=args.interleaved,
+               cpus=args.cpus)
 
 def catread(args):
     """
@@ -730,41 +1076,34 @@ def splitread(args):
 
     Split fastqfile into two read fastqfiles, cut in the middle.
     """
-    p = OptionParser(splitread.__doc__)
-    sp1.add_argument("-n", dest="n", default=76, type="int",
-            help="Split at N-th base position [default: %default]")
-    sp1.add_argument("--rc", default=False, action="store_true",
-            help="Reverse complement second read [default: %default]")
-    opts, args = p.parse_args(args)
-
-    if len(args) != 1:
-        sys.exit(not p.print_help())
-
-    pairsfastq, = args
+    pairsfastq = args.i
 
     base = op.basename(pairsfastq).split(".")[0]
     fq1 = base + ".1.fastq"
     fq2 = base + ".2.fastq"
-    fw1 = must_open(fq1, "w")
-    fw2 = must_open(fq2, "w")
+    fw1 = open_fastq(fq1, "w")
+    fw2 = open_fastq(fq2, "w")
 
-    fp = must_open(pairsfastq)
     n = args.n
     minsize = n * 8 / 5
-
-    for name, seq, qual in FastqGeneralIterator(fp):
-        if len(seq) < minsize:
-            logging.error("Skipping read {0}, length={1}".format(name, len(seq)))
-            continue
-
-        name = "@" + name
-        rec1 = FastqLite(name, seq[:n], qual[:n])
-        rec2 = FastqLite(name, seq[n:], qual[n:])
+    comp = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+
+    for batch in iter_fastq_batches(pairsfastq):
+        short = batch.lengths < minsize
+        for i in np.flatnonzero(short).tolist():
+            logging.error("Skipping read {0}, length={1}".\
+                    format(batch.headers()[i].decode(), batch.lengths[i]))
+        batch = batch[~short]
+        L = batch.lengths
+        zero, cut = np.zeros_like(L), np.minimum(L, n)
+        fw1.write(b"".join(format_trimmed(batch, zero, cut)))
+        rec2 = format_trimmed(batch, cut, L)
         if args.rc:
-            rec2.rc()
-
-        print >> fw1, rec1
-        print >> fw2, rec2
+            for i, rec in enumerate(rec2):
+                name, seq, plus, qual, _ = rec.split(b"\n")
+                rec2[i] = b"\n".join((name, seq.translate(comp)[::-1], plus,
+                                      qual[::-1], b""))
+        fw2.write(b"".join(rec2))
 
     logging.debug("Reads split into `{0},{1}`".format(fq1, fq2))
     fw1.close()
@@ -814,7 +1153,7 @@ def convert(args):
         sys.exit(not p.print_help())
 
     infastq, = args
-    phred = args.phred or str(guessoffset([infastq]))
+    phred = args.phred or str(guess_offset(infastq))
     ophred = {"64": "33", "33": "64"}[phred]
 
     gz = infastq.endswith(".gz")
@@ -1040,46 +1379,131 @@ def read_fastq(filename, iterator):
             raise line.error("End of input before sequence was complete:")
 
 def breakread(args):
-    fhi = must_open(args.fi)
-    fo1 = "%s_1.fq.gz" % fo
-    fo2 = "%s_2.fq.gz" % fo
-    fho1 = gzip.open(fo1, "wb")
-    fho2 = gzip.open(fo2, "wb")
-
-    for (seqid, seq, qual) in read_fastq(args.fi, fhi):
-        assert len(seq) == readlen * 2 and len(qual) == readlen * 2, \
-                "%s: seq[%d] qual[%d] not %d" % \
-                (seqid, len(seq), len(qual), readlen)
-        eles = seqid.split(" ")
-        if len(eles) > 2: seqid = " ".join(eles[0:2])
-        seq1, seq2 = seq[0:readlen], seq[readlen:readlen*2]
-        qual1, qual2 = qual[0:readlen], qual[readlen:readlen*2]
-        fho1.write(("@%s\n%s\n+\n%s\n" % (seqid, seq1, qual1)).encode('utf8'))
-        fho2.write(("@%s\n%s\n+\n%s\n" % (seqid, seq2, qual2)).encode('utf8'))
+    readlen = args.readlen
+    fo1 = "%s_1.fq.gz" % args.fo
+    fo2 = "%s_2.fq.gz" % args.fo
+    fho1 = open_fastq(fo1, "w")
+    fho2 = open_fastq(fo2, "w")
+
+    for batch in iter_fastq_batches(args.fi):
+        bad = (batch.lengths != readlen * 2)
+        if bad.any():
+            i = int(np.argmax(bad))
+            raise Error("%s: seq[%d] not %d" % (batch.headers()[i].decode(),
+                        batch.lengths[i], readlen * 2))
+        out1, out2 = [], []
+        for header, seq, qual in batch:
+            eles = bytes(header).split(b" ")
+            seqid = b" ".join(eles[0:2])
+            out1.append(b"@%s\n%s\n+\n%s\n" % (seqid, seq[:readlen], qual[:readlen]))
+            out2.append(b"@%s\n%s\n+\n%s\n" % (seqid, seq[readlen:], qual[readlen:]))
+        fho1.write(b"".join(out1))
+        fho2.write(b"".join(out2))
+    fho1.close()
+    fho2.close()
+
+BASE2 = np.full(256, 255, dtype=np.uint8)
+for i, c in enumerate(b"ACGT"):
+    BASE2[c] = BASE2[c + 32] = i
+
+def pack_umis(umis):
+    """
+    2-bit pack UMIs of up to 31 nt into uint64, behind a leading 1 bit that
+    keeps the length. Returns the codes and a mask of the packed UMIs, those
+    with other chars than ACGT or longer are left out.
+
+    >>> codes, ok = pack_umis([b"ACGT", b"TTN", b"A"])
+    >>> ok.tolist(), [unpack_umi(x) for x in codes[ok].tolist()]
+    ([True, False, True], ['ACGT', 'A'])
+    """
+    n = len(umis)
+    codes = np.zeros(n, dtype=np.uint64)
+    ok = np.zeros(n, dtype=bool)
+    lens = np.fromiter(map(len, umis), dtype=np.int64, count=n)
+    for L in np.unique(lens).tolist():
+        if not 0 < L <= 31:
+            continue
+        idx = np.flatnonzero(lens == L)
+        arr = np.frombuffer(b"".join([umis[i] for i in idx.tolist()]),
+                            dtype=np.uint8).reshape(-1, L)
+        v = BASE2[arr]
+        code = np.ones(len(idx), dtype=np.uint64)
+        for j in range(L):
+            code = (code << np.uint64(2)) | v[:, j].astype(np.uint64)
+        codes[idx] = code
+        ok[idx] = (v != 255).all(axis=1)
+    return codes, ok
+
+def unpack_umi(code):
+    L = (code.bit_length() - 1) // 2
+    return "".join("ACGT"[(code >> (2 * (L - 1 - j))) & 3] for j in range(L))
 
 def UMIcount(args):
     """
     %prog UMIcount fastqfile
 
     Report number of occurances of each unique UMI
+
+    UMIs are 2-bit packed into integers and counted exactly in sorted runs,
+    sharded by hash prefix over `--cpus` processes (UMIs that do not pack,
+    e.g. with N's, are counted on the side). With `--approx` counts go into
+    a count-min sketch with a HyperLogLog for the number of distinct UMIs,
+    and only the `--top` most frequent UMIs are reported.
     """
-    fhi = must_open(args.fi)
-    if args.fi.endswith(".gz"):
-        fhi = gzip.open(args.fi, "r")
-
-    ud = dict()
-    for (seqid, seq, qual) in read_fastq(args.fi, fhi):
-        umi = seqid.split(" ")[1].split("+")[1]
-        if umi in ud:
-            ud[umi] += 1
+    from maize.utils.sketch import CountMinSketch, HyperLogLog, \
+            SortedRunCounter, ShardPool, hash_bytes, log_memory
+
+    if args.approx:
+        cms = CountMinSketch(width=args.width)
+        hll = HyperLogLog()
+        top = {}
+    else:
+        pool = ShardPool(SortedRunCounter, cpus=args.cpus)
+        other = Counter()
+
+    for batch in iter_fastq_batches(args.fi):
+        umis = [x.split(b" ")[1].split(b"+")[1] for x in batch.headers()]
+        if args.approx:
+            keys = hash_bytes(umis)
+            cms.add(keys)
+            hll.add(keys)
+            uniq, first = np.unique(keys, return_index=True)
+            for k, i in zip(uniq.tolist(), first.tolist()):
+                top.setdefault(k, umis[i])
+            if len(top) > 2 * args.top:
+                cand = np.array(list(top.keys()), dtype=np.uint64)
+                est = cms.estimate(cand)
+                keep = set(cand[np.argsort(-est, kind="stable")[:args.top]].tolist())
+                top = dict((k, v) for k, v in top.items() if k in keep)
         else:
-            ud[umi] = 1
+            codes, ok = pack_umis(umis)
+            pool.call("add", codes[ok])
+            if not ok.all():
+                other.update(umis[i] for i in np.flatnonzero(~ok).tolist())
 
     fho = must_open(args.fo, 'w')
-    for umi, cnt in ud.items():
-        fho.write("%s\t%s\n" % (umi, cnt))
-
-    logging.debug("{} UMIs detected".format(len(ud)))
+    if args.approx:
+        cand = np.array(list(top.keys()), dtype=np.uint64)
+        est = cms.estimate(cand)
+        order = np.argsort(-est, kind="stable")[:args.top]
+        for k, cnt in zip(cand[order].tolist(), est[order].tolist()):
+            fho.write("%s\t%s\n" % (top[k].decode(), cnt))
+        nd = hll.estimate()
+        logging.debug("About {} UMIs detected".format(nd))
+        log_memory("UMIcount", cms.nbytes + hll.nbytes)
+    else:
+        nd = len(other)
+        nbytes = sum(pool.each("nbytes"))
+        for codes, counts in pool.each("items"):
+            nd += len(codes)
+            for code, cnt in zip(codes.tolist(), counts.tolist()):
+                fho.write("%s\t%s\n" % (unpack_umi(code), cnt))
+        for umi, cnt in other.items():
+            fho.write("%s\t%s\n" % (umi.decode(), cnt))
+        pool.close()
+        logging.debug("{} UMIs detected".format(nd))
+        log_memory("UMIcount", nbytes)
+    fho.close()
 
 def main():
     import argparse
@@ -1099,6 +1523,14 @@ def main():
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     sp1.add_argument('fi', help = 'input file (*.fastq or *.fastq.gz)')
     sp1.add_argument('fo', help = 'output table of UMI occurances (*.tsv)')
+    sp1.add_argument('--approx', action = 'store_true',
+            help = 'approximate counts in a count-min sketch of fixed size')
+    sp1.add_argument('--top', type = int, default = 1000,
+            help = 'number of most frequent UMIs to report with --approx')
+    sp1.add_argument('--width', type = int, default = 1 << 23,
+            help = 'counters per sketch row (power of 2) with --approx')
+    sp1.add_argument('--cpus', type = int, default = 1,
+            help = 'number of processes (hash-prefix shards) for exact counts')
     sp1.set_defaults(func = UMIcount)
 
     sp1 = sp.add_parser('size', help='total base pairs in the fastq files',
@@ -1118,7 +1550,11 @@ def main():
 
     sp1 = sp.add_parser('splitread', help='split appended reads (from JGI)',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('i', help = 'input file (*.fastq or *.fastq.gz)')
+    sp1.add_argument("-n", dest="n", default=76, type=int,
+            help="Split at N-th base position")
+    sp1.add_argument("--rc", default=False, action="store_true",
+            help="Reverse complement second read")
     sp1.set_defaults(func = splitread)
 
     sp1 = sp.add_parser('catread', help='cat pairs together (reverse of splitread)',
@@ -1143,7 +1579,12 @@ def main():
 
     sp1 = sp.add_parser('filter', help='filter to get high qv reads',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('r1', help = 'read1 or interleaved fastq file')
+    sp1.add_argument('r2', nargs = '?', help = 'read2 fastq file')
+    sp1.add_argument("-q", dest="qv", default=20, type=int,
+                 help="Minimum quality score to keep")
+    sp1.add_argument("-p", dest="pct", default=95, type=int,
+                 help="Minimum percent of bases that have [-q] quality")
     sp1.set_defaults(func = filter)
 
     sp1 = sp.add_parser('suffix', help='filter reads based on suffix',
@@ -1151,9 +1592,34 @@ def main():
     sp1.add_argument('i', help = '')
     sp1.set_defaults(func = suffix)
 
-    sp1 = sp.add_parser('trim', help='trim reads using fastx_trimmer',
+    sp1 = sp.add_parser('trim', help='trim and filter reads by quality',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('r1', help = 'read1, single or interleaved fastq file')
+    sp1.add_argument('r2', nargs = '?', help = 'read2 fastq file')
+    sp1.add_argument("--interleaved", action="store_true",
+            help="r1 has interleaved pairs")
+    sp1.add_argument("-f", dest="first", default=1, type=int,
+            help="First base to keep")
+    sp1.add_argument("-l", dest="last", default=0, type=int,
+            help="Last base to keep, 0 for entire read")
+    sp1.add_argument("--window", default=0, type=int,
+            help="Sliding window size, 0 to disable window trimming")
+    sp1.add_argument("--winqual", default=20, type=int,
+            help="Cut at the first window with mean quality below this")
+    sp1.add_argument("--minmean", default=0, type=float,
+            help="Minimum mean quality of trimmed reads")
+    sp1.add_argument("-q", dest="minqual", default=0, type=int,
+            help="Quality cutoff for [-p]")
+    sp1.add_argument("-p", dest="pct", default=0, type=int,
+            help="Minimum percent of bases that have [-q] quality")
+    sp1.add_argument("--maxn", default=None, type=int,
+            help="Maximum number of N's in trimmed reads")
+    sp1.add_argument("--minlen", default=1, type=int,
+            help="Minimum length of trimmed reads")
+    sp1.add_argument("--offset", default=None, type=int, choices=(33, 64),
+            help="Quality offset, guessed from the reads if not given")
+    sp1.add_argument("--cpus", default=1, type=int,
+            help="Number of processes")
     sp1.set_defaults(func = trim)
 
     sp1 = sp.add_parser('some', help='select a subset of fastq reads',
@@ -1188,7 +1654,14 @@ def main():
 
     sp1 = sp.add_parser('uniq', help='retain only first instance of duplicate (by name) reads',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument('i', help = '')
+    sp1.add_argument('fi', help = 'input file (*.fastq or *.fastq.gz)')
+    sp1.add_argument('--outfile', default = 'stdout', help = 'output file')
+    sp1.add_argument('--approx', action = 'store_true',
+            help = 'keep read names in a count-min sketch of fixed size')
+    sp1.add_argument('--width', type = int, default = 1 << 23,
+            help = 'counters per sketch row (power of 2) with --approx')
+    sp1.add_argument('--cpus', type = int, default = 1,
+            help = 'number of processes (hash-prefix shards)')
     sp1.set_defaults(func = uniq)
 
     args = parser.parse_args()
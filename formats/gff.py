@@ -12,10 +12,11 @@ from urllib.parse import quote, unquote, parse_qsl
 
 from jcvi.utils.cbook import AutoVivification
 from jcvi.formats.base import DictFile, LineFile, must_open, is_number
+from jcvi.formats.tabix import is_bgzf_file
 from jcvi.utils.iter import flatten
 from jcvi.apps.base import mkdir, parse_multi_values, need_update, sh
 from jcvi.formats.bed import Bed, BedLine
-from jcvi.utils.natsort import natsorted
+from jcvi.utils.natsort import natsorted, seqid_ranks
 from jcvi.utils.range import range_minmax
 
 Valid_strands = ('+', '-', '?', '.')
@@ -310,6 +311,26 @@ class Gff (LineFile):
                         compute_signature=self.compute_signature, \
                         gff3=self.gff3)
 
+    def iter_region(self, seqid, start, end):
+        """
+        Iterate over the features overlapping seqid:start-end. A sorted BGZF
+        file is read only around the region, through its index.
+        """
+        if self.make_gff_store or not is_bgzf_file(self.filename):
+            for row in self:
+                if row.seqid == seqid and row.start <= end and row.end >= start:
+                    yield row
+            return
+
+        for row in self.fetch(seqid, start, end, preset="gff"):
+            yield GffLine(row, key=self.key, strict=self.strict, \
+                    append_source=self.append_source, \
+                    append_ftype=self.append_ftype,\
+                    score_attrib=self.score_attrib, \
+                    keep_attr_order=self.keep_attr_order, \
+                    compute_signature=self.compute_signature, \
+                    gff3=self.gff3)
+
     @property
     def seqids(self):
         return set(x.seqid for x in self)
@@ -447,7 +468,8 @@ def addparent(args):
                         (d.seqid, d.source, args.parentfeat, start, end,
                          ".", d.strand, ".", "ID={0};Name={0}".format(parent)))
         parents.append(GffLine(gffline))
-    parents.sort(key=lambda x: (x.seqid, x.start))
+    ranks = seqid_ranks.update(x.seqid for x in parents)
+    parents.sort(key=lambda x: (ranks[x.seqid], x.start))
     logging.debug("Merged feature sorted")
 
     fw = must_open(args.outfile, "w")
@@ -1687,7 +1709,8 @@ def import_feats(gffile, type="gene"):
         allgenes.append(g)
 
     logging.debug("A total of {0} {1} features imported.".format(len(allgenes), type))
-    allgenes.sort(key=lambda x: (x.seqid, x.start))
+    ranks = seqid_ranks.update(x.seqid for x in allgenes)
+    allgenes.sort(key=lambda x: (ranks[x.seqid], x.start))
     return allgenes
 
 def populate_children(outfile, ids, gffile, iter="2", types=None):
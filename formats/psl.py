@@ -170,21 +170,20 @@ class PslLine(object):
                 self.blockStarts))
         return line
 
+def _parse_psllines(lines):
+    # header lines do not start with a digit
+    return [PslLine(line) for line in lines if line and line[0].isdigit()]
+
 class Psl(LineFile):
 
     def __init__(self, filename=None):
         super(Psl, self).__init__(filename)
 
-        import re
-
         self.mCounts = {}   # dict to hold match counts
         if not filename:
             return
 
-        for line in must_open(filename):
-            if not re.match(r'\d+', line[0]):
-                continue
-            self.append(PslLine(line))
+        self.extend(_parse_psllines(must_open(filename)))
 
     def trackMatches(self, id):
         self.mCounts[id] = self.mCounts.get(id, 0) + 1
@@ -4,9 +4,13 @@
 import os
 import os.path as op
 import sys
+import re
 import logging
 import pysam
-import gc
+
+import numpy as np
+
+from itertools import chain, groupby, islice
 
 cigar_set = (['M','I','D','N','S','H','P','=','X'])
 
@@ -52,387 +56,691 @@ psl_empty_line = '0 0 0 0 0 0 0 0 + s 0 0 0 r 0 0 0 0 , , ,'.split()
 from jcvi.apps.base import sh, mkdir
 from jcvi.formats.base import must_open
 
-def sam2tsv(args):
-    sMatch, sMisMatch, sGapOpen, sGapExtend = 2, -3, -5, -2
-    sam = pysam.AlignmentFile(args.fi, "r")
-
-    print("qId\tqBeg\tqEnd\tqSrd\tqSize\ttId\ttBeg\ttEnd\ttSrd\ttSize\t" +
-            "alnLen\tmatch\tmisMatch\tbaseN\tqNumIns\ttNumIns\tqBaseIns\ttBaseIns\tident\tscore\t" +
-            "qLoc\ttLoc")
-    for x in sam.fetch():
-        if x.is_unmapped:
+# BAM op codes, in the order of `cigar_set`
+BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CREF_SKIP, BAM_CSOFT_CLIP, \
+        BAM_CHARD_CLIP, BAM_CPAD, BAM_CEQUAL, BAM_CDIFF = range(9)
+# ops moving along the query (clipped bases included) and the reference
+CIGAR_QUERY = np.array([1, 1, 0, 0, 1, 1, 0, 1, 1], dtype=bool)
+CIGAR_REF = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1], dtype=bool)
+# byte => op code / digit value, -1 for anything else
+CIGAR_CODES = np.full(256, -1, dtype=np.int64)
+for i, c in enumerate(b"MIDNSHP=X"):
+    CIGAR_CODES[c] = i
+for c in b"midnshpx":
+    CIGAR_CODES[c] = CIGAR_CODES[c - 32]
+CIGAR_DIGITS = np.full(256, -1, dtype=np.int64)
+CIGAR_DIGITS[ord("0"):ord("9") + 1] = np.arange(10)
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+CIGAR_FULL_RE = re.compile(r"(?:\d+[MIDNSHP=X])*")
+
+
+def parse_cigars(cigars):
+    """
+    Tokenize CIGAR strings in one table-driven pass over their concatenated
+    bytes. Returns the op codes (BAM order), the lengths, and the bounds of
+    each CIGAR in them, as int64 arrays; "*" has no ops.
+
+    >>> ops, lens, bounds = parse_cigars(["10M2I5M", "*", "3S120=1X"])
+    >>> ops.tolist(), lens.tolist(), bounds.tolist()
+    ([0, 1, 0, 4, 7, 8], [10, 2, 5, 3, 120, 1], [0, 3, 3, 6])
+    """
+    cigars = ["" if x == "*" else x for x in cigars]
+    buf = np.frombuffer("".join(cigars).encode(), dtype=np.uint8)
+    code, digit = CIGAR_CODES[buf], CIGAR_DIGITS[buf]
+    isop = code >= 0
+    oppos = np.flatnonzero(isop)
+    dpos = np.flatnonzero(~isop)
+    owner = np.searchsorted(oppos, dpos)
+    lead = np.r_[-1, oppos[:-1]]
+    if (digit[dpos] < 0).any() or (owner == len(oppos)).any() or \
+            (oppos - lead < 2).any():
+        bad = [x for x in cigars if not CIGAR_FULL_RE.fullmatch(x.upper())]
+        raise ValueError("unknown CIGAR: {0}".format(bad[0] if bad else cigars))
+    # digit values by their place before the op
+    place = oppos[owner] - dpos - 1
+    lens = np.bincount(owner, weights=digit[dpos] * 10.0 ** place,
+                       minlength=len(oppos))
+    ends = np.cumsum([len(x) for x in cigars], dtype=np.int64)
+    bounds = np.r_[0, np.searchsorted(oppos, ends)].astype(np.int64)
+    return code[oppos], np.rint(lens).astype(np.int64), bounds
+
+
+def _within(x, bounds):
+    """
+    Cumulative sums of `x` before each element, restarted at every segment
+    of `bounds`.
+
+    >>> _within(np.array([1, 2, 3, 4, 5]), np.array([0, 2, 2, 5])).tolist()
+    [0, 1, 0, 3, 7]
+    """
+    c = np.r_[0, np.cumsum(x)]
+    return c[:-1] - np.repeat(c[bounds[:-1]], np.diff(bounds))
+
+
+class CigarBatch (object):
+    """
+    CIGARs of a batch of alignments as flat arrays: the `ops` (BAM codes)
+    and `lens` of alignment i are at `bounds[i]:bounds[i + 1]`. `sums` and
+    `counts` hold the bases and the number of each op per alignment (n x 9).
+
+    Blocks are the M and = ops, or with `merge` the runs of M, = and X (as
+    in CIGAR 1.3); those of alignment i are at `bbounds[i]:bbounds[i + 1]` of
+    `bsizes`, `bqstarts` (0-based on the query, clipped bases counted) and
+    `btstarts` (0-based on the reference, from `tstarts`). `qpos` and
+    `tpos` are the same starts for every op.
+    """
+    def __init__(self, ops, lens, bounds, tstarts, merge=True):
+        n = len(bounds) - 1
+        nops = np.diff(bounds)
+        self.ops, self.lens, self.bounds = ops, lens, bounds
+        self.tstarts = tstarts = np.asarray(tstarts, dtype=np.int64)
+        aln = np.repeat(np.arange(n), nops)
+        key = aln * 9 + ops
+        self.counts = np.bincount(key, minlength=9 * n).reshape(n, 9)
+        self.sums = np.bincount(key, weights=lens, minlength=9 * n).\
+                        astype(np.int64).reshape(n, 9)
+
+        self.qpos = qpos = _within(np.where(CIGAR_QUERY[ops], lens, 0), bounds)
+        self.tpos = tpos = _within(np.where(CIGAR_REF[ops], lens, 0), bounds) + \
+                np.repeat(tstarts, nops)
+        isblock = (ops == BAM_CMATCH) | (ops == BAM_CEQUAL)
+        first = isblock
+        if merge:
+            isblock |= ops == BAM_CDIFF
+            prev = np.r_[False, isblock[:-1]]
+            prev[bounds[:-1][nops > 0]] = False
+            first = isblock & ~prev
+        run = np.cumsum(first)[isblock] - 1
+        self.bsizes = np.bincount(run, weights=lens[isblock],
+                                  minlength=first.sum()).astype(np.int64)
+        self.bqstarts = qpos[first]
+        self.btstarts = tpos[first]
+        self.bbounds = np.r_[0, np.cumsum(np.bincount(aln[first], minlength=n))]
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    @classmethod
+    def from_tuples(cls, cigars, tstarts, merge=True):
+        """
+        From a list of `cigartuples` (pysam), None for no CIGAR.
+        """
+        cigars = [x or () for x in cigars]
+        bounds = np.r_[0, np.cumsum([len(x) for x in cigars])].astype(np.int64)
+        flat = np.fromiter(chain.from_iterable(chain.from_iterable(cigars)),
+                           dtype=np.int64, count=2 * bounds[-1])
+        return cls(flat[0::2], flat[1::2], bounds, tstarts, merge=merge)
+
+    @classmethod
+    def from_strings(cls, cigars, tstarts, merge=True):
+        """
+        From a list of CIGAR strings, see `parse_cigars`.
+
+        >>> cb = CigarBatch.from_strings(["5S10=2X3=4D6M", "*"], [100, 0])
+        >>> cb.bsizes.tolist(), cb.bqstarts.tolist(), cb.btstarts.tolist()
+        ([15, 6], [5, 20], [100, 119])
+        >>> cb.bbounds.tolist()
+        [0, 2, 2]
+        """
+        ops, lens, bounds = parse_cigars(cigars)
+        return cls(ops, lens, bounds, tstarts, merge=merge)
+
+    def alignment(self, i):
+        """
+        Op codes, lengths, query and reference starts of alignment i, as
+        lists.
+        """
+        a, b = self.bounds[i], self.bounds[i + 1]
+        return self.ops[a:b].tolist(), self.lens[a:b].tolist(), \
+                self.qpos[a:b].tolist(), self.tpos[a:b].tolist()
+
+    def sum(self, ops):
+        return self.sums[:, list(ops)].sum(axis=1)
+
+    def count(self, ops):
+        return self.counts[:, list(ops)].sum(axis=1)
+
+
+def region_shards(bam, nreads=200000, nbases=10000000):
+    """
+    Split the references of an indexed BAM/CRAM into shards of about
+    `nreads` mapped reads, going by the index statistics, or of about
+    `nbases` when those are not available. Contigs are cut into equal
+    windows, and small ones grouped; each shard is a list of 0-based
+    half-open (contig, start, end) in file order.
+    """
+    try:
+        mapped = dict((x.contig, x.mapped) for x in bam.get_index_statistics())
+        target = nreads
+    except (ValueError, AttributeError, NotImplementedError):
+        mapped = None
+        target = nbases
+
+    shards, shard, load = [], [], 0
+    for name, size in zip(bam.references, bam.lengths):
+        weight = size if mapped is None else mapped.get(name, 0)
+        if not weight or not size:
             continue
-        tId, tBeg, tEnd, tSrd, tSize = x.reference_name, x.reference_start, x.reference_end, "+", x.reference_length
-        qId, qBeg, qEnd, qSrd, qSize = x.query_name, x.query_alignment_start, x.query_alignment_end, "+", x.query_length
-        tBeg += 1
-        qBeg += 1
-        if x.is_reverse: qSrd = "-"
-        if args.paired:
-            if x.is_read2:
-                qId += ".2"
-            else:
-                qId += ".1"
-        alnLen, match, misMatch, baseN, qLen = 0,0,0,0,0
-        qNumIns, tNumIns, qBaseIns, tBaseIns = 0,0,0,0
-        for op, nt in x.cigartuples:
-            if op == 0 or op == 7 or op == 8: # M=X
-                alnLen += nt
-                qLen += nt
-            elif op == 1: # I
-                qNumIns += 1
-                qBaseIns += nt
-                qLen += nt
-            elif op == 4: # S
-                qLen += nt
-            elif op == 2 or op == 3: # DN
-                tNumIns += 1
-                tBaseIns += nt
-            elif op == 5:
-                logging.error("hard clipping: %s -> %s:%d" % (qId, tId, tBeg))
-                sys.exit(1)
-        if x.has_tag("NM"):
-            misMatch = x.get_tag("NM")
-        match = alnLen - misMatch
-        if qSize == 0:
-            qSize = qLen
-        #assert qSize == qEnd, "error qSize: %d > %d" % (qSize, qEnd)
-
-        score_match = match * sMatch
-        score_misMatch = misMatch * sMisMatch
-        numIns = qNumIns + tNumIns
-        score_indel = 0
-        if numIns >= 1:
-            score_indel = sGapOpen + (numIns - 1) * sGapExtend
-        score = score_match + score_misMatch + score_indel
-        ident = match / (match + misMatch)
-
-        print("%s\t%d\t%d\t%s\t%d\t%s\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%.03f\t%d\t%s\t%s" %
-                (qId, qBeg, qEnd, qSrd, qSize,
-                 tId, tBeg, tEnd, tSrd, tSize,
-                 alnLen, match, misMatch, 0,
-                 qNumIns, tNumIns, qBaseIns, tBaseIns, ident, score, '', ''))
+        n = -(-weight // target)
+        step = -(-size // n)
+        for start in range(0, size, step):
+            shard.append((name, start, min(start + step, size)))
+            load += weight / n
+            if load >= target:
+                shards.append(shard)
+                shard, load = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def iter_alignments(bam, regions=None):
+    """
+    Mapped alignments of a whole file, in file order, or of `regions` as
+    from `region_shards`: those starting inside each, so that an alignment
+    across two windows comes out once.
+    """
+    if regions is None:
+        for x in bam.fetch(until_eof=True):
+            if not x.is_unmapped:
+                yield x
+        return
+    for contig, start, end in regions:
+        for x in bam.fetch(contig, start, end):
+            if x.reference_start >= start and not x.is_unmapped:
+                yield x
+
+
+def open_alignments(filename, reference=None):
+    """
+    SAM, BAM or CRAM (`reference` FASTA to decode it, if the header does
+    not point to one) as pysam.AlignmentFile; "-" reads stdin.
+    """
+    return pysam.AlignmentFile(filename, "r", reference_filename=reference)
+
+
+def _iter_text(bam, regions, formatter, batchsize=10000, **kwargs):
+    reads = iter_alignments(bam, regions)
+    while True:
+        batch = list(islice(reads, batchsize))
+        if not batch:
+            break
+        yield formatter(batch, bam, **kwargs)
 
-def count(args):
-    from math import ceil
-    winsize, min_qual = args.winsize, args.min_qual
-    cdic = dict()
-    bam = pysam.AlignmentFile(args.fi, "rb")
-    for aln in bam:
-        if aln.reference_id == -1:
-            seqid = 'unmapped'
-            beg = 1
-        else:
-            seqid = aln.reference_name
-            beg = aln.reference_start
-        mq = aln.mapping_quality
-        if seqid not in cdic:
-            cdic[seqid] = dict()
-        pbin = ceil(beg / winsize)
-        if pbin not in cdic[seqid]:
-            cdic[seqid][pbin] = [0, 0]
-        if mq >= min_qual:
-            cdic[seqid][pbin][0] += 1
-        else:
-            cdic[seqid][pbin][1] += 1
+
+def _convert_shard(regions, filename, formatter, reference=None, **kwargs):
+    bam = open_alignments(filename, reference=reference)
+    text = "".join(_iter_text(bam, regions, formatter, **kwargs))
+    bam.close()
+    return text
+
+
+def convert_alignments(filename, fw, formatter, cpus=1, reference=None,
+                       **kwargs):
+    """
+    Write `formatter(batch, bam, **kwargs)` over batches of the mapped
+    alignments of `filename` to `fw`, in file order. An indexed BAM/CRAM is
+    split by `region_shards` and the shards converted on `cpus` processes,
+    with a bounded queue of shards in flight; other input is streamed on
+    one process.
+    """
+    from collections import deque
+    from functools import partial
+
+    bam = open_alignments(filename, reference=reference)
+    indexed = filename != "-" and bam.has_index()
+    if cpus < 2 or not indexed:
+        if cpus > 1:
+            logging.debug("`{0}` not indexed, converted on one process".\
+                            format(filename))
+        for text in _iter_text(bam, None, formatter, **kwargs):
+            fw.write(text)
+        bam.close()
+        return
+
+    shards = region_shards(bam)
     bam.close()
+    logging.debug("{0} regions in {1} shards on {2} processes".\
+                    format(sum(len(x) for x in shards), len(shards), cpus))
 
-    for seqid, idic in sorted(cdic.items()):
-        for pbin, cnts in sorted(idic.items()):
-            cntstr = "\t".join([str(x) for x in cnts])
-            print("%s\t%d\t%s" % (seqid, pbin, cntstr))
-
-def parse_cigar(c,toversion="1.3"):
-    # parse CIGAR string
-    # TOVERSION: if set to "1.3" the CIGAR is converted forcefully to CIGAR defined
-    #          in SAM version 1.3 (i.e. neighbours "X" and "=" are joined and
-    #          converted into one region of "M") if CIGAR is given as version 1.4
-    #          If it is set to "1.4" no conversion to 1.3 is done!
-    r = []
-    d = ''
-    mismatches_x = 0
-    c = c.upper()
-    for a in c:
-        if a.isdigit():
-            d = d + a
-        elif a in cigar_set:
-            dd = int(d)
-            r.append((a,dd))
-            if a == 'X':
-                mismatches_x = mismatches_x + dd
-            d = ''
+    from concurrent.futures import ProcessPoolExecutor
+
+    work = partial(_convert_shard, filename=filename, formatter=formatter,
+                   reference=reference, **kwargs)
+    pending = deque()
+    with ProcessPoolExecutor(cpus) as pool:
+        for shard in shards:
+            pending.append(pool.submit(work, shard))
+            if len(pending) >= 2 * cpus:
+                fw.write(pending.popleft().result())
+        while pending:
+            fw.write(pending.popleft().result())
+
+
+def _strcol(a):
+    return [str(x) for x in a.tolist()]
+
+
+def _nm_tags(reads, fallback=None):
+    tags = []
+    for x in reads:
+        if x.has_tag("NM"):
+            tags.append(x.get_tag("NM"))
+        elif fallback and x.has_tag(fallback):
+            tags.append(x.get_tag(fallback))
         else:
-            print >>sys.stderr,"ERROR: unknown CIGAR:",c
-            sys.exit(1)
-    if mismatches_x and toversion == '1.3':
-        rr = []
-        i = -1
-        n = len(r)
-        while True:
-            i = i + 1
-            if i == n:
-                r = rr
-                break
-            elif r[i][0] in ('X', '=', 'M'):
-                b = r[i][1]
-                for j in xrange(i+1,n):
-                    if r[j][0] in ('=','M','X'):
-                        b = b + r[j][1]
-                    else:
-                        i = j - 1
-                        break
-                rr.append(('M',b))
-            else:
-                rr.append(r[i])
-    return (r,mismatches_x)
-
-def blocks(cigar, ig = 0, use_cigar_13 = True):
-    # returns block of matches
-    # input is from cigar()
-    # NOTE: hard clipping is converted forecfully to soft clipping
-    ir = 0 # index on read
-    #ig = 0 # index on genome
-    rr = [] # on read
-    rg = [] # on genome
-    match = 0
-    mismatch = 0
-    mismatch_x = 0
-    mismatch_clip = 0
-    insert_query = 0
-    insert_query_count = 0
-    insert_ref = 0
-    insert_ref_count = 0
-    seq_len = 0 # Sum of lengths of the M/I/S/=/X operations shall equal the length of SEQ
-    #print >>sys.stderr,'cigar:',cigar
-    (cig,mismatch_x) = parse_cigar(cigar, toversion = "1.3" if use_cigar_13 else "all")
-    mismatch = mismatch_x
-    #print >>sys.stderr,"parsed cigar:",cig
-    for e in cig:
-        if e[0] in ('S','H'):
-            ir = ir + e[1] # read
-            mismatch = mismatch + e[1]
-            mismatch_clip = mismatch_clip + e[1]
-            seq_len = seq_len + e[1]
-        elif e[0] in ('I',):
-            ir = ir + e[1] # read
-            mismatch = mismatch + e[1]
-            insert_query = insert_query + e[1]
-            insert_query_count = insert_query_count + 1
-            seq_len = seq_len + e[1]
-        elif e[0] in ('X'):
-            ir = ir + e[1] # read
-            ig = ig + e[1] # reference/target seq
-            mismatch = mismatch + e[1]
-            mismatch_x = mismatch_x + e[1]
-            seq_len = seq_len + e[1]
-        elif e[0] in ('M','='):
-            rr.append((ir,ir+e[1])) # read
-            rg.append((ig,ig+e[1])) # reference/target seq
-            ir = ir + e[1] # read
-            ig = ig + e[1] # reference/target seq
-            match = match + e[1]
-            seq_len = seq_len + e[1]
-        elif e[0] in ('D','N','P'):
-            ig = ig + e[1] # reference/target seq
-            insert_ref = insert_ref + e[1]
-            insert_ref_count = insert_ref_count + 1
-    #print >>sys.stderr,"cigar: query:",rr
-    #print >>sys.stderr,"cigar: ref:",rg
-    #print >>sys.stderr,"cigar: match:",match
-    #print >>sys.stderr,"cigar: mismatch:",mismatch
-    #print >>sys.stderr,"cigar: mismatch_clip:",mismatch_clip
-    #print >>sys.stderr,"cigar: mismatch_x:",mismatch_x
-    return (rr,rg,match,mismatch,mismatch_clip,mismatch_x,insert_ref,insert_ref_count,insert_query,insert_query_count,seq_len)
-
-def get_psl(sam, lens, use_cigar_13=True , replace_string = '', read_sequence=False):
-    # USE_CIGAR_13 - If True then the input CIGAR string is in format 1.4 then it will be converted into format 1.3
-    #cig, qSize, tSize, tStart, strand):
-    # returns PSL coordinates
-    # input from blocks()
-    #
-    #  12. qStart - Alignment start position in query
-    #  13. qEnd - Alignment end position in query
-    #  18. blockCount - Number of blocks in the alignment (a block contains no gaps)
-    #  19. blockSizes - Comma-separated list of sizes of each block
-    #  20. qStarts - Comma-separated list of starting positions of each block in query
-    #  15. tSize - Target sequence size
-    #  16. tStart - Alignment start position in target
-    #  17. tEnd - Alignment end position in target
-    #  21. tStarts - Comma-separated list of starting positions of each block in target
-
-    psl = None
-    if sam and sam[sam_FLAG].isdigit():
-        sam_flag = int(sam[sam_FLAG])
-        unmapped = True if int(sam[sam_FLAG]) & 0x4  else False
-        if (not unmapped) and sam[sam_RNAME] != '*' and sam[sam_CIGAR] != '*' and sam[sam_QNAME] != '*':
-            psl = psl_empty_line[:]
-
-            # read sequence length
-            psl[psl_tSize] = lens.get(sam[sam_RNAME],0)
-            # reference name
-            psl[psl_tName] = sam[sam_RNAME]
-            # read name
-            rname = sam[sam_QNAME].replace(replace_string,'/',1) if replace_string else sam[sam_QNAME]
-            psl[psl_qName] = rname
-            if (sam_flag & 0x1) and  (sam_flag & 0x40):
-                psl[psl_qName] = rname + ".1"
-            if (sam_flag & 0x1) and  (sam_flag & 0x80):
-                psl[psl_qName] = rname + ".2"
-
-            # strand
-            psl[psl_strand] = "-" if int(sam[sam_FLAG]) & 0x10  else '+'
-
-            # start position
-            psl[psl_tStart] = int(sam[sam_POS])-1
-
-            (interval_query,interval_ref, match, mismatch, mismatch_clip, mismatch_x,insert_ref,insert_ref_count,insert_query,insert_query_count,seq_len) = blocks(sam[sam_CIGAR], ig = psl[psl_tStart], use_cigar_13 = use_cigar_13)
-
-            # read sequence length
-            if sam[sam_SEQ] != '*' and sam[sam_CIGAR].find('H') == -1:
-                psl[psl_qSize] = len(sam[sam_SEQ])
-            else:
-                # • Sum of lengths of the M/I/S/=/X operations shall equal the length of SEQ
-                psl[psl_qSize] = seq_len
-
-            #
-            psl[psl_qNumInsert] = insert_query_count
-            psl[psl_qBaseInsert] = insert_query
-            psl[psl_tNumInsert] = insert_ref_count
-            psl[psl_tBaseInsert] = insert_ref
-
-            # extract the mismatches from SAM (using tag NM:i)
-            tag_nm_i = [e.partition("NM:i:")[2] for e in sam[sam_TAG:] if e.startswith('NM:i:')] # NM is mismatches per reads
-            if not tag_nm_i:
-                tag_nm_i = [e.partition("nM:i:")[2] for e in sam[sam_TAG:] if e.startswith('nM:i:')] # nM is not good because but is better than nothing because it is mismatches per fragment and not per read!
-            tag_nm_i = int(tag_nm_i[0]) if tag_nm_i else 0
-            #if tag_nm_i > float(0.90)*seq_len:
-            #    tag_nm_i = 0
-            #print >>sys.stderr,"tag NM:i:",tag_nm_i
-
-            # compute the matches and mismatches (include also the clipping as mismatches)
-            mis = mismatch_clip + tag_nm_i
-            #print >>sys.stderr,"mismatch_clip + tag_nm_i =",mis
-            if mis >= mismatch:
-                psl[psl_matches] = psl[psl_qSize] - mis
-                psl[psl_misMatches] = mis
-            else: # probably the tag NM:i are missing???!!!
-                psl[psl_matches] = match
-                psl[psl_misMatches] = mismatch
-            alnsize = sum([e[1]-e[0] for e in interval_query])
-            assert alnsize == match, 'alnsize error'
-            assert mismatch == mismatch_clip + insert_query, 'q-insert error'
-            assert psl[psl_qSize] == match + mismatch_clip + insert_query
-            psl[psl_misMatches] = tag_nm_i - insert_query - insert_ref
-            psl[psl_matches] = alnsize - psl[psl_misMatches]
-            
-            #print("------")
-            if interval_query:
-                #psl[tStart] = boxes[0][1][0]
-                psl[psl_tEnd] = interval_ref[-1][1]
-                psl[psl_blockCount] = len(interval_query)
-                #for i in range(psl[psl_blockCount]):
-                #    print("%10d-%10d [%10d]: %10d-%10d [%10d]" % (interval_query[i][0], interval_query[i][1], interval_query[i][1]-interval_query[i][0], interval_ref[i][0], interval_ref[i][1], interval_ref[i][1]-interval_ref[i][0]))
-
-                # this is how is the specification BUT BLAT does not follow the specification!!!
-                # NOTE: BLAT _always_ gives the coordinates as everything is mapped on the forwward strand
-                # even that it is mapped on the reverse strand
-                #
-                if psl[psl_strand] == "+":
-                    psl[psl_qStart] = interval_query[0][0]
-                    psl[psl_qEnd] = interval_query[-1][1]
-                #    psl[psl_blockSizes] = ','.join([str(e[1]-e[0]) for e in interval_query])+','
-                #    psl[psl_qStarts] = ','.join([str(e[0]) for e in interval_query])+','
-                #    psl[psl_tStarts] = ','.join([str(e[0]) for e in interval_ref])+','
-                elif psl[psl_strand] == "-":
-                    psl[psl_qStart] = psl[psl_qSize] - interval_query[-1][1]
-                    psl[psl_qEnd] = psl[psl_qSize] - interval_query[0][0]
-                #    psl[psl_blockSizes] = ','.join([str(e[1]-e[0]) for e in interval_query[::-1]])+','
-                #    psl[psl_qStarts] = ','.join([str(psl[psl_qSize]-e[1]) for e in interval_query[::-1]])+','
-                #    psl[psl_tStarts] = ','.join([str(psl[psl_tSize]-e[0]-1) for e in interval_ref[::-1]])+','
-
-                psl[psl_blockSizes] = ','.join([str(e[1]-e[0]) for e in interval_query])+','
-                psl[psl_qStarts] = ','.join([str(e[0]) for e in interval_query])+','
-                psl[psl_tStarts] = ','.join([str(e[0]) for e in interval_ref])+','
-
-            if read_sequence:
-                if len(psl) < psl_seq + 1:
-                    psl.append(sam[sam_SEQ])
-
-            psl = map(str,psl)
-
-    return psl
-
-def getlines(a_filename):
-    # it gives chunks
-    fin = None
-    if a_filename == '-':
-        fin = sys.stdin
+            tags.append(0)
+    return np.array(tags, dtype=np.int64)
+
+
+def tsv_lines(reads, bam, paired=False, sMatch=2, sMisMatch=-3, sGapOpen=-5,
+              sGapExtend=-2):
+    """
+    Tab-separated alignment summary of a batch of reads, see `sam2tsv`.
+    """
+    cb = CigarBatch.from_strings([x.cigarstring or '*' for x in reads],
+                                 [x.reference_start for x in reads])
+    hard = np.flatnonzero(cb.counts[:, BAM_CHARD_CLIP])
+    if len(hard):
+        x = reads[hard[0]]
+        raise ValueError("hard clipping: %s -> %s:%d" % \
+                (x.query_name, x.reference_name, x.reference_start + 1))
+
+    qIds, qSrds, tIds = [], [], []
+    for x in reads:
+        qId = x.query_name
+        if paired:
+            qId += ".2" if x.is_read2 else ".1"
+        qIds.append(qId)
+        qSrds.append("-" if x.is_reverse else "+")
+        tIds.append(x.reference_name)
+    tBeg = np.array([x.reference_start for x in reads]) + 1
+    tEnd = np.array([x.reference_end for x in reads])
+    qBeg = np.array([x.query_alignment_start for x in reads]) + 1
+    qEnd = np.array([x.query_alignment_end for x in reads])
+    qSize = np.array([x.query_length for x in reads])
+    qSize = np.where(qSize == 0, cb.sum((BAM_CMATCH, BAM_CINS, BAM_CSOFT_CLIP,
+                                         BAM_CEQUAL, BAM_CDIFF)), qSize)
+
+    alnLen = cb.sum((BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF))
+    misMatch = _nm_tags(reads)
+    match = alnLen - misMatch
+    qNumIns, qBaseIns = cb.counts[:, BAM_CINS], cb.sums[:, BAM_CINS]
+    tNumIns = cb.count((BAM_CDEL, BAM_CREF_SKIP))
+    tBaseIns = cb.sum((BAM_CDEL, BAM_CREF_SKIP))
+    numIns = qNumIns + tNumIns
+    score = match * sMatch + misMatch * sMisMatch + \
+            np.where(numIns >= 1, sGapOpen + (numIns - 1) * sGapExtend, 0)
+    total = match + misMatch
+    ident = np.divide(match, total, out=np.zeros(len(reads)), where=total != 0)
+
+    n = len(reads)
+    cols = [qIds, _strcol(qBeg), _strcol(qEnd), qSrds, _strcol(qSize),
+            tIds, _strcol(tBeg), _strcol(tEnd), ["+"] * n, _strcol(tEnd - tBeg + 1),
+            _strcol(alnLen), _strcol(match), _strcol(misMatch), ["0"] * n,
+            _strcol(qNumIns), _strcol(tNumIns), _strcol(qBaseIns),
+            _strcol(tBaseIns), ["%.03f" % x for x in ident.tolist()],
+            _strcol(score), [""] * n, [""] * n]
+    return "".join("\t".join(x) + "\n" for x in zip(*cols))
+
+
+def psl_rows(cb, flags, qnames, rnames, tsizes, qlens, nms, seqs=None,
+             use_cigar_13=True, replace_string=''):
+    """
+    PSL fields (lists of str) of a batch of alignments: their CIGARs in
+    `cb` (a CigarBatch, with merge=use_cigar_13), SAM flags, query and
+    reference names, reference sizes, lengths of SEQ (0 if absent), NM
+    tags and, to add as column 22, SEQ.
+
+    BLAT style, query coordinates of the blocks stay on the forward strand
+    of the query, while qStart and qEnd follow the strand. Mismatches are
+    the NM tag less the inserted bases.
+    """
+    flags = np.asarray(flags, dtype=np.int64)
+    seq_len = cb.sum((BAM_CMATCH, BAM_CINS, BAM_CSOFT_CLIP, BAM_CHARD_CLIP,
+                      BAM_CEQUAL, BAM_CDIFF))
+    qlens = np.asarray(qlens, dtype=np.int64)
+    qSize = np.where((qlens > 0) & (cb.counts[:, BAM_CHARD_CLIP] == 0),
+                     qlens, seq_len)
+    qNumInsert, qBaseInsert = cb.counts[:, BAM_CINS], cb.sums[:, BAM_CINS]
+    tNumInsert = cb.count((BAM_CDEL, BAM_CREF_SKIP, BAM_CPAD))
+    tBaseInsert = cb.sum((BAM_CDEL, BAM_CREF_SKIP, BAM_CPAD))
+    alnsize = cb.sum((BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF) if use_cigar_13
+                     else (BAM_CMATCH, BAM_CEQUAL))
+    misMatches = np.asarray(nms, dtype=np.int64) - qBaseInsert - tBaseInsert
+    matches = alnsize - misMatches
+
+    sizes, qstarts, tstarts = cb.bsizes.tolist(), cb.bqstarts.tolist(), \
+                                cb.btstarts.tolist()
+    bsizes, bqstarts, btstarts = [[str(v) for v in x] for x in
+                                  (sizes, qstarts, tstarts)]
+    bb = cb.bbounds.tolist()
+    qsizes = qSize.tolist()
+    tbegs = cb.tstarts.tolist()
+    nums = np.column_stack((matches, misMatches, qNumInsert, qBaseInsert,
+                            tNumInsert, tBaseInsert)).tolist()
+    paired = (flags & 0x1) > 0
+    suffix = np.where(paired & ((flags & 0x80) > 0), ".2",
+                      np.where(paired & ((flags & 0x40) > 0), ".1", "")).tolist()
+    strands = np.where((flags & 0x10) > 0, "-", "+").tolist()
+
+    rows = []
+    for i, rname in enumerate(qnames):
+        if replace_string:
+            rname = rname.replace(replace_string, '/', 1)
+        strand = strands[i]
+        a, b = bb[i], bb[i + 1]
+        qStart = qEnd = tEnd = 0
+        if b > a:
+            tEnd = tstarts[b - 1] + sizes[b - 1]
+            qStart, qEnd = qstarts[a], qstarts[b - 1] + sizes[b - 1]
+            if strand == "-":
+                qStart, qEnd = qsizes[i] - qEnd, qsizes[i] - qStart
+        psl = [str(v) for v in nums[i]]
+        psl[2:2] = ["0", "0"]
+        psl += [strand, rname + suffix[i], str(qsizes[i]), str(qStart),
+                str(qEnd), rnames[i], str(tsizes[i]), str(tbegs[i]), str(tEnd),
+                str(b - a), ",".join(bsizes[a:b]) + ",",
+                ",".join(bqstarts[a:b]) + ",", ",".join(btstarts[a:b]) + ","]
+        if seqs is not None:
+            psl.append(seqs[i])
+        rows.append(psl)
+    return rows
+
+
+def psl_lines(reads, bam, use_cigar_13=True, replace_string='',
+              read_sequence=False):
+    """
+    PSL lines of a batch of reads (pysam), see `sam2psl`.
+    """
+    reads = [x for x in reads if x.reference_id >= 0 and x.cigartuples
+                                  and x.query_name != '*']
+    cb = CigarBatch.from_strings([x.cigarstring for x in reads],
+                                 [x.reference_start for x in reads],
+                                 merge=use_cigar_13)
+    lengths = bam.lengths
+    seqs = [x.query_sequence or '*' for x in reads] if read_sequence else None
+    rows = psl_rows(cb, [x.flag for x in reads],
+                    [x.query_name for x in reads],
+                    [x.reference_name for x in reads],
+                    [lengths[x.reference_id] for x in reads],
+                    [x.query_length for x in reads],
+                    _nm_tags(reads, fallback="nM"), seqs=seqs,
+                    use_cigar_13=use_cigar_13, replace_string=replace_string)
+    return "".join("\t".join(x) + "\n" for x in rows)
+
+
+def _text_nm(tags):
+    for tag in ("NM:i:", "nM:i:"):
+        for e in tags:
+            if e.startswith(tag):
+                return int(e[5:])
+    return 0
+
+
+def sam_psl_rows(sams, lens, use_cigar_13=True, replace_string='',
+                 read_sequence=False):
+    """
+    PSL fields of SAM lines split on tabs; `lens` maps reference names to
+    sizes. Unmapped lines and those without CIGAR are left out.
+    """
+    sams = [x for x in sams if x[sam_FLAG].isdigit()
+                and not int(x[sam_FLAG]) & 0x4 and x[sam_RNAME] != '*'
+                and x[sam_CIGAR] != '*' and x[sam_QNAME] != '*']
+    cb = CigarBatch.from_strings([x[sam_CIGAR] for x in sams],
+                                 [int(x[sam_POS]) - 1 for x in sams],
+                                 merge=use_cigar_13)
+    seqs = [x[sam_SEQ] for x in sams] if read_sequence else None
+    return psl_rows(cb, [int(x[sam_FLAG]) for x in sams],
+                    [x[sam_QNAME] for x in sams],
+                    [x[sam_RNAME] for x in sams],
+                    [lens.get(x[sam_RNAME], 0) for x in sams],
+                    [0 if x[sam_SEQ] == '*' else len(x[sam_SEQ]) for x in sams],
+                    [_text_nm(x[sam_TAG:]) for x in sams], seqs=seqs,
+                    use_cigar_13=use_cigar_13, replace_string=replace_string)
+
+
+def get_psl(sam, lens, use_cigar_13=True, replace_string='',
+            read_sequence=False):
+    """
+    PSL fields of one SAM line split on tabs, None if it is not aligned.
+    Batches of lines go faster through `sam_psl_rows`.
+    """
+    if not sam:
+        return None
+    rows = sam_psl_rows([sam], lens, use_cigar_13=use_cigar_13,
+                        replace_string=replace_string,
+                        read_sequence=read_sequence)
+    return rows[0] if rows else None
+
+
+def sam2tsv(args):
+    """
+    Summarise alignments of a SAM/BAM/CRAM file, one tab-separated line
+    each; an indexed BAM/CRAM is converted by region on `--cpus` processes.
+    """
+    fw = sys.stdout
+    fw.write("qId\tqBeg\tqEnd\tqSrd\tqSize\ttId\ttBeg\ttEnd\ttSrd\ttSize\t" +
+            "alnLen\tmatch\tmisMatch\tbaseN\tqNumIns\ttNumIns\tqBaseIns\ttBaseIns\tident\tscore\t" +
+            "qLoc\ttLoc\n")
+    convert_alignments(args.fi, fw, tsv_lines, cpus=args.cpus,
+                       reference=args.reference, paired=args.paired)
+    fw.flush()
+
+def _count_shard(regions, filename, reference=None, **kwargs):
+    bam = open_alignments(filename, reference=reference)
+    res = _count_alignments(bam, regions, **kwargs)
+    bam.close()
+    return res
+
+
+def _count_alignments(bam, regions, winsizes, layouts, lengths, edges,
+                      batchsize=1 << 16):
+    """
+    Read counts by window and MAPQ class of `regions` (as from
+    `region_shards`), of the unplaced reads ("*"), or of the whole file
+    (None). For each window size, returns the first window covered, in the
+    genome-wide layout of `layouts`, and the counts from there
+    (windows x classes); then the counts of the unplaced reads.
+    """
+    nq = len(edges)
+    if regions is None:
+        reads = bam.fetch(until_eof=True)
+        lo = [0] * len(winsizes)
+        hi = [x[-1] for x in layouts]
+    elif regions == "*":
+        reads = bam.fetch("*")
+        lo = hi = [0] * len(winsizes)
     else:
-        fin = open(a_filename,'r')
-    header = dict()
-    first = True
+        (c0, s0, _), (c1, _, e1) = regions[0], regions[-1]
+        t0, t1 = bam.get_tid(c0), bam.get_tid(c1)
+        lo = [x[t0] + s0 // w for w, x in zip(winsizes, layouts)]
+        hi = [x[t1] + -(-e1 // w) for w, x in zip(winsizes, layouts)]
+        reads = (x for contig, start, end in regions
+                   for x in bam.fetch(contig, start, end)
+                   if x.reference_start >= start)
+    counts = [np.zeros((h - l) * nq, dtype=np.int64) for l, h in zip(lo, hi)]
+    unplaced = np.zeros(nq, dtype=np.int64)
+
     while True:
-        lines = fin.readlines(10**8)
-        if not lines:
+        batch = list(islice(reads, batchsize))
+        if not batch:
             break
-        gc.disable()
-        lines = [line.rstrip('\r\n').split('\t') for line in lines if line.rstrip('\r\n')]
-        gc.enable()
-        for line in lines:
-            if line[0].startswith('@'):
-                if line[0].startswith('@SQ') and line[1].startswith('SN:') and line[2].startswith('LN:'):
-                    k = line[1][3:]
-                    v = int(line[2][3:])
-                    header[k] = v
-                else:
-                    pass
+        n = len(batch)
+        tid = np.fromiter((x.reference_id for x in batch), np.int64, n)
+        pos = np.fromiter((x.reference_start for x in batch), np.int64, n)
+        mapq = np.fromiter((x.mapping_quality for x in batch), np.int64, n)
+        cls = np.searchsorted(edges, mapq, side="right") - 1
+        placed = tid >= 0
+        if not placed.all():
+            unplaced += np.bincount(cls[~placed], minlength=nq)
+            tid, pos, cls = tid[placed], pos[placed], cls[placed]
+        if not len(tid):
+            continue
+        pos = np.clip(pos, 0, lengths[tid] - 1)
+        for k, (w, layout) in enumerate(zip(winsizes, layouts)):
+            key = (layout[tid] + pos // w - lo[k]) * nq + cls
+            kmin = key.min() // nq * nq
+            c = np.bincount(key - kmin)
+            counts[k][kmin:kmin + len(c)] += c
+    return [(l, c.reshape(-1, nq)) for l, c in zip(lo, counts)], unplaced
+
+
+def count_reads(filename, winsizes=(100000,), edges=(0,), cpus=1,
+                reference=None):
+    """
+    Count reads by their start in windows of each size in `winsizes`, and
+    by MAPQ class, a class starting at each of the sorted `edges`. Windows
+    and contigs come from the header; an indexed BAM/CRAM is counted by
+    region on `cpus` processes.
+
+    Returns the contig names, and for each window size the window bounds
+    of each contig and the counts (windows x classes) genome-wide; then
+    the counts of the unplaced reads.
+    """
+    from functools import partial
+
+    bam = open_alignments(filename, reference=reference)
+    names, lengths = bam.references, np.array(bam.lengths, dtype=np.int64)
+    layouts = [np.r_[0, np.cumsum(-(-lengths // w))] for w in winsizes]
+    edges = np.array(edges, dtype=np.int64)
+    nq = len(edges)
+    kwargs = dict(winsizes=winsizes, layouts=layouts, lengths=lengths,
+                  edges=edges)
+    indexed = filename != "-" and bam.has_index()
+    shards = [None]
+    if indexed:
+        shards = region_shards(bam, nreads=1000000)
+        if bam.nocoordinate:
+            shards.append("*")
+
+    counts = [np.zeros((x[-1], nq), dtype=np.int64) for x in layouts]
+    unplaced = np.zeros(nq, dtype=np.int64)
+    if cpus > 1 and len(shards) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        bam.close()
+        logging.debug("Count {0} shards on {1} processes".\
+                        format(len(shards), cpus))
+        work = partial(_count_shard, filename=filename, reference=reference,
+                       **kwargs)
+        with ProcessPoolExecutor(cpus) as pool:
+            for res in pool.map(work, shards):
+                unplaced += _add_counts(counts, res)
+    else:
+        for shard in shards:
+            unplaced += _add_counts(counts,
+                                    _count_alignments(bam, shard, **kwargs))
+        bam.close()
+    return names, layouts, counts, unplaced
+
+
+def _add_counts(counts, res):
+    blocks, unplaced = res
+    for total, (lo, c) in zip(counts, blocks):
+        total[lo:lo + len(c)] += c
+    return unplaced
+
+
+def count(args):
+    """
+    Count reads in windows along the contigs, split by mapping quality:
+    reads of MAPQ >= min_qual, and below. Window i (1-based) holds reads
+    starting in ((i - 1) * winsize, i * winsize]; only windows with reads
+    are written, unplaced reads in window 1 of "unmapped". `--mapq_hist`
+    adds the counts of reads by MAPQ class as more columns.
+
+    With several window sizes, the counts for each go to
+    `<outprefix>.<winsize>.tsv`.
+    """
+    winsizes, min_qual = args.winsize, args.min_qual
+    hist = sorted(set(int(x) for x in args.mapq_hist.split(","))) \
+            if args.mapq_hist else []
+    edges = sorted(set([0, min_qual] + hist))
+    names, layouts, counts, unplaced = count_reads(args.fi, winsizes,
+                edges=edges, cpus=args.cpus, reference=args.reference)
+    hq = np.array(edges) >= min_qual
+    # classes of each `--mapq_hist` bucket
+    hcls = np.searchsorted(edges, hist + [np.inf], side="left")
+
+    def rows(c):
+        cols = [c[:, hq].sum(axis=1), c[:, ~hq].sum(axis=1)]
+        cols += [c[:, a:b].sum(axis=1) for a, b in zip(hcls[:-1], hcls[1:])]
+        return cols
+
+    outprefix = args.outprefix
+    if outprefix is None and len(winsizes) > 1:
+        outprefix = op.basename(args.fi).rsplit(".", 1)[0]
+    order = sorted([(x, i) for i, x in enumerate(names)] + [("unmapped", -1)])
+    for w, layout, c in zip(winsizes, layouts, counts):
+        fw = must_open("{0}.{1}.tsv".format(outprefix, w), "w") \
+                if outprefix else sys.stdout
+        for seqid, i in order:
+            if i < 0:
+                if not unplaced.any():
+                    continue
+                idx = np.zeros(1, dtype=np.int64)
+                cols = rows(unplaced[None, :])
+            else:
+                block = c[layout[i]:layout[i + 1]]
+                idx = np.flatnonzero(block.any(axis=1))
+                if not len(idx):
+                    continue
+                cols = rows(block[idx])
+            cols = [_strcol(x) for x in [idx + 1] + cols]
+            fw.write("".join(seqid + "\t" + "\t".join(x) + "\n"
+                             for x in zip(*cols)))
+        if fw is not sys.stdout:
+            fw.close()
+        else:
+            fw.flush()
+
+def parse_cigar(c, toversion="1.3"):
+    """
+    Parse a CIGAR string into a list of (op, length), and the number of
+    bases in X ops. With `toversion` "1.3", neighbouring M, = and X are
+    joined into one M (as in SAM version 1.3), the blocks of a CigarBatch
+    with `merge`.
+
+    >>> parse_cigar("3S5=1X4=2I10M")
+    ([('S', 3), ('M', 10), ('I', 2), ('M', 10)], 1)
+    >>> parse_cigar("5=5M")
+    ([('M', 10)], 0)
+    >>> parse_cigar("3S5=1X4=", toversion="1.4")
+    ([('S', 3), ('=', 5), ('X', 1), ('=', 4)], 1)
+    """
+    c = c.upper()
+    if not CIGAR_FULL_RE.fullmatch(c):
+        raise ValueError("unknown CIGAR: {0}".format(c))
+    r = [(a, int(d)) for d, a in CIGAR_RE.findall(c)]
+    mismatches_x = sum(n for a, n in r if a == 'X')
+    if toversion == '1.3':
+        rr = []
+        for match, g in groupby(r, key=lambda x: x[0] in 'M=X'):
+            if match:
+                rr.append(('M', sum(n for a, n in g)))
             else:
-                if first:
-                    first = False
-                    yield header
-                    header = None
-                yield line
-    if first and header:
-        yield header
-    fin.close()
+                rr.extend(g)
+        r = rr
+    return r, mismatches_x
+
 
 def sam2psl(args):
-    file_in, file_ou = args.sam, args.psl
-    use_cigar_13 = not args.skip_conversion_cigar_13
-    read_sequence = args.read_sequence
-    replace_string = args.replace_reads_ids if args.replace_reads_ids else ''
-
-    fou = None
-    if file_ou == '-':
-        fou = sys.stdout
+    """
+    Convert alignments of a SAM/BAM/CRAM file to PSL; an indexed BAM/CRAM
+    is converted by region on `--cpus` processes.
+    """
+    file_ou = args.psl
+    fou = sys.stdout if file_ou == '-' else open(file_ou, 'w')
+    convert_alignments(args.sam, fou, psl_lines, cpus=args.cpus,
+                       reference=args.reference,
+                       use_cigar_13=not args.skip_conversion_cigar_13,
+                       replace_string=args.replace_reads_ids or '',
+                       read_sequence=args.read_sequence)
+    if fou is sys.stdout:
+        fou.flush()
     else:
-        fou = open(file_ou,'w')
-
-    # PSL data
-    psl = []
-    psl_empty_line = ['0']*21
-    # processing
-    i = 0
-    size_lines = 10**6
-    lengths = None
-    for line in getlines(file_in):
-        if i == 0:
-            lengths = line
-            i = i + 1
-            continue
-        i = i + 1
-        temp = get_psl(line, lengths, use_cigar_13, replace_string, read_sequence)
-        # saving
-        if temp:
-            psl.append('\t'.join(temp)+'\n')
-            #print >>sys.stderr, '\t'.join(line)
-            #print >>sys.stderr, '\t'.join(temp)
-            #print >>sys.stderr, "-----------------------------------------------"
-            if i > size_lines:
-                fou.writelines(psl)
-                psl = []
-    if psl:
-        fou.writelines(psl)
-    fou.close()
+        fou.close()
 
 if __name__ == "__main__":
     import argparse
@@ -443,13 +751,15 @@ if __name__ == "__main__":
     sp = parser.add_subparsers(title = 'available commands', dest = 'command')
 
     sp1 = sp.add_parser("2tsv", help = "sam -> tsv")
-    sp1.add_argument('fi', help = 'input *.sam or *.bam file')
+    sp1.add_argument('fi', help = 'input *.sam, *.bam or *.cram file')
     sp1.add_argument('--paired', action = "store_true", help = 'paired end input ')
+    sp1.add_argument('--reference', help = 'reference fasta to decode cram')
+    sp1.add_argument('--cpus', type = int, default = 1, help = 'number of processes (indexed bam/cram)')
     sp1.set_defaults(func = sam2tsv)
 
     sp1 = sp.add_parser("2psl", help = "sam -> psl",
                         formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-    sp1.add_argument("sam", help="The input file in SAM format.")
+    sp1.add_argument("sam", help="The input file in SAM, BAM or CRAM format.")
     sp1.add_argument("psl", help="The output file in PSL format.")
     sp1.add_argument("--skip-conversion-cigar-1.3","-4", action = "store_true",
                      dest = "skip_conversion_cigar_13",
@@ -464,15 +774,22 @@ if __name__ == "__main__":
                      help = "In the reads ids (also known as query name in PSL) "+
                      "the string specified here will be replaced with '/' "+
                      "(which is used in Solexa for /1 and /2).")
+    sp1.add_argument("--reference", help = "reference fasta to decode CRAM")
+    sp1.add_argument("--cpus", type = int, default = 1,
+                     help = "number of processes, used when the input is an indexed BAM/CRAM")
     sp1.set_defaults(func = sam2psl)
 
     sp1 = sp.add_parser("count",
             formatter_class = argparse.ArgumentDefaultsHelpFormatter,
             help = 'count reads in bins'
     )
-    sp1.add_argument('fi', help='input *.sam or *.bam file')
-    sp1.add_argument('--winsize', default=100000, choices=[100000, 1000000], help='window size')
-    sp1.add_argument('--min_qual', default=20, choices=[0, 10, 20], help='min read mapping quality')
+    sp1.add_argument('fi', help='input *.sam, *.bam or *.cram file')
+    sp1.add_argument('--winsize', type=int, nargs='+', default=[100000], help='window size(s)')
+    sp1.add_argument('--min_qual', type=int, default=20, help='min read mapping quality')
+    sp1.add_argument('--mapq_hist', help='also count reads in MAPQ classes starting at these comma-separated values, e.g. 0,10,20,30,40')
+    sp1.add_argument('--outprefix', help='output prefix, counts go to <outprefix>.<winsize>.tsv [default: stdout for one window size, input prefix for more]')
+    sp1.add_argument('--reference', help='reference fasta to decode cram')
+    sp1.add_argument('--cpus', type=int, default=1, help='number of processes (indexed bam/cram)')
     sp1.set_defaults(func = count)
  
     args = parser.parse_args()
@@ -13,12 +13,13 @@ import os.path as op
 import sys
 import logging
 
+import numpy as np
+
 from collections import defaultdict
 from itertools import groupby
 
 from maize.formats.base import LineFile, must_open
 from maize.formats.fasta import Fasta
-from maize.formats.sizes import Sizes
 from maize.utils.cbook import fill
 from maize.apps.base import need_update, sh, mkdir, glob, get_abs_path
 
@@ -224,6 +225,16 @@ def main():
     sp1.set_defaults(func = fpkm)
     sp1 = sp.add_parser('coverage', help='calculate depth for BAM file',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+    sp1.add_argument('bam', help = 'bam or cram file')
+    sp1.add_argument("--format", default="bigwig",
+                 choices=("bedgraph", "bigwig", "coverage"),
+                 help="Output format")
+    sp1.add_argument("--outfile", help="Output file [default: <bam prefix>.bedgraph/.bigwig, stdout for coverage]")
+    sp1.add_argument("--min_mapq", type=int, default=0, help="min read mapping quality")
+    sp1.add_argument("--exclude_flag", type=int, default=0x4, help="skip reads with any of these SAM flag bits")
+    sp1.add_argument("--chunksize", type=int, default=1 << 24, help="bases of a contig chunk computed at once")
+    sp1.add_argument("--reference", help="reference fasta to decode cram")
+    sp1.add_argument("--cpus", type=int, default=1, help="number of processes")
     sp1.set_defaults(func = coverage)
     sp1 = sp.add_parser('vcf', help='call SNPs on a set of bam files',
             formatter_class = argparse.ArgumentDefaultsHelpFormatter)
@@ -437,58 +448,200 @@ def count(args):
         cmd += " {0} {1}".format(nsortedsam, gtf)
         sh(cmd, outfile=countfile)
 
-def coverage(args):
+def region_depth(bam, contig, start, end, min_mapq=0, exclude_flag=0x4,
+                 batchsize=1 << 16):
     """
-    %prog coverage fastafile bamfile
+    Read depth at each base of contig:[start, end), 0-based, as int32.
+    Reads add their aligned blocks (M, = and X) to a difference array, so
+    bases under D and N are not covered; reads with any of `exclude_flag`
+    set or of MAPQ below `min_mapq` are skipped.
+    """
+    from itertools import islice
+    from maize.formats.sam import CigarBatch
+
+    n = end - start
+    diff = np.zeros(n + 1, dtype=np.int32)
+    reads = (x for x in bam.fetch(contig, start, end)
+             if not x.flag & exclude_flag and x.mapping_quality >= min_mapq)
+    while True:
+        batch = list(islice(reads, batchsize))
+        if not batch:
+            break
+        cb = CigarBatch.from_strings([x.cigarstring or '*' for x in batch],
+                                     [x.reference_start for x in batch])
+        bstarts = np.clip(cb.btstarts - start, 0, n)
+        bends = np.clip(cb.btstarts + cb.bsizes - start, 0, n)
+        keep = bends > bstarts
+        for pos, sign in ((bstarts[keep], 1), (bends[keep], -1)):
+            if not len(pos):
+                continue
+            lo = pos.min()
+            c = np.bincount(pos - lo).astype(np.int32)
+            diff[lo:lo + len(c)] += sign * c
+    return np.cumsum(diff[:-1], dtype=np.int32)
+
 
-    Calculate coverage for BAM file. BAM file will be sorted unless with
-    --nosort.
+def depth_runs(depth, offset=0):
     """
-    p = OptionParser(coverage.__doc__)
-    sp1.add_argument("--format", default="bigwig",
-                 choices=("bedgraph", "bigwig", "coverage"),
-                 help="Output format")
-    sp1.add_argument("--nosort", default=False, action="store_true",
-                 help="Do not sort BAM")
-    p.set_outfile()
-    opts, args = p.parse_args(args)
+    Run-length encode depth into bedGraph runs of non-zero depth: starts,
+    ends (0-based, half-open, shifted by `offset`) and depths.
 
-    if len(args) != 2:
-        sys.exit(not p.print_help())
+    >>> [x.tolist() for x in depth_runs(np.array([0, 2, 2, 1, 0, 0, 3]), 10)]
+    [[11, 13, 16], [13, 14, 17], [2, 1, 3]]
+    """
+    change = np.flatnonzero(np.diff(depth)) + 1
+    starts = np.r_[0, change]
+    ends = np.r_[change, len(depth)]
+    values = depth[starts]
+    keep = values != 0
+    return starts[keep] + offset, ends[keep] + offset, values[keep]
 
-    fastafile, bamfile = args
-    format = args.format
-    if args.nosort:
-        logging.debug("BAM sorting skipped")
-    else:
-        bamfile = index([bamfile, "--fasta={0}".format(fastafile)])
-
-    pf = bamfile.rsplit(".", 2)[0]
-    sizesfile = Sizes(fastafile).filename
-    cmd = "genomeCoverageBed -ibam {0} -g {1}".format(bamfile, sizesfile)
-    if format in ("bedgraph", "bigwig"):
-        cmd += " -bg"
-        bedgraphfile = pf + ".bedgraph"
-        sh(cmd, outfile=bedgraphfile)
-
-        if format == "bedgraph":
-            return bedgraphfile
-
-        bigwigfile = pf + ".bigwig"
-        cmd = "bedGraphToBigWig {0} {1} {2}".\
-                    format(bedgraphfile, sizesfile, bigwigfile)
-        sh(cmd)
-        return bigwigfile
 
-    coveragefile = pf + ".coverage"
-    if need_update(fastafile, coveragefile):
-        sh(cmd, outfile=coveragefile)
+def _depth_chunk(region, filename, reference=None, **kwargs):
+    from maize.formats.sam import open_alignments
 
-    gcf = GenomeCoverageFile(coveragefile)
-    fw = must_open(args.outfile, "w")
-    for seqid, cov in gcf.iter_coverage_seqid():
-        print >> fw, "\t".join((seqid, "{0:.1f}".format(cov)))
-    fw.close()
+    contig, start, end = region
+    bam = open_alignments(filename, reference=reference)
+    depth = region_depth(bam, contig, start, end, **kwargs)
+    bam.close()
+    return depth_runs(depth, offset=start)
+
+
+def iter_depth_runs(bamfile, chunksize=1 << 24, cpus=1, reference=None,
+                    **kwargs):
+    """
+    Iterate over (contig, starts, ends, depths) bedGraph runs of an indexed
+    BAM/CRAM, contig chunks of `chunksize` bases at a time, in file order.
+    Chunks are computed on `cpus` processes with a bounded queue in flight,
+    so memory stays within a few chunks; runs of equal depth across chunk
+    ends are joined.
+    """
+    from collections import deque
+    from functools import partial
+    from maize.formats.sam import open_alignments
+
+    bam = open_alignments(bamfile, reference=reference)
+    regions = [(name, start, min(start + chunksize, size))
+               for name, size in zip(bam.references, bam.lengths)
+               for start in range(0, size, chunksize)]
+    bam.close()
+    work = partial(_depth_chunk, filename=bamfile, reference=reference,
+                   **kwargs)
+
+    def results():
+        if cpus < 2:
+            for region in regions:
+                yield region, work(region)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        pending = deque()
+        with ProcessPoolExecutor(cpus) as pool:
+            for region in regions:
+                pending.append((region, pool.submit(work, region)))
+                if len(pending) >= 2 * cpus:
+                    region, future = pending.popleft()
+                    yield region, future.result()
+            while pending:
+                region, future = pending.popleft()
+                yield region, future.result()
+
+    last = None
+    for (contig, start, end), (starts, ends, depths) in results():
+        if last is not None and last[0] == contig and len(starts) and \
+                last[2][-1] == starts[0] and last[3][-1] == depths[0]:
+            last[2][-1] = ends[0]
+            starts, ends, depths = starts[1:], ends[1:], depths[1:]
+        if last is not None and len(last[1]):
+            yield last
+        last = (contig, starts, ends, depths)
+    if last is not None and len(last[1]):
+        yield last
+
+
+def sorted_indexed(bamfile, cpus=1):
+    """
+    Position-sorted and indexed BAM of `bamfile`: itself if indexed, or
+    indexed if sorted already, otherwise sorted into `<prefix>.sorted.bam`.
+    """
+    import pysam
+
+    bam = pysam.AlignmentFile(bamfile)
+    indexed = bam.has_index()
+    so = bam.header.to_dict().get("HD", {}).get("SO")
+    bam.close()
+    if indexed:
+        return bamfile
+    if so != "coordinate":
+        sortedbamfile = bamfile.rsplit(".", 1)[0] + ".sorted.bam"
+        if need_update(bamfile, sortedbamfile):
+            pysam.sort("-@", str(cpus), "-o", sortedbamfile, bamfile)
+        bamfile = sortedbamfile
+    if need_update(bamfile, bamfile + ".bai"):
+        pysam.index(bamfile)
+    return bamfile
+
+
+def coverage(args):
+    """
+    %prog coverage bamfile
+
+    Calculate read depth of a BAM/CRAM file, as bedGraph, bigWig, or mean
+    depth per contig (and genome-wide) with `--format coverage`. The BAM
+    file is sorted and indexed if needed.
+    """
+    from maize.formats.sam import open_alignments
+
+    fmt = args.format
+    bamfile = args.bam
+    if not bamfile.endswith(".cram"):
+        bamfile = sorted_indexed(bamfile, cpus=args.cpus)
+    bam = open_alignments(bamfile, reference=args.reference)
+    sizes = list(zip(bam.references, bam.lengths))
+    bam.close()
+
+    runs = iter_depth_runs(bamfile, chunksize=args.chunksize, cpus=args.cpus,
+                           reference=args.reference, min_mapq=args.min_mapq,
+                           exclude_flag=args.exclude_flag)
+    pf = bamfile.rsplit(".", 1)[0]
+    if pf.endswith(".sorted"):
+        pf = pf.rsplit(".", 1)[0]
+
+    if fmt == "bedgraph":
+        outfile = args.outfile or pf + ".bedgraph"
+        fw = must_open(outfile, "w")
+        for contig, starts, ends, depths in runs:
+            cols = [[str(v) for v in x.tolist()] for x in (starts, ends, depths)]
+            fw.write("".join("{0}\t{1}\t{2}\t{3}\n".format(contig, *x)
+                             for x in zip(*cols)))
+        fw.close()
+        return outfile
+
+    if fmt == "bigwig":
+        from maize.formats.bigwig import BigWigWriter
+
+        outfile = args.outfile or pf + ".bigwig"
+        bw = BigWigWriter(outfile, sizes)
+        for contig, starts, ends, depths in runs:
+            bw.add(contig, starts, ends, depths)
+        bw.close()
+        return outfile
+
+    bases = defaultdict(int)
+    for contig, starts, ends, depths in runs:
+        bases[contig] += int(((ends - starts) * depths.astype(np.int64)).sum())
+    fw = must_open(args.outfile or "stdout", "w")
+    for seqid, size in sizes:
+        if size:
+            print("\t".join((seqid, "{0:.1f}".format(bases[seqid] * 1. / size))),
+                  file=fw)
+    genome = sum(x for seqid, x in sizes)
+    if genome:
+        print("\t".join(("genome", "{0:.1f}".format(sum(bases.values()) * 1. / genome))),
+              file=fw)
+    if fw is not sys.stdout:
+        fw.close()
 
 def fpkm(args):
     """
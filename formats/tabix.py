@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Region index for BGZF-compressed, position-sorted tab-delimited files (BED,
+GFF, VCF, ...), in the spirit of tabix's linear index.
+
+For every 16kb window of each seqid the index keeps the virtual offset of
+the first record overlapping it. A region query seeks there and reads
+forward until records start past the region. The index is built on first
+use and cached next to the file as `<file>.idx.npz`, and rebuilt when the
+file is newer.
+"""
+
+import io
+import os.path as op
+import logging
+
+import numpy as np
+
+from jcvi.apps.base import need_update
+from jcvi.formats.compress import BgzfReader, iter_blocks, is_bgzf
+
+WINDOW_SHIFT = 14       # 16kb windows
+
+# column of seqid, start, end (None: end from VCF REF), start is 0-based
+PRESETS = {
+    "bed": (0, 1, 2, True),
+    "gff": (0, 3, 4, False),
+    "vcf": (0, 1, None, False),
+}
+
+
+def guess_preset(filename):
+    """
+    >>> guess_preset("genes.gff3.gz"), guess_preset("snps.vcf.gz")
+    ('gff', 'vcf')
+    >>> guess_preset("peaks.bed.gz")
+    'bed'
+    """
+    name = filename.lower()
+    for suffix in (".gz", ".bgz"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    ext = name.rsplit(".", 1)[-1]
+    if ext in ("gff", "gff3", "gtf"):
+        return "gff"
+    if ext == "vcf":
+        return "vcf"
+    return "bed"
+
+
+def is_bgzf_file(filename):
+    if not op.exists(filename):
+        return False
+    with open(filename, "rb") as fp:
+        return is_bgzf(fp.read(18))
+
+
+def _parse_interval(line, preset):
+    """
+    Returns seqid, 1-based start and end of a record (bytes), None for
+    header and comment lines.
+    """
+    if not line or line[:1] == b"#" or line.startswith((b"track", b"browser")):
+        return None
+    scol, bcol, ecol, zero = PRESETS[preset]
+    atoms = line.split(b"\t", max(bcol, 3 if ecol is None else ecol) + 1)
+    start = int(atoms[bcol]) + zero
+    if ecol is None:
+        end = start + len(atoms[3]) - 1
+    else:
+        end = int(atoms[ecol])
+    return atoms[scol], start, max(start, end)
+
+
+class TabixIndex (object):
+    """
+    Linear region index of a BGZF file. The file has to be sorted by seqid
+    (records of a seqid contiguous) and then by start.
+    """
+    def __init__(self, filename, preset=None, threads=4):
+        assert is_bgzf_file(filename), \
+                "`{0}` is not BGZF, compress with `bgzip`".format(filename)
+        self.filename = filename
+        self.preset = preset or guess_preset(filename)
+        self.idxfile = filename + ".idx.npz"
+        self.offsets = {}
+
+        if not need_update(filename, self.idxfile) and self.load():
+            return
+        self.build(threads=threads)
+        self.save()
+
+    def __contains__(self, seqid):
+        return seqid in self.offsets
+
+    @property
+    def seqids(self):
+        return list(self.offsets.keys())
+
+    def load(self):
+        data = np.load(self.idxfile)
+        if str(data["preset"]) != self.preset:
+            return False
+        names, bounds, voffsets = data["names"], data["bounds"], data["voffsets"]
+        for i, name in enumerate(names.tolist()):
+            self.offsets[name] = voffsets[bounds[i]:bounds[i + 1]]
+        return True
+
+    def save(self):
+        names = list(self.offsets.keys())
+        sizes = [len(self.offsets[x]) for x in names]
+        bounds = np.r_[0, np.cumsum(sizes)].astype("int64")
+        voffsets = np.concatenate([self.offsets[x] for x in names]) if names \
+                        else np.zeros(0, dtype="int64")
+        # e.g. in a read-only data directory the index stays in memory
+        try:
+            with open(self.idxfile, "wb") as fw:
+                np.savez(fw, names=np.array(names, dtype=str), bounds=bounds,
+                         voffsets=voffsets, preset=np.array(self.preset))
+        except (IOError, OSError) as e:
+            logging.debug("Cannot write `{0}`: {1}".format(self.idxfile, e))
+            return
+        logging.debug("Region index written to `{0}`".format(self.idxfile))
+
+    def build(self, threads=4):
+        logging.debug("Build region index for `{0}`".format(self.filename))
+        self.offsets = {}
+        linear = None
+        seqid = None
+        lastbeg = 0
+        filled = 0
+        for voffset, line in self._iter_lines(threads=threads):
+            rec = _parse_interval(line, self.preset)
+            if rec is None:
+                continue
+            sid, start, end = rec
+            if sid != seqid:
+                if linear is not None:
+                    self._finish(seqid, linear)
+                seqid = sid
+                assert seqid.decode() not in self.offsets, \
+                    "`{0}` not sorted: `{1}` appears twice".\
+                        format(self.filename, seqid.decode())
+                linear, lastbeg, filled = [], 0, 0
+            assert start >= lastbeg, "`{0}` not sorted at {1}:{2}".\
+                        format(self.filename, seqid.decode(), start)
+            lastbeg = start
+
+            # windows seen before `filled` are set already, because every
+            # record before this one started no later than it
+            wbeg = max((start - 1) >> WINDOW_SHIFT, filled)
+            wend = (end - 1) >> WINDOW_SHIFT
+            if wend >= len(linear):
+                linear.extend([-1] * (wend + 1 - len(linear)))
+            for w in range(wbeg, wend + 1):
+                if linear[w] < 0:
+                    linear[w] = voffset
+            filled = max(filled, wend + 1)
+
+        if linear is not None:
+            self._finish(seqid, linear)
+
+    def _finish(self, seqid, linear):
+        # empty windows take the offset of the window before them
+        linear = np.array(linear, dtype="int64")
+        missing = linear < 0
+        if missing.any():
+            idx = np.where(missing, 0, np.arange(len(linear)))
+            np.maximum.accumulate(idx, out=idx)
+            idx[:np.argmax(~missing)] = np.argmax(~missing)
+            linear = linear[idx]
+        self.offsets[seqid.decode()] = linear
+
+    def _iter_lines(self, threads=4):
+        """
+        Iterate over (virtual offset, line) of the whole file.
+        """
+        partial, pvoffset = [], 0
+        with open(self.filename, "rb") as fp:
+            for coffset, data in iter_blocks(fp, threads=threads):
+                pos = 0
+                while True:
+                    nl = data.find(b"\n", pos)
+                    if nl < 0:
+                        if pos < len(data):
+                            if not partial:
+                                pvoffset = coffset << 16 | pos
+                            partial.append(data[pos:])
+                        break
+                    if partial:
+                        partial.append(data[pos:nl])
+                        yield pvoffset, b"".join(partial)
+                        partial = []
+                    else:
+                        yield coffset << 16 | pos, data[pos:nl]
+                    pos = nl + 1
+        if partial:
+            yield pvoffset, b"".join(partial)
+
+    def fetch(self, seqid, start, end):
+        """
+        Iterate over lines (newline stripped) of records overlapping
+        seqid:start-end, 1-based and inclusive.
+        """
+        if seqid not in self.offsets:
+            return
+        linear = self.offsets[seqid]
+        w = (max(start, 1) - 1) >> WINDOW_SHIFT
+        if w >= len(linear):
+            return
+
+        bseqid = seqid.encode()
+        reader = BgzfReader(open(self.filename, "rb"), threads=1,
+                            chunksize=1 << 16)
+        reader.seek_virtual(int(linear[w]))
+        with io.BufferedReader(reader, 1 << 16) as fp:
+            for line in fp:
+                line = line.rstrip(b"\r\n")
+                rec = _parse_interval(line, self.preset)
+                if rec is None:
+                    continue
+                sid, rstart, rend = rec
+                if sid != bseqid or rstart > end:
+                    break
+                if rend >= start:
+                    yield line.decode()
+
+
+def tabix_fetch(filename, seqid, start, end, preset=None):
+    """
+    Iterate over the lines of a BGZF file overlapping seqid:start-end
+    (1-based, inclusive), building the region index if needed.
+    """
+    return TabixIndex(filename, preset=preset).fetch(seqid, start, end)
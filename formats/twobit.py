@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+2-bit packed sequence store, in the UCSC .2bit layout
+<https://genome.ucsc.edu/FAQ/FAQformat.html#format7>.
+
+Bases are packed four to a byte (T=0, C=1, A=2, G=3); runs of N and of
+soft-masked (lower case) bases are kept apart as (start, size) blocks. The
+file is memory-mapped, and `TwoBitFile.fetch` decodes a whole batch of
+regions with table lookups over the packed bytes. Characters other than
+ACGT are stored as N.
+"""
+
+import os
+import os.path as op
+import mmap
+import struct
+import logging
+
+import numpy as np
+
+from jcvi.apps.base import need_update, mkdir
+from jcvi.formats.base import must_open
+
+TWOBIT_SIGNATURE = 0x1A412743
+CHUNKSIZE = 1 << 24         # bases decoded at once in `fetch`
+
+BASES = np.frombuffer(b"TCAG", dtype=np.uint8)
+# packed byte => its 4 bases
+DECODE4 = BASES[(np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3]
+ENCODE = np.full(256, 255, dtype=np.uint8)
+for i, c in enumerate(b"TCAG"):
+    ENCODE[c] = ENCODE[c + 32] = i
+
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for a, b in zip(b"ACGTNacgtn", b"TGCANtgcan"):
+    COMPLEMENT[a] = b
+
+
+def _runs(mask):
+    """
+    Starts and sizes of the runs of True in a boolean array.
+
+    >>> [x.tolist() for x in _runs(np.array([0, 1, 1, 0, 1], dtype=bool))]
+    [[1, 4], [2, 1]]
+    """
+    d = np.diff(np.r_[0, mask.view(np.int8), 0])
+    starts = np.flatnonzero(d == 1)
+    return starts, np.flatnonzero(d == -1) - starts
+
+
+def encode_record(seq):
+    """
+    .2bit record (without name) of a sequence given as bytes.
+    """
+    arr = np.frombuffer(seq, dtype=np.uint8)
+    code = ENCODE[arr]
+    isn = code == 255
+    code[isn] = 0
+    nstarts, nsizes = _runs(isn)
+    mstarts, msizes = _runs((arr >= 97) & (arr <= 122))
+
+    n = len(code)
+    code = np.r_[code, np.zeros(-n % 4, dtype=np.uint8)].reshape(-1, 4)
+    packed = (code[:, 0] << 6) | (code[:, 1] << 4) | (code[:, 2] << 2) | code[:, 3]
+
+    u4 = lambda x: np.asarray(x, dtype="<u4").tobytes()
+    return b"".join((struct.pack("<II", n, len(nstarts)), u4(nstarts),
+                     u4(nsizes), struct.pack("<I", len(mstarts)), u4(mstarts),
+                     u4(msizes), struct.pack("<I", 0), packed.astype(np.uint8).tobytes()))
+
+
+def iter_fasta_raw(fastafile):
+    """
+    Iterate over (id, sequence bytes) of a FASTA file, without Bio.
+    """
+    name, seq = None, []
+    for line in must_open(fastafile):
+        if line[:1] == ">":
+            if name is not None:
+                yield name, "".join(seq).encode()
+            name, seq = line[1:].split()[0], []
+        elif name is not None:
+            seq.append(line.strip())
+    if name is not None:
+        yield name, "".join(seq).encode()
+
+
+def fasta_to_twobit(fastafile, twobitfile):
+    """
+    Pack a FASTA file into .2bit. Records are written to a temporary file
+    as they are encoded, then put behind the header and index.
+    """
+    names, sizes = [], []
+    tmpfile = twobitfile + ".tmp"
+    with open(tmpfile, "wb") as fw:
+        for name, seq in iter_fasta_raw(fastafile):
+            rec = encode_record(seq)
+            fw.write(rec)
+            names.append(name.encode())
+            sizes.append(len(rec))
+
+    offset = 16 + sum(5 + len(x) for x in names)
+    with open(twobitfile, "wb") as fw:
+        fw.write(struct.pack("<IIII", TWOBIT_SIGNATURE, 0, len(names), 0))
+        for name, size in zip(names, sizes):
+            fw.write(struct.pack("<B", len(name)) + name + struct.pack("<I", offset))
+            offset += size
+        with open(tmpfile, "rb") as fp:
+            while True:
+                buf = fp.read(1 << 24)
+                if not buf:
+                    break
+                fw.write(buf)
+    os.remove(tmpfile)
+    logging.debug("{0} sequences packed into `{1}`".format(len(names), twobitfile))
+
+
+def twobit_paths(fastafile):
+    """
+    Places for the .2bit of a FASTA file, in order of preference: next to
+    it, then (for read-only genome directories) under the user cache
+    directory and the temporary directory, named after its real path.
+    """
+    import hashlib
+    from tempfile import gettempdir
+
+    key = hashlib.md5(op.realpath(fastafile).encode()).hexdigest()[:12]
+    name = "{0}.{1}.2bit".format(op.basename(fastafile), key)
+    cache = os.environ.get("XDG_CACHE_HOME") or op.join(op.expanduser("~"), ".cache")
+    return [fastafile + ".2bit", op.join(cache, "twobit", name),
+            op.join(gettempdir(), name)]
+
+
+def twobit_store(filename):
+    """
+    `TwoBitFile` of a .2bit file, or of a FASTA file through `<fasta>.2bit`
+    built next to it when missing or older than the FASTA; where that
+    cannot be written, the next of `twobit_paths` is used.
+    """
+    if not filename.endswith(".2bit"):
+        for twobitfile in twobit_paths(filename):
+            if not need_update(filename, twobitfile):
+                break
+            try:
+                mkdir(op.dirname(twobitfile) or ".")
+                fasta_to_twobit(filename, twobitfile)
+                break
+            except OSError as e:
+                logging.debug("Cannot write `{0}`: {1}".format(twobitfile, e))
+        else:
+            raise OSError("no writable place for the .2bit of `{0}`".format(filename))
+        filename = twobitfile
+    return TwoBitFile(filename)
+
+
+class TwoBitRecord (object):
+
+    def __init__(self, mm, offset, endian):
+        u4 = endian + "u4"
+        self.size, nn = struct.unpack_from(endian + "II", mm, offset)
+        offset += 8
+        self.nstarts = np.frombuffer(mm, u4, nn, offset).astype(np.int64)
+        self.nends = self.nstarts + np.frombuffer(mm, u4, nn, offset + 4 * nn)
+        offset += 8 * nn
+        nm, = struct.unpack_from(endian + "I", mm, offset)
+        offset += 4
+        self.mstarts = np.frombuffer(mm, u4, nm, offset).astype(np.int64)
+        self.mends = self.mstarts + np.frombuffer(mm, u4, nm, offset + 4 * nm)
+        offset += 8 * nm + 4
+        self.packed = np.frombuffer(mm, np.uint8, (self.size + 3) // 4, offset)
+
+    @staticmethod
+    def _covered(bstarts, bends, starts, ends, offsets, total):
+        """
+        Mask over the concatenated regions of the bases inside blocks,
+        painted with a difference array over the (region, block) overlaps.
+        None if no block overlaps.
+        """
+        lo = np.searchsorted(bends, starts, side="right")
+        k = np.searchsorted(bstarts, ends, side="left") - lo
+        k = np.maximum(k, 0)
+        if not k.any():
+            return None
+        reg = np.repeat(np.arange(len(starts)), k)
+        blk = lo[reg] + np.arange(len(reg)) - np.repeat(np.cumsum(k) - k, k)
+        shift = offsets[reg] - starts[reg]
+        d = np.zeros(total + 1, dtype=np.int32)
+        np.add.at(d, np.maximum(bstarts[blk], starts[reg]) + shift, 1)
+        np.add.at(d, np.minimum(bends[blk], ends[reg]) + shift, -1)
+        return np.cumsum(d[:-1]) > 0
+
+    def decode(self, starts, lens):
+        """
+        Bases of the regions [starts, starts + lens), each widened to whole
+        packed bytes, concatenated as uint8. Returns the bases and the
+        offset of each region in them.
+        """
+        b0 = starts >> 2
+        nb = ((starts + lens + 3) >> 2) - b0
+        boff = np.cumsum(nb) - nb
+        idx = np.arange(int(nb.sum()), dtype=np.int64) + np.repeat(b0 - boff, nb)
+        seq = DECODE4[self.packed[idx]].ravel()
+
+        total = len(seq)
+        spans, offsets, ends = b0 << 2, boff << 2, (b0 + nb) << 2
+        for bstarts, bends, paint in ((self.nstarts, self.nends, None),
+                                      (self.mstarts, self.mends, 0x20)):
+            if not len(bstarts):
+                continue
+            mask = self._covered(bstarts, bends, spans, ends, offsets, total)
+            if mask is None:
+                continue
+            if paint:
+                seq[mask] |= paint
+            else:
+                seq[mask] = ord("N")
+        return seq, offsets + (starts & 3)
+
+
+class TwoBitFile (object):
+    """
+    Memory-mapped .2bit file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, "rb")
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        for endian in "<>":
+            sig, version, count, _ = struct.unpack_from(endian + "IIII", self.mm, 0)
+            if sig == TWOBIT_SIGNATURE:
+                break
+        else:
+            raise ValueError("`{0}` is not a .2bit file".format(filename))
+        self.endian = endian
+
+        self.offsets = {}
+        pos = 16
+        for i in range(count):
+            n = self.mm[pos]
+            name = self.mm[pos + 1:pos + 1 + n].decode()
+            self.offsets[name], = struct.unpack_from(endian + "I", self.mm,
+                                                     pos + 1 + n)
+            pos += 5 + n
+        self._records = {}
+
+    def __contains__(self, seqid):
+        return seqid in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def keys(self):
+        return list(self.offsets.keys())
+
+    def record(self, seqid):
+        if seqid not in self._records:
+            self._records[seqid] = TwoBitRecord(self.mm, self.offsets[seqid],
+                                                self.endian)
+        return self._records[seqid]
+
+    def size(self, seqid):
+        return self.record(seqid).size
+
+    @property
+    def sizes(self):
+        return dict((x, self.size(x)) for x in self.offsets)
+
+    def fetch_one(self, seqid, start, end):
+        """
+        Sequence of seqid:[start, end), 0-based, as str.
+        """
+        return self.fetch([seqid], [start], [end])[0].decode()
+
+    def fetch(self, seqids, starts, ends, strands=None):
+        """
+        Sequences (bytes) of a batch of 0-based half-open regions, clipped
+        to the sequence ends; those on the "-" strand are reverse
+        complemented. Regions are decoded in order of position, about
+        `CHUNKSIZE` bases at a time, and returned in input order.
+        """
+        n = len(seqids)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        names = sorted(set(seqids))
+        codes = dict((x, i) for i, x in enumerate(names))
+        seqid = np.fromiter((codes[x] for x in seqids), dtype=np.int64, count=n)
+        sizes = np.array([self.size(x) for x in names], dtype=np.int64)
+        if n:
+            starts = np.clip(starts, 0, sizes[seqid])
+            ends = np.clip(ends, starts, sizes[seqid])
+        lens = ends - starts
+
+        seqs = [None] * n
+        order = np.lexsort((starts, seqid))
+        chunk = []
+        nbases = 0
+        for k, i in enumerate(order.tolist()):
+            chunk.append(i)
+            nbases += lens[i]
+            last = k == n - 1 or seqid[order[k + 1]] != seqid[i]
+            if last or nbases >= CHUNKSIZE:
+                self._decode_chunk(names[seqid[i]], np.array(chunk), starts,
+                                   lens, seqs)
+                chunk, nbases = [], 0
+
+        if strands is not None:
+            minus = [i for i, x in enumerate(strands) if x == "-"]
+            if minus:
+                # rc of a concatenation is the concatenation of the rc's
+                # in reverse order
+                rc = COMPLEMENT[np.frombuffer(b"".join(seqs[i] for i in minus),
+                                              dtype=np.uint8)[::-1]].tobytes()
+                pos = 0
+                for i in reversed(minus):
+                    seqs[i] = rc[pos:pos + lens[i]]
+                    pos += lens[i]
+        return seqs
+
+    def _decode_chunk(self, seqid, idx, starts, lens, seqs):
+        rec = self.record(seqid)
+        clens = lens[idx]
+        data, offsets = rec.decode(starts[idx], clens)
+        data = data.tobytes()
+        for i, b, l in zip(idx.tolist(), offsets.tolist(), clens.tolist()):
+            seqs[i] = data[b:b + l]
+
+    def close(self):
+        self.mm.close()
+        self.fp.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
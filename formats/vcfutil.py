@@ -9,6 +9,7 @@ import vcf
 
 from jcvi.apps.base import sh, mkdir
 from jcvi.formats.base import must_open
+from jcvi.formats.tabix import TabixIndex
 
 dna_comp_dict = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
 def revcomp(dna):
@@ -82,7 +83,7 @@ def vcf2fas(args):
 
     fhi = must_open(args.fi)
     seqdic = SeqIO.index(args.fs, "fasta")
-    vcfr = vcf.Reader(filename = args.fv, compressed = True)
+    vcfi = TabixIndex(args.fv, preset="vcf")
 
     for line in fhi:
         line = line.strip("\n")
@@ -94,10 +95,10 @@ def vcf2fas(args):
         beg, end = int(beg), int(end)
         chrstr = seqdic[seqid].seq
         seqstr = chrstr[beg-1:end]
-        rcds = vcfr.fetch(seqid, start = beg-1, end = end)
-        for rcd in rcds:
-            alts = ",".join(map(str, rcd.ALT))
-            alt = rcd.ALT[0]
+        for rcd in vcfi.fetch(seqid, beg, end):
+            row = rcd.split("\t")
+            alts = row[4]
+            alt = alts.split(",")[0]
             #logging.debug("%s\t%s\t%s\t%s" % (rcd.CHROM, rcd.POS, rcd.REF, alts))
         #logging.debug("%s\t%s\t%s\t%s" % (seqid, beg, end, note))
         print("%s\t%s\t%s\t%s\t%s" % (seqid, beg, end, note, seqstr))
@@ -4,8 +4,18 @@
 """
 Disjoint set data structure <http://code.activestate.com/recipes/387776/>
 Author: Michael Droettboom
+
+Reimplemented as an array-backed union-find: keys are interned to integer
+ids, sets are trees with path compression and union by rank, and members of
+each set are threaded on a circular linked list so a group can be listed
+without scanning all keys.
 """
 
+from array import array
+
+import numpy as np
+
+
 class Grouper(object):
     """
     This class provides a lightweight way to group arbitrary objects
@@ -30,41 +40,132 @@ class Grouper(object):
     False
     >>> g.joined('a', 'd')
     False
+    >>> len(g), g.num_members
+    (2, 5)
     >>> del g['b']
     >>> list(g)
     [['a', 'c'], ['d', 'e']]
+    >>> g.join_many([('c', 'd'), ('f', 'g')])
+    >>> list(g)
+    [['a', 'c', 'd', 'e'], ['f', 'g']]
+    >>> h = Grouper()
+    >>> h.join_many(np.array([[1, "1"], [None, 2]], dtype=object))
+    >>> len(h), h.joined(1, "1"), h.joined(None, 2), h.joined(1, 2)
+    (2, True, True, False)
     """
     def __init__(self, init=[]):
-        mapping = self._mapping = {}
+        self._ids = {}           # key => int id
+        self._keys = []          # int id => key
+        self._alive = bytearray()
+        self._parent = array("l")
+        self._rank = bytearray()
+        self._size = array("l")  # live members, valid at roots
+        self._next = array("l")  # circular list of members in each set
+        self._ncomponents = 0
         for x in init:
-            mapping[x] = [x]
+            self._intern(x)
+
+    def _intern(self, key):
+        """
+        Return the int id of key, creating a singleton set if unseen.
+        """
+        i = self._ids.get(key)
+        if i is None:
+            i = len(self._keys)
+            self._ids[key] = i
+            self._keys.append(key)
+            self._alive.append(1)
+            self._parent.append(i)
+            self._rank.append(0)
+            self._size.append(1)
+            self._next.append(i)
+            self._ncomponents += 1
+        return i
+
+    def _find(self, i):
+        parent = self._parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:   # path compression
+            parent[i], i = root, parent[i]
+        return root
+
+    def _union(self, i, j):
+        ri, rj = self._find(i), self._find(j)
+        if ri == rj:
+            return ri
+        rank = self._rank
+        if rank[ri] < rank[rj]:
+            ri, rj = rj, ri
+        elif rank[ri] == rank[rj]:
+            rank[ri] += 1
+        self._parent[rj] = ri
+        size = self._size
+        if size[ri] and size[rj]:
+            self._ncomponents -= 1
+        size[ri] += size[rj]
+        nxt = self._next
+        nxt[ri], nxt[rj] = nxt[rj], nxt[ri]
+        return ri
+
+    def _members(self, i):
+        nxt, alive, keys = self._next, self._alive, self._keys
+        group = [i] if alive[i] else []
+        j = nxt[i]
+        while j != i:
+            if alive[j]:
+                group.append(j)
+            j = nxt[j]
+        group.sort()
+        return [keys[x] for x in group]
 
     def join(self, a, *args):
         """
         Join given arguments into the same set. Accepts one or more arguments.
         """
-        mapping = self._mapping
-        set_a = mapping.setdefault(a, [a])
-
+        i = self._intern(a)
         for arg in args:
-            set_b = mapping.get(arg)
-            if set_b is None:
-                set_a.append(arg)
-                mapping[arg] = set_a
-            elif set_b is not set_a:
-                if len(set_b) > len(set_a):
-                    set_a, set_b = set_b, set_a
-                set_a.extend(set_b)
-                for elem in set_b:
-                    mapping[elem] = set_a
+            self._union(i, self._intern(arg))
+
+    def join_many(self, pairs):
+        """
+        Join every (a, b) pair in an iterable or a 2-column array. Keys are
+        interned once per distinct value, and repeated pairs are dropped
+        before any union is done. Keys that are not all str or all int
+        (None, tuples, mixed types such as 1 and "1") are joined pair by
+        pair, so that no key is converted.
+        """
+        if not isinstance(pairs, np.ndarray) or pairs.dtype.kind == "O":
+            pairs = pairs.tolist() if isinstance(pairs, np.ndarray) \
+                    else list(pairs)
+            if not pairs:
+                return
+            types = set(type(x) for pair in pairs for x in pair)
+            if len(types) != 1 or types.pop() not in (str, int) or \
+                    any(len(pair) != 2 for pair in pairs):
+                for a, b in pairs:
+                    self.join(a, b)
+                return
+            pairs = np.array(pairs)
+        if not pairs.size:
+            return
+        uniq, inverse = np.unique(pairs.ravel(), return_inverse=True)
+        ids = np.array([self._intern(x) for x in uniq.tolist()], dtype="int64")
+        edges = ids[inverse].reshape(-1, 2)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+        union = self._union
+        for i, j in edges.tolist():
+            union(i, j)
 
     def joined(self, a, b):
         """
         Returns True if a and b are members of the same set.
         """
-        mapping = self._mapping
+        ids = self._ids
         try:
-            return mapping[a] is mapping[b]
+            return self._find(ids[a]) == self._find(ids[b])
         except KeyError:
             return False
 
@@ -73,37 +174,42 @@ class Grouper(object):
         Returns an iterator returning each of the disjoint sets as a list.
         """
         seen = set()
-        for elem, group in self._mapping.items():
-            if elem not in seen:
-                yield group
-                seen.update(group)
+        for i, alive in enumerate(self._alive):
+            if not alive:
+                continue
+            root = self._find(i)
+            if root not in seen:
+                seen.add(root)
+                yield self._members(root)
 
     def __getitem__(self, key):
         """
         Returns the set that a certain key belongs.
         """
-        return tuple(self._mapping[key])
+        return tuple(self._members(self._ids[key]))
 
     def __contains__(self, key):
-        return key in self._mapping
+        return key in self._ids
 
     def __len__(self):
-        group = set()
-        for v in self._mapping.values():
-            group.update([tuple(v)])
-        return len(group)
+        return self._ncomponents
 
     def __delitem__(self, key):
-        group = self._mapping[key]
-        group.remove(key)
-        del self._mapping[key]
+        # the node stays in its tree to keep the paths intact, only the key
+        # is dropped from the set
+        i = self._ids.pop(key)
+        self._alive[i] = 0
+        root = self._find(i)
+        self._size[root] -= 1
+        if not self._size[root]:
+            self._ncomponents -= 1
 
     @property
     def num_members(self):
-        return sum(len(x) for x in self)
+        return len(self._ids)
 
     def keys(self):
-        return self._mapping.keys()
+        return self._ids.keys()
 
 if __name__ == '__main__':
     import doctest
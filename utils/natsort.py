@@ -267,6 +267,55 @@ def index_natsorted(seq, key=lambda x: x, number_type=float, signed=True, exp=Tr
                                                   signed=signed, exp=exp))
     return [x[0] for x in index_seq_pair]
 
+class NatsortRanks(object):
+    """\
+    Memoized natural order of a growing set of strings (typically seqids).
+    `natsort_key` runs once per distinct string, and `update()` returns a
+    dict string => integer rank, so sort keys become integer tuples.
+
+    Ranks are renumbered when new strings are added, so call `update()` with
+    all the strings of a container before sorting it, and use the returned
+    dict for the whole sort.
+
+        >>> r = NatsortRanks()
+        >>> ranks = r.update(['chr10', 'chr2', 'chr1'])
+        >>> sorted(ranks, key=ranks.get)
+        ['chr1', 'chr2', 'chr10']
+        >>> ranks = r.update(['chr3'])
+        >>> ranks['chr3'], ranks['chr10']
+        (2, 3)
+        >>> r.key('chr10')
+        ('chr', 10)
+
+    """
+    def __init__(self):
+        self.keys = {}
+        self.ranks = {}
+
+    def key(self, s):
+        k = self.keys.get(s)
+        if k is None:
+            k = self.keys[s] = natsort_key(s)
+        return k
+
+    def update(self, names):
+        keys = self.keys
+        new = [x for x in set(names) if x not in keys]
+        if new:
+            for x in new:
+                keys[x] = natsort_key(x)
+            order = sorted(keys, key=keys.get)
+            self.ranks = dict((x, i) for i, x in enumerate(order))
+        return self.ranks
+
+    def __getitem__(self, s):
+        if s not in self.ranks:
+            self.update([s])
+        return self.ranks[s]
+
+# shared by all the containers (Bed, BedArray, Gff, ...) of a process
+seqid_ranks = NatsortRanks()
+
 def test():
     from doctest import DocTestSuite
     return DocTestSuite()
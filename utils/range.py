@@ -6,10 +6,15 @@ This script implements algorithm for finding intersecting rectangles,
 both on the 2D dotplot and 1D-projection
 
 `range_chain` implements the exon-chain algorithm
+
+The `*_array` variants take parallel arrays (seqid codes, starts, ends) and
+run as NumPy sweep-lines; the tuple-based functions are thin wrappers.
 """
 
 import sys
 
+import numpy as np
+
 from itertools import groupby
 from collections import namedtuple, defaultdict
 
@@ -236,6 +241,117 @@ def range_interleave(ranges, sizes={}, empty=False):
 
     return interleaved_ranges
 
+def range_arrays(ranges):
+    """
+    Split a list of (seqid, start, end, ...) into arrays. Seqids are coded
+    following their sorted order, so code order is seqid order.
+
+    >>> names, codes, starts, ends = range_arrays([("2", 5, 9), ("1", 3, 4)])
+    >>> names, codes.tolist(), starts.tolist(), ends.tolist()
+    (['1', '2'], [1, 0], [5, 3], [9, 4])
+    """
+    n = len(ranges)
+    names = sorted(set(r[0] for r in ranges))
+    lookup = dict((x, i) for i, x in enumerate(names))
+    codes = np.fromiter((lookup[r[0]] for r in ranges), dtype="int64", count=n)
+    starts = np.fromiter((r[1] for r in ranges), dtype="int64", count=n)
+    ends = np.fromiter((r[2] for r in ranges), dtype="int64", count=n)
+    return names, codes, starts, ends
+
+def _range_runs(codes, starts, ends, dist=0):
+    """
+    Sort intervals by (seqid, start) and flag where a new run of overlapping
+    intervals begins: start is beyond the running max of ends by more than
+    `dist`, or the seqid changes. Seqids are offset so that a single running
+    max never crosses from one seqid into the next.
+    """
+    codes = np.asarray(codes, dtype="int64")
+    starts = np.asarray(starts, dtype="int64")
+    ends = np.asarray(ends, dtype="int64")
+    order = np.lexsort((ends, starts, codes))
+    c, s, e = codes[order], starts[order], ends[order]
+    base = min(s.min(), e.min())
+    width = max(s.max(), e.max()) - base + dist + 2
+    gs = c * width + (s - base)
+    runmax = np.maximum.accumulate(c * width + (e - base))
+    newrun = np.ones(len(order), dtype=bool)
+    newrun[1:] = gs[1:] - runmax[:-1] > dist
+    return order, newrun, c, s, e
+
+def range_merge_array(codes, starts, ends, dist=0):
+    """
+    Array version of `range_merge`, returns arrays (codes, starts, ends) of
+    the merged ranges, sorted by seqid code and start.
+    """
+    if not len(codes):
+        empty = np.zeros(0, dtype="int64")
+        return empty, empty, empty
+    order, newrun, c, s, e = _range_runs(codes, starts, ends, dist=dist)
+    firsts = np.flatnonzero(newrun)
+    return c[firsts], s[firsts], np.maximum.reduceat(e, firsts)
+
+def range_union_array(codes, starts, ends):
+    """
+    Array version of `range_union`, returns total size of the ranges.
+    """
+    if not len(codes):
+        return 0
+    c, s, e = range_merge_array(codes, starts, ends)
+    return int((e - s + 1).sum())
+
+def range_piles_array(codes, starts, ends):
+    """
+    Array version of `range_piles`, returns the pile number of each interval
+    (in input order). Piles are numbered by position along the seqids.
+    """
+    if not len(codes):
+        return np.zeros(0, dtype="int64")
+    # LEFT sorts before RIGHT at the same position, so touching intervals
+    # join the same pile: new pile only when start > running max of ends
+    order, newrun, c, s, e = _range_runs(codes, starts, ends)
+    piles = np.empty(len(order), dtype="int64")
+    piles[order] = np.cumsum(newrun) - 1
+    return piles
+
+def range_conflict_array(codes, starts, ends, depth=1):
+    """
+    Array version of `range_conflict`, returns a list of arrays of interval
+    indices that are active together at more than `depth` deep. Max depth
+    per pile is computed vectorized; the active sets are only tracked inside
+    the piles that do exceed `depth`.
+    """
+    n = len(codes)
+    if not n:
+        return []
+    codes = np.asarray(codes, dtype="int64")
+    piles = range_piles_array(codes, starts, ends)
+    idx = np.arange(n, dtype="int64")
+    pos = np.concatenate((np.asarray(starts, dtype="int64"),
+                          np.asarray(ends, dtype="int64")))
+    leftright = np.repeat(np.array([LEFT, RIGHT]), n)
+    ids = np.concatenate((idx, idx))
+    order = np.lexsort((ids, leftright, pos, np.concatenate((codes, codes))))
+    pos, leftright, ids = pos[order], leftright[order], ids[order]
+    running = np.cumsum(np.where(leftright == LEFT, 1, -1))
+    epiles = piles[ids]
+    firsts = np.flatnonzero(np.r_[True, epiles[1:] != epiles[:-1]])
+    maxdepth = np.maximum.reduceat(running, firsts)
+
+    overlap = set()
+    bounds = np.r_[firsts, len(order)]
+    for k in np.flatnonzero(maxdepth > depth):
+        active = set()
+        for lr, i in zip(leftright[bounds[k]:bounds[k + 1]].tolist(),
+                         ids[bounds[k]:bounds[k + 1]].tolist()):
+            if lr == LEFT:
+                active.add(i)
+            else:
+                active.remove(i)
+            if len(active) > depth:
+                overlap.add(tuple(sorted(active)))
+
+    return [np.array(x, dtype="int64") for x in sorted(overlap)]
+
 def range_merge(ranges, dist=0):
     """
     Returns merged range. Similar to range_union, except this returns
@@ -254,20 +370,9 @@ def range_merge(ranges, dist=0):
     if not ranges:
         return []
 
-    ranges.sort()
-
-    cur_range = list(ranges[0])
-    merged_ranges = []
-    for r in ranges[1:]:
-        # open new range if start > cur_end or seqid != cur_seqid
-        if r[1] - cur_range[2] > dist or r[0] != cur_range[0]:
-            merged_ranges.append(tuple(cur_range))
-            cur_range = list(r)
-        else:
-            cur_range[2] = max(cur_range[2], r[2])
-    merged_ranges.append(tuple(cur_range))
-
-    return merged_ranges
+    names, codes, starts, ends = range_arrays(ranges)
+    c, s, e = range_merge_array(codes, starts, ends, dist=dist)
+    return [(names[x], y, z) for x, y, z in zip(c.tolist(), s.tolist(), e.tolist())]
 
 def range_union(ranges):
     """
@@ -288,23 +393,8 @@ def range_union(ranges):
     if not ranges:
         return 0
 
-    ranges.sort()
-
-    total_len = 0
-    cur_chr, cur_left, cur_right = ranges[0]  # left-most range
-    for r in ranges:
-        # open new range if left > cur_right or chr != cur_chr
-        if r[1] > cur_right or r[0] != cur_chr:
-            total_len += cur_right - cur_left + 1
-            cur_chr, cur_left, cur_right = r
-        else:
-            # update cur_right
-            cur_right = max(r[2], cur_right)
-
-    # the last one
-    total_len += cur_right - cur_left + 1
-
-    return total_len
+    names, codes, starts, ends = range_arrays(ranges)
+    return range_union_array(codes, starts, ends)
 
 def _make_endpoints(ranges):
     assert ranges, "Ranges cannot be empty"
@@ -325,21 +415,14 @@ def range_piles(ranges):
     >>> list(range_piles(ranges))
     [[0, 1], [2]]
     """
-    endpoints = _make_endpoints(ranges)
-
-    for seqid, ends in groupby(endpoints, lambda x: x[0]):
-        active = []
-        depth = 0
-        for seqid, pos, leftright, i, score in ends:
-            if leftright == LEFT:
-                active.append(i)
-                depth += 1
-            else:
-                depth -= 1
-
-            if depth == 0 and active:
-                yield active
-                active = []
+    assert ranges, "Ranges cannot be empty"
+    names, codes, starts, ends = range_arrays(ranges)
+    piles = range_piles_array(codes, starts, ends)
+    order = np.lexsort((np.arange(len(piles)), starts, piles))
+    sorted_piles = piles[order]
+    firsts = np.flatnonzero(np.r_[True, sorted_piles[1:] != sorted_piles[:-1]])
+    for pile in np.split(order, firsts[1:]):
+        yield pile.tolist()
 
 def range_conflict(ranges, depth=1):
     """
@@ -350,28 +433,98 @@ def range_conflict(ranges, depth=1):
     >>> list(range_conflict(ranges))
     [(0, 1)]
     """
-    overlap = set()
-    active = set()
-    endpoints = _make_endpoints(ranges)
+    assert ranges, "Ranges cannot be empty"
+    names, codes, starts, ends = range_arrays(ranges)
+    for ov in range_conflict_array(codes, starts, ends, depth=depth):
+        yield tuple(ov.tolist())
 
-    for seqid, ends in groupby(endpoints, lambda x: x[0]):
-        active.clear()
-        for seqid, pos, leftright, i, score in ends:
-            if leftright == LEFT:
-                active.add(i)
-            else:
-                active.remove(i)
+def _chain_block(args):
+    """
+    Weighted interval scheduling on one block of intervals, returns the
+    selected positions within the block and the total score.
 
-            if len(active) > depth:
-                overlap.add(tuple(sorted(active)))
+    Intervals are ordered by end; the predecessor of each interval is found
+    by binary search over the sorted ends (an interval ending at the start
+    of another still overlaps it). `best[k]` holds the best score over the
+    first k intervals, `take[k]` is the back-pointer flag.
+    """
+    codes, starts, ends, scores = args
+    n = len(starts)
+    if not n:
+        return np.zeros(0, dtype="int64"), 0
+
+    codes = np.asarray(codes, dtype="int64")
+    starts = np.asarray(starts, dtype="int64")
+    ends = np.asarray(ends, dtype="int64")
+    # intervals on different seqids never overlap, so one key does them all
+    base = min(starts.min(), ends.min())
+    width = max(starts.max(), ends.max()) - base + 1
+    kstarts = codes * width + (starts - base)
+    kends = codes * width + (ends - base)
+    order = np.lexsort((np.arange(n), kends))
+    pred = np.searchsorted(kends[order], kstarts[order], side="left").tolist()
+    weights = np.asarray(scores)[order].tolist()
+
+    best = [0] * (n + 1)
+    take = bytearray(n + 1)
+    for k in range(1, n + 1):
+        cur = best[k - 1]
+        chained = best[pred[k - 1]] + weights[k - 1]
+        if chained > cur:
+            cur = chained
+            take[k] = 1
+        best[k] = cur
+
+    selected = []
+    k = n
+    while k > 0:
+        if take[k]:
+            selected.append(k - 1)
+            k = pred[k - 1]
+        else:
+            k -= 1
+    selected.reverse()
+
+    return order[selected], best[n]
 
-    for ov in overlap:
-        yield ov
+def range_chain_array(codes, starts, ends, scores, cpus=1):
+    """
+    Array version of `range_chain`, returns indices of the selected
+    non-overlapping intervals (ordered by seqid code then end) and the total
+    score. With `cpus` > 1 the seqids are chained on separate processes.
+
+    >>> range_chain_array([0, 0, 0], [0, 3, 10], [9, 18, 28], [22, 24, 20])
+    (array([0, 2]), 42)
+    """
+    codes = np.asarray(codes, dtype="int64")
+    if cpus <= 1 or not len(codes):
+        return _chain_block((codes, starts, ends, scores))
+
+    starts = np.asarray(starts)
+    ends = np.asarray(ends)
+    scores = np.asarray(scores)
+    groups = np.argsort(codes, kind="mergesort")
+    firsts = np.flatnonzero(np.r_[True, np.diff(codes[groups]) != 0])
+    blocks = np.split(groups, firsts[1:])
+
+    from multiprocessing import Pool
+
+    pool = Pool(cpus)
+    try:
+        results = pool.map(_chain_block, [(codes[x], starts[x], ends[x],
+                                           scores[x]) for x in blocks])
+    finally:
+        pool.close()
+        pool.join()
+
+    selected = [x[sel] for x, (sel, score) in zip(blocks, results)]
+    total = sum(score for sel, score in results)
+    return np.concatenate(selected), total
 
 def range_chain(ranges):
     """
     Take list of weighted intervals, find non-overlapping set with max weight.
-    We proceed with each end point (sorted by their relative positions).
+    Thin wrapper around `range_chain_array`.
 
     The input are a list of ranges of the form (start, stop, score), output is
     subset of the non-overlapping ranges that give the highest score, score
@@ -383,39 +536,12 @@ def range_chain(ranges):
     >>> range_chain(ranges)
     ([Range(seqid='2', start=0, end=1, score=3, id=0), Range(seqid='3', start=5, end=7, score=3, id=2)], 6)
     """
-    endpoints = _make_endpoints(ranges)
-
-    # stores the left end index for quick retrieval
-    left_index = {}
-    # dynamic programming, each entry [score, from_index, which_chain]
-    scores = []
-
-    for i, (seqid, pos, leftright, j, score) in enumerate(endpoints):
-
-        cur_score = [0, -1, -1] if i == 0 else scores[-1][:]
-
-        if leftright == LEFT:
-            left_index[j] = i
-
-        else:  # this is right end of j-th interval
-            # update if chaining j-th interval gives a better score
-            left_j = left_index[j]
-            chain_score = scores[left_j][0] + score
-            if chain_score > cur_score[0]:
-                cur_score = [chain_score, left_j, j]
-
-        scores.append(cur_score)
-
-    chains = []
-    score, last, chain_id = scores[-1]  # start backtracking
-    while last != -1:
-        if chain_id != -1:
-            chains.append(chain_id)
-        _, last, chain_id = scores[last]
-
-    chains.reverse()
+    assert ranges, "Ranges cannot be empty"
+    names, codes, starts, ends = range_arrays(ranges)
+    scores = [x.score for x in ranges]
+    chains, score = range_chain_array(codes, starts, ends, scores)
 
-    selected = [ranges[x] for x in chains]
+    selected = [ranges[x] for x in chains.tolist()]
 
     return selected, score
 
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Memory-bounded counting of keys (UMIs, read names, ...) seen in huge
+streams.
+
+Approximate: `CountMinSketch` for per-key counts and `HyperLogLog` for the
+number of distinct keys, both of fixed size. Exact: `SortedRunCounter` and
+`SortedRunSet` keep keys as NumPy arrays sorted in chunks (runs), merged
+when runs of similar size pile up, so each key costs its fixed width and
+not a Python object. `ShardPool` runs one of these per hash-prefix shard in
+its own process.
+"""
+
+import hashlib
+import logging
+import resource
+
+import numpy as np
+
+from maize.utils.cbook import human_size
+
+MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def splitmix64(x):
+    """
+    Vectorized 64-bit mixing of uint64 keys.
+
+    >>> splitmix64(np.array([0, 1], dtype=np.uint64)).tolist()
+    [16294208416658607535, 10451216379200822465]
+    """
+    x = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_bytes(items, digest_size=8):
+    """
+    Digests of byte strings: uint64 for `digest_size` 8, else fixed-width
+    bytes (e.g. "S16"), which sort and compare as keys.
+    """
+    digests = b"".join(hashlib.blake2b(x, digest_size=digest_size).digest()
+                       for x in items)
+    if digest_size == 8:
+        return np.frombuffer(digests, dtype=np.uint64)
+    return np.frombuffer(digests, dtype="S{0}".format(digest_size))
+
+
+def key_hash(keys):
+    """
+    uint64 hash of uint64 or fixed-width bytes keys.
+    """
+    keys = np.asarray(keys)
+    if keys.dtype.kind == "S":
+        if keys.dtype.itemsize >= 8:    # already digests
+            return keys.view(np.uint8).reshape(len(keys), -1)[:, :8].\
+                    copy().view(np.uint64).ravel()
+        return hash_bytes(keys.tolist())
+    return splitmix64(keys)
+
+
+def shard_of(keys, nshards):
+    """
+    Shard index of each key, from the top bits of its hash.
+    """
+    return (key_hash(keys) >> np.uint64(40)) % np.uint64(nshards)
+
+
+def bit_length(x):
+    """
+    Vectorized int.bit_length() of uint64 values.
+
+    >>> bit_length(np.array([0, 1, 5, 1 << 40, (1 << 64) - 1], dtype=np.uint64)).tolist()
+    [0, 1, 3, 41, 64]
+    """
+    x = np.asarray(x, dtype=np.uint64)
+    hi = (x >> np.uint64(32)).astype(np.float64)
+    lo = (x & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(hi > 0, 32 + np.frexp(hi)[1], np.frexp(lo)[1])
+
+
+def peak_rss():
+    """
+    Peak resident memory in bytes of this process and its children.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage * 1024
+
+
+def log_memory(label, nbytes):
+    logging.debug("{0}: {1} in counting structures, peak RSS {2}".\
+            format(label, human_size(nbytes, True), human_size(peak_rss(), True)))
+
+
+class CountMinSketch (object):
+    """
+    Count-min sketch: `depth` rows of `width` counters; a key adds to one
+    counter per row and its count is estimated by the smallest of them,
+    never below the true count.
+
+    >>> cms = CountMinSketch(width=1 << 10)
+    >>> cms.add(np.array([1, 2, 2, 3, 3, 3], dtype=np.uint64))
+    >>> cms.estimate(np.array([1, 2, 3, 4], dtype=np.uint64)).tolist()
+    [1, 2, 3, 0]
+    """
+    def __init__(self, width=1 << 22, depth=4, seed=0):
+        assert width & (width - 1) == 0, "width must be a power of 2"
+        self.width, self.depth = width, depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self.seeds = splitmix64(np.arange(seed, seed + depth, dtype=np.uint64))
+        self.total = 0
+
+    def _index(self, h, row):
+        return (splitmix64(h ^ self.seeds[row]) & np.uint64(self.width - 1)).\
+                    astype(np.intp)
+
+    def add(self, keys, counts=1):
+        h = key_hash(keys)
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._index(h, row), counts)
+        self.total += int(np.sum(counts)) if np.ndim(counts) else \
+                      counts * len(h)
+
+    def estimate(self, keys):
+        h = key_hash(keys)
+        est = self.table[0][self._index(h, 0)]
+        for row in range(1, self.depth):
+            est = np.minimum(est, self.table[row][self._index(h, row)])
+        return est
+
+    def merge(self, other):
+        self.table += other.table
+        self.total += other.total
+
+    @property
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class HyperLogLog (object):
+    """
+    HyperLogLog estimate of the number of distinct keys with 2^p one-byte
+    registers, standard error about 1.04 / sqrt(2^p).
+
+    >>> hll = HyperLogLog()
+    >>> hll.add(np.arange(100000, dtype=np.uint64))
+    >>> abs(hll.estimate() - 100000) < 3000
+    True
+    """
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+    def add(self, keys):
+        h = key_hash(keys)
+        p = np.uint64(self.p)
+        idx = (h >> (np.uint64(64) - p)).astype(np.intp)
+        w = (h << p) & MASK64
+        rank = np.minimum(65 - self.p, 65 - bit_length(w)).astype(np.uint8)
+        np.maximum.at(self.registers, idx, rank)
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int((self.registers == 0).sum())
+        if e <= 2.5 * m and zeros:
+            e = m * np.log(m / zeros)     # small range: linear counting
+        return int(round(e))
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    @property
+    def nbytes(self):
+        return self.registers.nbytes
+
+
+def _merge_counts(runs):
+    keys = np.concatenate([x[0] for x in runs])
+    counts = np.concatenate([x[1] for x in runs])
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    if not len(keys):
+        return keys, counts
+    first = np.r_[True, keys[1:] != keys[:-1]]
+    idx = np.flatnonzero(first)
+    return keys[idx], np.add.reduceat(counts, idx)
+
+
+def _tiered(runs, merge):
+    # merge the newest runs while a run is at least half the one before
+    while len(runs) > 1 and len(runs[-1][0]) * 2 >= len(runs[-2][0]):
+        runs[-2:] = [merge(runs[-2:])]
+
+
+class SortedRunCounter (object):
+    """
+    Exact counts of uint64 or fixed-width bytes keys. Keys are buffered,
+    then turned into a sorted run of (unique keys, counts) every `chunksize`
+    keys; runs of similar size are merged, which keeps O(log n) runs.
+
+    >>> c = SortedRunCounter(chunksize=2)
+    >>> for x in ([3, 1], [3, 2], [3]):
+    ...     c.add(np.array(x, dtype=np.uint64))
+    >>> [x.tolist() for x in c.items()]
+    [[1, 2, 3], [1, 1, 3]]
+    """
+    def __init__(self, chunksize=1 << 22):
+        self.chunksize = chunksize
+        self.buffer, self.nbuffered = [], 0
+        self.runs = []
+
+    def add(self, keys):
+        self.buffer.append(np.asarray(keys))
+        self.nbuffered += len(keys)
+        if self.nbuffered >= self.chunksize:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        keys, counts = np.unique(np.concatenate(self.buffer), return_counts=True)
+        self.buffer, self.nbuffered = [], 0
+        self.runs.append((keys, counts.astype(np.int64)))
+        _tiered(self.runs, _merge_counts)
+
+    def items(self):
+        """
+        Sorted unique keys and their counts.
+        """
+        self._flush()
+        if not self.runs:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        if len(self.runs) > 1:
+            self.runs = [_merge_counts(self.runs)]
+        return self.runs[0]
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.buffer) + \
+               sum(k.nbytes + c.nbytes for k, c in self.runs)
+
+
+def _merge_sets(runs):
+    return (np.sort(np.concatenate([x[0] for x in runs]), kind="stable"),)
+
+
+class SortedRunSet (object):
+    """
+    Exact set of uint64 or fixed-width bytes keys as sorted runs, queried
+    with binary search.
+
+    >>> s = SortedRunSet()
+    >>> s.add_new(np.array([5, 3, 5], dtype=np.uint64)).tolist()
+    [True, True, False]
+    >>> s.add_new(np.array([3, 7], dtype=np.uint64)).tolist()
+    [False, True]
+    >>> len(s)
+    3
+    """
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(x[0]) for x in self.runs)
+
+    def contains(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for run, in self.runs:
+            pos = np.minimum(np.searchsorted(run, keys), len(run) - 1)
+            found |= run[pos] == keys
+        return found
+
+    def add_new(self, keys):
+        """
+        Add keys, returns True for those not seen before (the first of
+        repeated keys within `keys` counts as new).
+        """
+        keys = np.asarray(keys)
+        new = np.zeros(len(keys), dtype=bool)
+        if not len(keys):
+            return new
+        uniq, first = np.unique(keys, return_index=True)
+        unseen = ~self.contains(uniq)
+        new[first[unseen]] = True
+        if unseen.any():
+            self.runs.append((uniq[unseen],))
+            _tiered(self.runs, _merge_sets)
+        return new
+
+    @property
+    def nbytes(self):
+        return sum(x[0].nbytes for x in self.runs)
+
+
+def _shard_worker(conn, factory):
+    obj = factory()
+    while True:
+        method, arg = conn.recv()
+        if method is None:
+            conn.send(None)
+            break
+        conn.send(_invoke(obj, method, arg))
+    conn.close()
+
+
+def _invoke(obj, method, args):
+    attr = getattr(obj, method)
+    return attr(*args) if callable(attr) else attr
+
+
+class ShardPool (object):
+    """
+    One stateful counting object per shard, each in its own process when
+    `cpus` > 1. Keys are routed to shards by hash prefix (`shard_of`), so
+    the shards hold disjoint keys and their results can just be
+    concatenated. `factory` must be picklable.
+    """
+    def __init__(self, factory, cpus=1):
+        self.nshards = max(cpus, 1)
+        self.conns, self.procs = [], []
+        if self.nshards == 1:
+            self.objs = [factory()]
+            return
+
+        import multiprocessing as mp
+
+        for i in range(self.nshards):
+            parent, child = mp.Pipe()
+            proc = mp.Process(target=_shard_worker, args=(child, factory))
+            proc.daemon = True
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def call(self, method, keys, *args):
+        """
+        Split `keys` by shard and call `method(part, *args)` on each shard;
+        results are returned per shard, with the positions of its keys.
+        """
+        keys = np.asarray(keys)
+        if self.nshards == 1:
+            return [(np.arange(len(keys)),
+                     getattr(self.objs[0], method)(keys, *args))]
+
+        shards = shard_of(keys, self.nshards)
+        parts = [np.flatnonzero(shards == i) for i in range(self.nshards)]
+        for conn, idx in zip(self.conns, parts):
+            conn.send((method, (keys[idx],) + args))
+        return [(idx, conn.recv()) for conn, idx in zip(self.conns, parts)]
+
+    def each(self, method, *args):
+        """
+        Call `method(*args)` (or read a property) on every shard, returns
+        the results.
+        """
+        if self.nshards == 1:
+            return [_invoke(self.objs[0], method, args)]
+        for conn in self.conns:
+            conn.send((method, args))
+        return [conn.recv() for conn in self.conns]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send((None, None))
+            conn.recv()
+        for proc in self.procs:
+            proc.join()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()